@@ -0,0 +1,695 @@
+"""
+Simplified TCP over asyncio, many connections can share one event loop.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import asyncio
+import mmap
+import os
+import random
+import socket
+import time
+from collections import deque
+from itertools import chain
+from typing import Callable, Iterable
+
+from segment_tcp import SegmentTCP
+from trace_tcp import TRACE_SEGMENTS
+from socket_tcp import (
+    SocketTCP, SEGMENT_TIMEOUT_SECONDS, CHUNK_BYTECOUNT_PREFIX, MAX_RETRIES, TIME_WAIT_RTOS,
+    CLOSE_TIME_WAIT, CLOSE_LAST_ACK, MODE_GO_BACK_N, MODE_SELECTIVE_REPEAT
+)
+
+# Teardown tasks of closed connections (TIME_WAIT, LAST_ACK), referenced until they end
+_lingering = set()
+
+# Datagram protocol of an AsyncSocketTCP, parses each datagram and queues it for the socket
+class _SegmentProtocol(asyncio.DatagramProtocol):
+    def __init__(self, tcp_socket: 'AsyncSocketTCP'):
+        self.tcp_socket = tcp_socket
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        if self.tcp_socket.capture is not None:
+            self.tcp_socket.capture.write(data, addr, self.tcp_socket.socket.getsockname())
+        try:
+            recv_segment = SegmentTCP.parse_segment(data)
+        except ValueError as e:
+            self.tcp_socket._log('[%s] @datagram_received, dropping invalid datagram from %s: %s', self.tcp_socket.seq, addr, e)
+            return
+        self.tcp_socket.segments.put_nowait((recv_segment, addr))
+
+    # ICMP errors (e.g. port unreachable) are treated as lost segments, retransmissions take care of them
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+# Simplified TCP socket on top of an asyncio datagram endpoint.
+# Same handshake, data and FIN exchange as SocketTCP (and interoperable with it), but the
+# methods that wait segments are coroutines and timers are run by the event loop.
+class AsyncSocketTCP(SocketTCP):
+    # Constructor
+    def __init__(self):
+        super().__init__()
+        self.socket.setblocking(False)
+        self.transport = None
+        # (segment, address) received by the endpoint and not yet processed
+        self.segments = asyncio.Queue()
+
+        # Listening sockets complete handshakes in the background, accept takes them from _accepted
+        self._listener = None
+        self._accepted = asyncio.Queue()
+        self._handshakes = {}
+
+    # Client function
+    # Initiate handshake with the server
+    async def connect(self, address: tuple[str, int]) -> None:
+        await self._connect(address, None)
+
+    # Client function
+    # Connects to address and sends message, see SocketTCP.connect_send
+    async def connect_send(self, address: tuple[str, int], message: bytes) -> None:
+        n_sent = await self._connect(address, message)
+        if n_sent is None:
+            await self.send(message)
+            return
+
+        await self._send_slices(self._slice_message(memoryview(message).cast('B')[n_sent:]))
+        self._log('[%s] @send, end', self.seq)
+
+    # Helper that makes the handshake, see SocketTCP._connect
+    async def _connect(self, address: tuple[str, int], message: 'bytes | None') -> 'int | None':
+        await self._open()
+        self.seq = random.randint(0, 100)
+        self.destination_addr, self.destination_port = address
+        self._log('[%s] @connect, set seq to %s', self.seq, self.seq)
+
+        # Send SYN, seq=x, advertising the supported header version and MSS
+        tcp_segment, fast_open_data = self._syn_segment(address, message)
+        self._log('[%s] @connect, send SYN', self.seq)
+        self._send_segment(tcp_segment)
+        sent_time = time.monotonic()
+
+        # Wait ACK+SYN, seq=x+1
+        self._log('[%s] @connect, wait ACK+SYN...', self.seq)
+        while True:
+            try:
+                recv_segment, recv_address = await self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.ack and rseg.syn and rseg.seq == sock.seq + 1,
+                    f_update_seq=lambda sock, rseg: rseg.seq
+                )
+                break
+            except socket.timeout:
+                self.rtt.backoff()
+                sent_time = None
+                self._log('[%s] @connect, timeout waiting SYN-ACK, resending SYN', self.seq)
+                self._resend_segment(tcp_segment)
+
+        self._sample_rtt(sent_time)
+
+        return self._complete_connect(recv_segment, recv_address, address, fast_open_data)
+
+    # Server function
+    # Returns the next connection whose handshake is completed.
+    # The first call starts listening, handshakes of different clients run concurrently
+    async def accept(self) -> 'tuple[AsyncSocketTCP, tuple[str, int]]':
+        if self._listener is None:
+            await self._open()
+            self._listener = asyncio.ensure_future(self._listen())
+
+        return await self._accepted.get()
+
+    # Sends a full message in byte form
+    async def send(self, message: bytes) -> None:
+        bytecount, message = self._encode_message(message)
+        await self._send_bytecount(bytecount)
+        await self._send_slices(self._slice_message(message))
+        self._log('[%s] @send, end', self.seq)
+
+    # Sends a message read lazily from a file object or an iterable of bytes-like chunks, see SocketTCP.send_stream
+    async def send_stream(self, source, total_length: 'int | None' = None) -> None:
+        chunks = self._iter_chunks(source)
+
+        if total_length is not None and self._codec is None:
+            await self._send_bytecount(str(total_length).encode())
+            await self._send_slices(self._count_slices(
+                chain.from_iterable(self._slice_message(chunk) for chunk in chunks),
+                total_length
+            ))
+        else:
+            if total_length is not None:
+                chunks = self._count_slices(chunks, total_length)
+            for chunk in chunks:
+                bytecount, chunk = self._encode_message(chunk)
+                await self._send_bytecount(CHUNK_BYTECOUNT_PREFIX + bytecount)
+                await self._send_slices(self._slice_message(chunk))
+            await self._send_bytecount(CHUNK_BYTECOUNT_PREFIX + b'0')
+
+        self._log('[%s] @send_stream, end', self.seq)
+
+    # Sends the contents of the file at path, see SocketTCP.sendfile
+    async def sendfile(self, path: str, use_mmap: bool = False) -> None:
+        with open(path, 'rb') as file:
+            file_size = os.fstat(file.fileno()).st_size
+            if not use_mmap or file_size == 0:
+                await self.send_stream(file, file_size)
+                return
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                await self.send(file_map)
+
+    # Receives a TCP Segment of a message, of size buffer_size
+    async def recv(self, buffer_size: int) -> bytes:
+        self._log('[%s] @recv(%s), waiting message...', self.seq, buffer_size, level=TRACE_SEGMENTS)
+        n_bytes = await self._wait_buffered(buffer_size)
+        data = self.recv_buffer.read(n_bytes)
+        self._send_window_update()
+        return data
+
+    # Receives a TCP Segment of a message directly into buffer, returns the number of bytes written
+    async def recv_into(self, buffer) -> int:
+        buffer_view = memoryview(buffer).cast('B')
+        self._log('[%s] @recv_into(%s), waiting message...', self.seq, len(buffer_view), level=TRACE_SEGMENTS)
+        n_bytes = await self._wait_buffered(len(buffer_view))
+        n_bytes = self.recv_buffer.read_into(buffer_view[:n_bytes])
+        self._send_window_update()
+        return n_bytes
+
+    # Receives the next whole message, None if the peer closed the connection instead, see SocketTCP.recv_message
+    async def recv_message(self) -> 'bytes | None':
+        self._log('[%s] @recv_message, waiting message...', self.seq, level=TRACE_SEGMENTS)
+        message = bytearray()
+        while True:
+            n_bytes = await self._wait_buffered(self._remaining_to_deliver() or 1)
+            if self._peer_closed:
+                return None
+            message += self.recv_buffer.read(n_bytes)
+            self._send_window_update()
+            if self.message_received():
+                return bytes(message)
+
+    # Receives the next message straight into the file at path, returns its size, see SocketTCP.recv_file
+    async def recv_file(self, path: str) -> int:
+        self._log('[%s] @recv_file(%s), waiting message...', self.seq, path)
+        with open(path, 'w+b') as file:
+            self._recv_file = file
+            try:
+                await self._wait_buffered(0)
+            finally:
+                if self._recv_sink is not None:
+                    self._recv_sink.flush()
+                    self._recv_sink.close()
+                self._recv_sink = None
+                self._recv_file = None
+
+        return self._message_length
+
+    # Terminates the socket
+    # Handles the B-Host-side FIN/ACK package exchange, a listening socket just stops accepting
+    async def close(self) -> None:
+        if self.is_closed:
+            return
+
+        if self._listener is not None:
+            self._listener.cancel()
+            for handshake in list(self._handshakes.values()):
+                handshake.cancel()
+            self._close_socket()
+            return
+
+        self._log('[%s] @close, initiating termination', self.seq)
+
+        # Send FIN
+        self.seq += 1
+        fin_segment = SegmentTCP(False, False, True, self.seq, b'')
+        self._log('[%s] @close, send FIN', self.seq)
+        self._send_segment(fin_segment)
+        sent_time = time.monotonic()
+
+        # Wait FIN+ACK (MAX_RETRIES timeouts), on timeout resends FIN
+        retries = 1
+        self._log('[%s] @close, wait FIN+ACK...', self.seq)
+        while True:
+            try:
+                await self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.ack and rseg.fin and rseg.seq == sock.seq,
+                    f_update_seq=lambda sock, rseg: sock.seq
+                )
+                break
+            except socket.timeout:
+                # If the last FIN got no response, assume connection is closed.
+                if retries >= MAX_RETRIES:
+                    self._log('[%s] @close, %s timeouts waiting FIN+ACK, assume connection closed', self.seq, retries)
+                    self._close_socket()
+                    return
+
+                retries += 1
+                self.rtt.backoff()
+                sent_time = None
+                self._log('[%s] @close, timeout waiting FIN+ACK, resending FIN', self.seq)
+                self._resend_segment(fin_segment)
+            except ConnectionResetError:
+                return
+
+        self._sample_rtt(sent_time)
+
+        # Send final ACK, TIME_WAIT sends it again for each FIN+ACK the peer retransmits
+        ack_segment = SegmentTCP(False, True, False, self.seq, b'')
+        self._log('[%s] @close, send final ACK', self.seq)
+        self._send_segment(ack_segment)
+        self._linger(CLOSE_TIME_WAIT, ack_segment, time.monotonic() + TIME_WAIT_RTOS * self.rto)
+        self._log('[%s] @close, connection closed', self.seq)
+
+    # Terminates the socket
+    # Handles the A-Host-side FIN/ACK package exchange, the final ACK is waited in the background
+    async def recv_close(self) -> None:
+        if self.is_closed:
+            return
+
+        self._log('[%s] @recv_close, waiting FIN...', self.seq)
+        self._flush_ack()
+
+        # Wait FIN, unless recv already got it
+        while not self._peer_closed:
+            try:
+                await self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.fin,
+                    f_update_seq=lambda sock, rseg: rseg.seq,
+                    timeout=SEGMENT_TIMEOUT_SECONDS
+                )
+                break
+            except socket.timeout:
+                self._log('[%s] @recv_close, timeout waiting FIN, continuing', self.seq)
+                continue
+            except ConnectionResetError:
+                return
+
+        # Send FIN+ACK
+        tcp_segment = SegmentTCP(False, True, True, self.seq, b'')
+        self._log('[%s] @recv_close, send FIN+ACK', self.seq)
+        self._send_segment(tcp_segment)
+        self._linger(CLOSE_LAST_ACK, tcp_segment, time.monotonic() + self.rto)
+        self._log('[%s] @recv_close, connection closed', self.seq)
+
+    # Helper that runs the rest of the teardown as a task of the event loop, instead of the TimeWaitReaper
+    # (the endpoint keeps receiving the segments of the socket)
+    def _linger(self, state: str, tcp_segment: SegmentTCP, deadline: float) -> None:
+        self._close_state = state
+        self._close_segment = tcp_segment
+        self._close_retries = 1
+        self.is_closed = True
+        task = asyncio.ensure_future(self._run_linger(deadline))
+        _lingering.add(task)
+        task.add_done_callback(_lingering.discard)
+
+    # Helper task of _linger, see SocketTCP._linger_segment and SocketTCP._linger_timeout
+    async def _run_linger(self, deadline: float) -> None:
+        try:
+            while True:
+                try:
+                    recv_segment, _ = await asyncio.wait_for(self.segments.get(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    deadline = self._linger_timeout()
+                    if deadline is None:
+                        break
+                    continue
+
+                if not self._linger_segment(recv_segment):
+                    break
+        finally:
+            self._close_socket()
+
+    # Helper that wraps the UDP socket in a datagram endpoint of the running loop
+    async def _open(self) -> None:
+        if self.transport is None:
+            loop = asyncio.get_running_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: _SegmentProtocol(self), sock=self.socket
+            )
+
+    # Helper that closes the endpoint, and with it the UDP socket
+    def _close_socket(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self.socket.close()
+        self.is_closed = True
+
+    # Helper task of listening sockets, starts a handshake for each SYN of a new client
+    # Retransmitted SYNs of a client already in a handshake are left to that handshake
+    async def _listen(self) -> None:
+        self._log('[%s] @accept, wait SYN...', self.seq)
+        while True:
+            try:
+                recv_segment, recv_address = await self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.syn,
+                    f_update_seq=lambda sock, rseg: sock.seq,
+                    timeout=SEGMENT_TIMEOUT_SECONDS
+                )
+            except socket.timeout:
+                continue
+
+            if recv_address in self._handshakes or (recv_address, recv_segment.seq) in self._recent_handshakes:
+                self._log('[%s] @accept, duplicate SYN from %s, ignoring', self.seq, recv_address)
+                continue
+            self._recent_handshakes.append((recv_address, recv_segment.seq))
+
+            handshake = asyncio.ensure_future(self._guarded_handshake(recv_segment, recv_address))
+            handshake.add_done_callback(lambda task, address=recv_address: self._handshakes.pop(address, None))
+            self._handshakes[recv_address] = handshake
+
+    # Helper task of _listen: a SYN with malformed options is dropped, the listener goes on
+    async def _guarded_handshake(self, syn_segment: SegmentTCP, address: tuple[str, int]) -> None:
+        try:
+            await self._handshake(syn_segment, address)
+        except ValueError as e:
+            self._log('[%s] @accept, invalid SYN from %s, ignoring: %s', self.seq, address, e)
+
+    # Helper that answers a SYN from a new connection socket and waits its ACK, see SocketTCP.accept
+    async def _handshake(self, syn_segment: SegmentTCP, address: tuple[str, int]) -> None:
+        conn_socket = AsyncSocketTCP()
+        conn_socket.destination_addr, conn_socket.destination_port = address
+        conn_socket._copy_settings(self)
+        options_data, fast_open_data = SegmentTCP.split_fast_open(syn_segment.msg)
+        options = SegmentTCP.parse_options(options_data)
+        try:
+            conn_socket._negotiate(options)
+        except ValueError:
+            conn_socket._close_socket()
+            raise
+        local_bind_addr = self.origin_addr if self.origin_addr is not None else ''
+
+        # Let the system pick a port
+        conn_socket.socket.bind((local_bind_addr, 0))
+        conn_socket.origin_addr, conn_socket.origin_port = conn_socket.socket.getsockname()
+        await conn_socket._open()
+
+        # Send ACK+SYN, seq=x+1, with the negotiated header version and MSS
+        conn_socket.seq = syn_segment.seq + 1
+        fast_open_options = self._accept_fast_open(conn_socket, options, fast_open_data, address)
+        synack_options = conn_socket._handshake_options(conn_socket.header_version, fast_open_options)
+        tcp_segment = SegmentTCP(True, True, False, conn_socket.seq, synack_options)
+        self._log('[%s] @accept(conn), send ACK+SYN', conn_socket.seq)
+        conn_socket._send_segment(tcp_segment)
+        sent_time = time.monotonic()
+
+        # The client already counts the SYN data as ACKed, the connection is kept even if the ACK never comes
+        fast_open = fast_open_options is not None and 'data' in fast_open_options
+        f_condition = SocketTCP._completes_fast_open if fast_open else SocketTCP._completes_handshake
+
+        # Wait ACK, handshakes whose ACK never arrives are dropped
+        retries = 1
+        self._log('[%s] @accept(conn), wait ACK...', conn_socket.seq)
+        try:
+            while True:
+                try:
+                    await conn_socket._wait_segment(
+                        f_condition=f_condition,
+                        f_update_seq=lambda sock, rseg: sock.seq + 1
+                    )
+                    break
+                except socket.timeout:
+                    if fast_open and retries >= MAX_RETRIES:
+                        self._log('[%s] @accept(conn), %s timeouts waiting ACK, keeping the fast open connection', conn_socket.seq, retries)
+                        break
+                    if retries >= MAX_RETRIES:
+                        self._log('[%s] @accept(conn), %s timeouts waiting ACK, dropping the connection', conn_socket.seq, retries)
+                        conn_socket._close_socket()
+                        return
+                    retries += 1
+                    conn_socket.rtt.backoff()
+                    sent_time = None
+                    self._log('[%s] @accept(conn), timeout waiting ACK, resending SYN-ACK', conn_socket.seq)
+                    conn_socket._resend_segment(tcp_segment)
+        except asyncio.CancelledError:
+            conn_socket._close_socket()
+            raise
+
+        conn_socket._sample_rtt(sent_time)
+
+        self._log('[%s] @accept(conn), handshake completed!', conn_socket.seq)
+
+        if fast_open:
+            conn_socket._receive_fast_open(options['bytecount'], fast_open_data, syn_segment.seq + 3)
+            self._log('[%s] @accept(conn), fast open, %s bytes received in the SYN', conn_socket.seq, len(fast_open_data))
+
+        self._accepted.put_nowait((conn_socket, (conn_socket.origin_addr, conn_socket.origin_port)))
+
+    # Sends a BYTECOUNT segment and waits its ACK, data seq numbers start right after it
+    async def _send_bytecount(self, bytecount: bytes) -> None:
+        # The peer decompresses a message only as its application reads it, the next one waits for room
+        if self._codec is not None:
+            await self._wait_window(1)
+        self.seq += 1
+        tcp_segment = SegmentTCP(False, False, False, self.seq, bytecount)
+        self._log('[%s] @send, send BYTECOUNT', self.seq)
+        self._send_segment(tcp_segment)
+        sent_time = time.monotonic()
+
+        # Wait bytecount ACK
+        self._log('[%s] @send, wait BYTECOUNT ACK...', self.seq)
+        retries = 0
+        while True:
+            try:
+                await self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.ack and rseg.seq == sock.seq + 1,
+                    f_update_seq=lambda sock, rseg: rseg.seq
+                )
+                break
+            except socket.timeout:
+                self._check_retries(retries, 'BYTECOUNT')
+                retries += 1
+                self.rtt.backoff()
+                sent_time = None
+                self._log('[%s] @send, timeout waiting BYTECOUNT ACK, resending BYTECOUNT', self.seq)
+                self._resend_segment(tcp_segment)
+
+        self._sample_rtt(sent_time)
+
+    # Sends the message slices with the configured transfer mode
+    # Stop & Wait is Go-Back-N with a window of a single segment
+    async def _send_slices(self, messages_sliced: Iterable[memoryview]) -> None:
+        if self.transfer_mode == MODE_SELECTIVE_REPEAT:
+            await self._send_selective_repeat(messages_sliced)
+        elif self.transfer_mode == MODE_GO_BACK_N:
+            await self._send_go_back_n(messages_sliced, self.window_size)
+        else:
+            await self._send_go_back_n(messages_sliced, 1)
+
+    # Sends the message slices keeping up to window_size segments in flight, see SocketTCP._send_go_back_n
+    async def _send_go_back_n(self, messages_sliced: Iterable[memoryview], window_size: int) -> None:
+        slices = iter(messages_sliced)
+        in_flight = deque()  # [segment, sent time], sent time is None once retransmitted
+        # Timeouts in a row of the same oldest segment
+        timeouts = 0
+        timed_out_base = None
+        next_slice = None  # Slice waiting for room in the receive window
+        all_sent = False
+        congestion = self._congestion_controller()
+
+        while True:
+            # Fill the window, once the ACKs already received are handled
+            while (not all_sent and len(in_flight) < min(window_size, self._send_window())
+                   and not (in_flight and self._segments_queued())):
+                if next_slice is None:
+                    next_slice = next(slices, None)
+                    if next_slice is None:
+                        all_sent = True
+                        break
+                # The receiver has no room for it yet
+                if not self._window_allows(len(next_slice)):
+                    break
+                message_slice, next_slice = next_slice, None
+
+                send_delay = congestion.send_delay(time.monotonic())
+                if send_delay > 0:
+                    await asyncio.sleep(send_delay)
+                self.seq += len(message_slice)
+                tcp_segment = SegmentTCP(False, False, False, self.seq, message_slice)
+                self._log('[%s] @send(gbn), send msg slice, %s in flight', self.seq, len(in_flight) + 1, level=TRACE_SEGMENTS)
+                self._send_segment(tcp_segment)
+                sent_time = time.monotonic()
+                congestion.on_send(len(message_slice), sent_time)
+                in_flight.append([tcp_segment, sent_time])
+
+            if not in_flight:
+                if all_sent:
+                    break
+                # Nothing in flight will bring a window update, wait for it probing the closed window
+                await self._wait_window(len(next_slice))
+                continue
+
+            # Wait for an ACK that confirms at least the oldest segment in flight, or a duplicate of the last one
+            base_segment = in_flight[0][0]
+            base_start = base_segment.seq - len(base_segment.msg)
+            try:
+                ack_segment, _ = await self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.ack and base_start <= rseg.seq <= sock.seq,
+                    f_update_seq=lambda sock, rseg: sock.seq
+                )
+            except socket.timeout:
+                timeouts = timeouts + 1 if base_segment is timed_out_base else 1
+                timed_out_base = base_segment
+                self._check_retries(timeouts - 1, f'seq {base_segment.seq}')
+                self.rtt.backoff()
+                self._log('[%s] @send(gbn), timeout waiting ACK for seq %s, resending window', self.seq, base_segment.seq)
+                self._end_recovery()
+                congestion.on_timeout(time.monotonic())
+                self._resend_window(in_flight)
+                continue
+
+            self._ack_go_back_n(in_flight, ack_segment)
+
+    # Sends the message slices with a timer per segment, see SocketTCP._send_selective_repeat
+    async def _send_selective_repeat(self, messages_sliced: Iterable[memoryview]) -> None:
+        slices = iter(messages_sliced)
+        in_flight = {}  # seq -> [segment, deadline, sent time], None once ACKed
+        next_slice = None  # Slice waiting for room in the receive window
+        all_sent = False
+        congestion = self._congestion_controller()
+
+        while True:
+            # Fill the window, once the ACKs already received are handled
+            while not all_sent and len(in_flight) < self._send_window() and not (in_flight and self._segments_queued()):
+                if next_slice is None:
+                    next_slice = next(slices, None)
+                    if next_slice is None:
+                        all_sent = True
+                        break
+                # The receiver has no room for it yet
+                if not self._window_allows(len(next_slice)):
+                    break
+                message_slice, next_slice = next_slice, None
+
+                send_delay = congestion.send_delay(time.monotonic())
+                if send_delay > 0:
+                    await asyncio.sleep(send_delay)
+                self.seq += len(message_slice)
+                tcp_segment = SegmentTCP(False, False, False, self.seq, message_slice)
+                self._log('[%s] @send(sr), send msg slice, %s in flight', self.seq, len(in_flight) + 1, level=TRACE_SEGMENTS)
+                self._send_segment(tcp_segment)
+                sent_time = time.monotonic()
+                congestion.on_send(len(message_slice), sent_time)
+                in_flight[self.seq] = [tcp_segment, sent_time + self.rto, sent_time, 0]
+
+            if not in_flight:
+                if all_sent:
+                    break
+                # Nothing in flight will bring a window update, wait for it probing the closed window
+                await self._wait_window(len(next_slice))
+                continue
+
+            # Wait until the earliest timer expires
+            next_deadline = min(entry[1] for entry in in_flight.values() if entry is not None)
+            try:
+                ack_segment, _ = await self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.ack,
+                    f_update_seq=lambda sock, rseg: sock.seq,
+                    timeout=max(next_deadline - time.monotonic(), 0.001)
+                )
+            except socket.timeout:
+                self._resend_expired(in_flight)
+                continue
+
+            self._ack_selective_repeat(in_flight, ack_segment)
+
+    # Helper that receives segments until buffer_size bytes (or the rest of the message) are buffered
+    # Returns how many bytes can be delivered to the caller
+    async def _wait_buffered(self, buffer_size: int) -> int:
+        while not self._peer_closed:
+            # Try to satisfy recv call from buffer
+            if self.expected_total_bytes is not None:
+                n_bytes = min(buffer_size, self._remaining_to_deliver())
+                if n_bytes > 0 and (len(self.recv_buffer) >= n_bytes or self._recv_buffer_full()):
+                    self._flush_ack()
+                    return min(n_bytes, len(self.recv_buffer))
+
+            # Wait for data, or until the delayed ACK is due
+            try:
+                recv_segment, _ = await self._wait_segment(
+                    f_condition=lambda sock, rseg: True,
+                    f_update_seq=lambda sock, rseg: sock.seq,
+                    timeout=self._recv_timeout()
+                )
+            except socket.timeout:
+                if self._ack_deadline is not None:
+                    self._flush_ack()
+                else:
+                    self._log('[%s] @recv, timeout waiting data, continuing', self.seq)
+                continue
+
+            # The peer closed the connection instead of sending another message, recv_close answers its FIN
+            if recv_segment.fin and not recv_segment.ack:
+                self._log('[%s] @recv, FIN received, peer closed the connection', self.seq)
+                self._flush_ack()
+                self.seq = recv_segment.seq
+                self._peer_closed = True
+                break
+
+            # Empty messages, the end of a chunked one or recv_file have nothing else to wait for
+            try:
+                message_completed = self._handle_data_segment(recv_segment)
+            except ValueError as e:
+                raise self._reset_invalid(e) from e
+            if message_completed and self.message_received():
+                self._flush_ack()
+                return 0
+
+        return 0
+
+    # Helper that waits until the peer has room for n_bytes more, probing its closed window, see SocketTCP._wait_window
+    async def _wait_window(self, n_bytes: int) -> None:
+        persist_timeout = self.rto
+        probes = 0
+        while not self._window_allows(n_bytes):
+            try:
+                await self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.ack,
+                    f_update_seq=lambda sock, rseg: sock.seq,
+                    timeout=persist_timeout
+                )
+                probes = 0
+            except socket.timeout:
+                self._check_retries(probes, 'window probe')
+                probes += 1
+                self._log('[%s] @send, receive window closed, sending window probe', self.seq)
+                self._send_segment(SegmentTCP(False, False, False, self.seq, b''))
+                self._stats.window_probes += 1
+                persist_timeout = min(persist_timeout * 2, SEGMENT_TIMEOUT_SECONDS)
+
+    # Helper that checks if received segments are waiting in the queue of the endpoint
+    def _segments_queued(self) -> bool:
+        return not self.segments.empty()
+
+    # Helper private method to send a tcp segment through the endpoint
+    def _send_segment(self, tcp_segment) -> None:
+        message_bytes = SegmentTCP.create_segment(tcp_segment, self.header_version)
+        self._log('[%s] @_send_segment, sent msg: %s', self.seq, tcp_segment, level=TRACE_SEGMENTS)
+        self._stats.segments_sent += 1
+        self._stats.bytes_sent += len(tcp_segment.msg)
+        if self.capture is not None:
+            self.capture.write(message_bytes, self.socket.getsockname(), (self.destination_addr, self.destination_port))
+        self.transport.sendto(message_bytes, (self.destination_addr, self.destination_port))
+
+    # Helper private method to await a tcp segment based on a condition, see SocketTCP._wait_segment
+    # The timeout is run by the event loop, socket.timeout is raised as in SocketTCP
+    async def _wait_segment(self,
+                            f_condition: Callable[['SocketTCP', SegmentTCP], bool],
+                            f_update_seq: Callable[['SocketTCP', SegmentTCP], int],
+                            timeout: 'float | None' = None
+                            ) -> tuple[SegmentTCP, tuple[str, int]]:
+        timeout = self.rtt.rto if timeout is None else timeout
+        while True:
+            # Segments already queued are taken without scheduling a timer
+            try:
+                recv_segment, recv_address = self.segments.get_nowait()
+            except asyncio.QueueEmpty:
+                blocked_since = time.monotonic()
+                try:
+                    recv_segment, recv_address = await asyncio.wait_for(self.segments.get(), timeout)
+                except asyncio.TimeoutError:
+                    raise socket.timeout('timed out')
+                finally:
+                    self._stats.blocked_seconds += time.monotonic() - blocked_since
+
+            if self._check_segment(recv_segment, f_condition, f_update_seq):
+                return recv_segment, recv_address
@@ -0,0 +1,173 @@
+"""
+Goodput benchmark for the Simplified TCP, over the link emulator.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from socket_tcp import SocketTCP, MODE_STOP_AND_WAIT, MODE_GO_BACK_N, MODE_SELECTIVE_REPEAT
+from link_emulator import LinkEmulator, PROFILES, CLIENT_TO_SERVER, SERVER_TO_CLIENT
+from congestion_control import CONGESTION_CONTROLS, CONGESTION_RENO
+from compression import CODECS
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+DEFAULT_MODES = [MODE_STOP_AND_WAIT, MODE_GO_BACK_N, MODE_SELECTIVE_REPEAT]
+RECV_BUFFER_SIZE = 64 * 1024
+# Payloads: random bytes (incompressible) or text, lines of words drawn from TEXT_WORDS
+PAYLOAD_RANDOM = 'random'
+PAYLOAD_TEXT = 'text'
+TEXT_WORDS = ('segmento', 'ventana', 'mensaje', 'conexión', 'cliente', 'servidor', 'socket', 'datos', 'envío',
+              'recepción', 'timeout', 'handshake', 'bytes', 'linea', 'de', 'el', 'la', 'los', 'con', 'por', 'se', 'y')
+NO_COMPRESSION = 'none'
+
+# Message of size bytes of the given payload, the same for the same seed
+def make_message(payload: str, size: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    if payload == PAYLOAD_RANDOM:
+        return rng.randbytes(size)
+
+    text = bytearray()
+    while len(text) < size:
+        line = ' '.join(rng.choice(TEXT_WORDS) for _ in range(rng.randint(4, 16)))
+        text += f'[{rng.randint(0, 9999):04}] {line}\n'.encode()
+    return bytes(text[:size])
+
+# Sends one message of size bytes through the emulator on each of flows connections at once, and
+# measures them at the receiver. Completion time goes from the start of the sends until every message
+# is received, so the handshakes and the FIN exchanges are left out.
+# All the flows share the emulated link, so its bandwidth and queue are a common bottleneck
+def run_transfer(mode: str, size: int, profile_name: str, seed: int, flows: int = 1,
+                 congestion_control: str = CONGESTION_RENO, payload: str = PAYLOAD_RANDOM,
+                 compression: 'str | None' = None) -> dict:
+    message = make_message(payload, size, seed)
+
+    server_socket = SocketTCP()
+    server_socket.transfer_mode = mode
+    server_socket.compression = compression
+    server_socket.bind(('127.0.0.1', 0))
+    server_address = server_socket.socket.getsockname()
+
+    emulator = LinkEmulator(('127.0.0.1', 0), server_address, PROFILES[profile_name], seed)
+    emulator.start()
+
+    results = []
+    def receive(conn_socket: SocketTCP) -> None:
+        conn_socket.keep_current_message = False
+        received = bytearray()
+        while not conn_socket.message_received():
+            received += conn_socket.recv(RECV_BUFFER_SIZE)
+        results.append((time.monotonic(), received == message))
+        conn_socket.recv_close()
+
+    def accept() -> None:
+        for _ in range(flows):
+            conn_socket, _ = server_socket.accept()
+            threading.Thread(target=receive, args=(conn_socket,)).start()
+
+    acceptor = threading.Thread(target=accept)
+    acceptor.start()
+
+    client_sockets = []
+    for _ in range(flows):
+        client_socket = SocketTCP()
+        client_socket.transfer_mode = mode
+        client_socket.congestion_control = congestion_control
+        client_socket.compression = compression
+        client_socket.connect(emulator.listen_address)
+        client_sockets.append(client_socket)
+    acceptor.join()
+
+    def send(client_socket: SocketTCP) -> None:
+        client_socket.send(message)
+        client_socket.close()
+
+    senders = [threading.Thread(target=send, args=(client_socket,)) for client_socket in client_sockets]
+    start = time.monotonic()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    while len(results) < flows:
+        time.sleep(0.01)
+
+    emulator.stop()
+    server_socket.socket.close()
+
+    seconds = max(end for end, _ in results) - start
+    return {
+        'mode': mode,
+        'congestion_control': congestion_control,
+        'payload': payload,
+        'compression': compression,
+        'profile': profile_name,
+        'link': PROFILES[profile_name].to_dict(),
+        'size': size,
+        'flows': flows,
+        'ok': all(ok for _, ok in results),
+        'seconds': round(seconds, 6),
+        'goodput_bytes_per_second': round(flows * size / seconds, 1) if seconds > 0 else None,
+        'retransmissions': emulator.stats['retransmissions'],
+        'datagrams_sent': emulator.stats[CLIENT_TO_SERVER]['datagrams'],
+        'acks_sent': emulator.stats[SERVER_TO_CLIENT]['datagrams'],
+        'dropped': sum(emulator.stats[direction][counter] for direction in (CLIENT_TO_SERVER, SERVER_TO_CLIENT)
+                       for counter in ('dropped', 'overflowed')),
+    }
+
+# Commit of the working tree, to compare reports between commits
+def current_commit() -> 'str | None':
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Goodput benchmark of SocketTCP over emulated links')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Message sizes in bytes')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=sorted(PROFILES))
+    parser.add_argument('--modes', nargs='+', choices=DEFAULT_MODES, default=DEFAULT_MODES)
+    parser.add_argument('--congestion', nargs='+', choices=sorted(CONGESTION_CONTROLS), default=[CONGESTION_RENO],
+                        help='Congestion controls of the senders')
+    parser.add_argument('--flows', type=int, default=1, help='Concurrent connections sharing the link')
+    parser.add_argument('--payload', choices=(PAYLOAD_RANDOM, PAYLOAD_TEXT), default=PAYLOAD_RANDOM,
+                        help='Content of the messages')
+    parser.add_argument('--compression', nargs='+', choices=[NO_COMPRESSION] + sorted(CODECS),
+                        default=[NO_COMPRESSION], help='Compression codecs of both peers')
+    parser.add_argument('--seed', type=int, default=4303, help='Seed of the messages and the emulated links')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+    for profile_name in args.profiles:
+        for mode in args.modes:
+            for congestion_control in args.congestion:
+                for compression in args.compression:
+                    for size in args.sizes:
+                        result = run_transfer(mode, size, profile_name, args.seed, args.flows, congestion_control,
+                                              args.payload, None if compression == NO_COMPRESSION else compression)
+                        results.append(result)
+                        print(f'{profile_name:12} {mode:17} {congestion_control:10} {compression:5} {size:>10} B  '
+                              f'{result["seconds"]:8.3f} s  {result["goodput_bytes_per_second"] or 0:>12.0f} B/s  '
+                              f'{result["retransmissions"]:>6} retransmissions', file=sys.stderr)
+
+    report = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -5,27 +5,72 @@ Author: Augusto Aguayo Barham
 """
 
 import argparse
+import os
+import stat
+import sys
 from socket_tcp import SocketTCP
+from compression import CODECS
+from striped_transfer import send_striped, format_report
+from load_generator import run_load
 
 parser = argparse.ArgumentParser(description='Actividad 3: Sockets orientados a conexión con Stop & Wait')
 parser.add_argument('host', help='Server hostname or IP address')
 parser.add_argument('port', type=int, help='Server port number')
+parser.add_argument('--file', nargs='+', help='Send these files instead of STDIN, each one as a message over the same connection')
+parser.add_argument('--mmap', action='store_true', help='Map the files to send (requires --file)')
+parser.add_argument('--compression', choices=sorted(CODECS), help='Compress the messages, if the server also does')
+parser.add_argument('--stripes', type=int, help='Send the file in this many parallel connections, one process each (requires a single --file)')
+parser.add_argument('--clients', type=int, help='Load generator: this many client processes open --connections connections in total, each sending one message')
+parser.add_argument('--connections', type=int, default=1000, help='Connections opened by the load generator (requires --clients)')
+parser.add_argument('--size', type=int, default=1000, help='Bytes of the message of each load generator connection, unless a single --file is given')
 args = parser.parse_args()
 
-# Read STDIN
-data = ''
-while True:
-    try:
-        line = input()
-        data += line + '\n'
-    except EOFError:
-        break
+if args.clients is not None:
+    if args.file is not None and len(args.file) != 1:
+        parser.error('--clients takes a single --file')
+    if args.file is not None:
+        with open(args.file[0], 'rb') as file:
+            message = file.read()
+    else:
+        message = os.urandom(args.size)
 
-data_bytes = data.encode()
+    def configure(tcp_socket: SocketTCP) -> None:
+        tcp_socket.compression = args.compression
+
+    report = run_load((args.host, args.port), message, args.connections, args.clients, configure)
+    print(' =============== LOAD GENERATOR ==============')
+    for client in report['clients']:
+        print(f"client {client['client']} (pid {client['pid']}): {client['connections']} connections, {client['failed']} failed")
+        for error, count in client['errors'].items():
+            print(f'  {count} x {error}')
+    print(f"total   : {report['connections']} connections, {report['failed']} failed, {report['bytes']} bytes in "
+          f"{report['seconds']} s, {report['connections_per_second']} connections/s, "
+          f"{report['goodput_bytes_per_second']} B/s")
+    print(f"connection time: mean {report['connection_seconds_mean']} s, p50 {report['connection_seconds_p50']} s, "
+          f"p99 {report['connection_seconds_p99']} s")
+    sys.exit(0 if report['failed'] == 0 else 1)
+
+if args.stripes is not None:
+    if args.file is None or len(args.file) != 1:
+        parser.error('--stripes requires a single --file')
+
+    def configure(tcp_socket: SocketTCP) -> None:
+        tcp_socket.compression = args.compression
+
+    report = send_striped((args.host, args.port), args.file[0], args.stripes, configure)
+    print(' ============== STRIPED TRANSFER =============')
+    print(format_report(report))
+    sys.exit(0 if report['ok'] else 1)
+
+# STDIN is streamed, its length is only known beforehand when it is redirected from a file
+stdin = sys.stdin.buffer
+stdin_stat = os.fstat(stdin.fileno())
+stdin_length = stdin_stat.st_size if stat.S_ISREG(stdin_stat.st_mode) else None
 
 # Create socket and connect
 client_socket = SocketTCP()
 client_socket.debug_mode = True
+client_socket.compression = args.compression
 client_socket.connect((args.host, args.port))
 
 print(' ============== CONNECTION DATA ==============')
@@ -36,7 +81,11 @@ print(' =============================================')
 print()
 print(' =============== SENDING DATA ================')
 print()
-client_socket.send(data_bytes)
+if args.file is not None:
+    for path in args.file:
+        client_socket.sendfile(path, use_mmap=args.mmap)
+else:
+    client_socket.send_stream(stdin, stdin_length)
 print()
 print(' ============= CLOSING CONNECTION ============')
 client_socket.close()
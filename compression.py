@@ -0,0 +1,87 @@
+"""
+Payload compression for the Simplified TCP: codecs negotiated in the handshake, applied per message.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import zlib
+
+# Codecs, picked per socket with SocketTCP.compression (both peers must pick the same one)
+COMPRESSION_ZLIB = 'zlib'
+
+# Messages shorter than this are sent as they are, they would not save a segment
+COMPRESSION_MIN_SIZE = 256
+# Compressed messages must take at most this fraction of the original, otherwise they are sent as they are
+COMPRESSION_MAX_RATIO = 0.9
+# Longer messages are tried on their first bytes first, incompressible data is not compressed whole
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+
+DEFAULT_ZLIB_LEVEL = 6
+
+# Compresses whole messages and decompresses them as their segments arrive.
+# Subclasses set name (the value negotiated in the handshake) and implement:
+# - compress(data), returning the compressed bytes of a whole message
+# - decompressor(), returning a new object like zlib's decompressobj: decompress(data, max_length) returns at most
+#   max_length (0 for no limit) more bytes of the message, keeping the input it did not use in unconsumed_tail,
+#   so that once all the compressed bytes went through it the whole message was returned
+# and set error to the exception its decompressor raises on corrupt data
+class CompressionCodec:
+    name = None
+    error = ValueError
+
+    def __str__(self):
+        return f'<{type(self).__name__}> [NAME:{self.name}]'
+
+    def __repr__(self):
+        return str(self)
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompressor(self):
+        raise NotImplementedError
+
+class ZlibCodec(CompressionCodec):
+    name = COMPRESSION_ZLIB
+    error = zlib.error
+
+    def __init__(self, level: int = DEFAULT_ZLIB_LEVEL):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+CODECS = {
+    COMPRESSION_ZLIB: ZlibCodec,
+}
+
+# Makes a codec class available to SocketTCP.compression under its name
+def register_codec(codec_class: type) -> None:
+    if not isinstance(codec_class.name, str) or not codec_class.name:
+        raise ValueError(f'{codec_class.__name__}.name must be a non-empty string')
+    CODECS[codec_class.name] = codec_class
+
+def create_codec(name: str) -> CompressionCodec:
+    if name not in CODECS:
+        raise ValueError(f'Unknown compression codec {name!r}, expected one of {", ".join(CODECS)}')
+    return CODECS[name]()
+
+# Returns the compressed message, or None if it is better sent as it is: too short, or compressing it does not
+# save enough. Messages longer than a sample are given up on if their first bytes do not compress
+def compress_message(codec: CompressionCodec, message: bytes) -> 'bytes | None':
+    message_view = memoryview(message).cast('B')
+    if len(message_view) < COMPRESSION_MIN_SIZE:
+        return None
+
+    if len(message_view) > COMPRESSION_SAMPLE_SIZE:
+        sample = codec.compress(message_view[:COMPRESSION_SAMPLE_SIZE])
+        if len(sample) > COMPRESSION_SAMPLE_SIZE * COMPRESSION_MAX_RATIO:
+            return None
+
+    compressed = codec.compress(message_view)
+    if len(compressed) > len(message_view) * COMPRESSION_MAX_RATIO:
+        return None
+    return compressed
@@ -0,0 +1,169 @@
+"""
+Congestion control for the Simplified TCP senders: Reno, CUBIC and a fixed-rate pacer.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+# Algorithms, picked per socket with SocketTCP.congestion_control
+CONGESTION_NONE = 'none'
+CONGESTION_RENO = 'reno'
+CONGESTION_CUBIC = 'cubic'
+CONGESTION_FIXED_RATE = 'fixed_rate'
+
+# Windows are counted in segments, as SocketTCP.window_size
+INITIAL_WINDOW = 4
+MIN_WINDOW = 2
+# Window after a timeout, two segments so the receiver ACKs them without waiting its delayed ACK timer
+LOSS_WINDOW = 2
+
+# CUBIC constants (RFC 8312)
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+# Rate of the fixed-rate pacer, in bytes per second
+DEFAULT_PACING_RATE = 1_000_000
+
+# Decides how many segments a sender may keep in flight, never more than max_window (the socket's window_size).
+# This base class is no congestion control at all: the window is always max_window and segments are never paced.
+# Subclasses react to the sender events: on_send for each segment, on_ack for each ACK that confirms new
+# segments outside a recovery, on_loss for a fast retransmit and on_timeout for a retransmission timeout
+class CongestionControl:
+    name = CONGESTION_NONE
+
+    def __init__(self, max_window: int):
+        self.max_window = max_window
+        self.cwnd = float(max_window)
+        self.ssthresh = float('inf')
+
+    def __str__(self):
+        return f'<{type(self).__name__}> [CWND:{self.cwnd:.2f}, SSTHRESH:{self.ssthresh}]'
+
+    def __repr__(self):
+        return str(self)
+
+    # Segments allowed in flight
+    def window(self) -> int:
+        return max(min(int(self.cwnd), self.max_window), 1)
+
+    # Seconds to wait before sending the next segment
+    def send_delay(self, now: float) -> float:
+        return 0.0
+
+    def on_send(self, n_bytes: int, now: float) -> None:
+        pass
+
+    # acked_segments were confirmed by one ACK, srtt is the smoothed RTT of the connection (None before any sample)
+    def on_ack(self, acked_segments: int, srtt: 'float | None', now: float) -> None:
+        pass
+
+    def on_loss(self, now: float) -> None:
+        pass
+
+    def on_timeout(self, now: float) -> None:
+        pass
+
+# Slow start up to ssthresh, then one more segment per window of ACKs (congestion avoidance).
+# Losses halve the window, timeouts also restart slow start from LOSS_WINDOW
+class RenoCongestionControl(CongestionControl):
+    name = CONGESTION_RENO
+
+    def __init__(self, max_window: int):
+        super().__init__(max_window)
+        self.cwnd = float(min(INITIAL_WINDOW, max_window))
+
+    def on_ack(self, acked_segments: int, srtt: 'float | None', now: float) -> None:
+        for _ in range(acked_segments):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        # Growing past the window the sender can use would only delay the reaction to losses
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self, now: float) -> None:
+        self.ssthresh = max(self.cwnd / 2, MIN_WINDOW)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, now: float) -> None:
+        self.ssthresh = max(self.cwnd / 2, MIN_WINDOW)
+        self.cwnd = float(LOSS_WINDOW)
+
+# Out of slow start the window follows a cubic of the time since the last loss, centered on the window
+# it had then (w_max): it grows fast while far from it, flattens around it and probes beyond it.
+# It never grows slower than Reno would (TCP-friendly region)
+class CubicCongestionControl(CongestionControl):
+    name = CONGESTION_CUBIC
+
+    def __init__(self, max_window: int):
+        super().__init__(max_window)
+        self.cwnd = float(min(INITIAL_WINDOW, max_window))
+        self.w_max = 0.0
+        self.epoch_start = None
+        self.k = 0.0
+        self.origin = 0.0
+        self.w_reno = 0.0
+
+    def on_ack(self, acked_segments: int, srtt: 'float | None', now: float) -> None:
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked_segments
+        else:
+            if self.epoch_start is None:
+                self.epoch_start = now
+                self.origin = max(self.w_max, self.cwnd)
+                self.k = (max(self.w_max - self.cwnd, 0) / CUBIC_C) ** (1 / 3)
+                self.w_reno = self.cwnd
+
+            t = now - self.epoch_start + (srtt or 0)
+            target = self.origin + CUBIC_C * (t - self.k) ** 3
+            if target > self.cwnd:
+                self.cwnd += (target - self.cwnd) / self.cwnd * acked_segments
+            else:
+                self.cwnd += 0.01 * acked_segments / self.cwnd
+
+            self.w_reno += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * acked_segments / self.cwnd
+            self.cwnd = max(self.cwnd, self.w_reno)
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self, now: float) -> None:
+        # Fast convergence, a flow that lost before reaching its previous w_max leaves room to the others
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + CUBIC_BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * CUBIC_BETA, MIN_WINDOW)
+        self.cwnd = self.ssthresh
+        self.epoch_start = None
+
+    def on_timeout(self, now: float) -> None:
+        self.on_loss(now)
+        self.cwnd = float(LOSS_WINDOW)
+
+# Sends at a constant rate whatever happens, the window is always max_window.
+# Useful as a reference, or on links whose capacity is known
+class FixedRateCongestionControl(CongestionControl):
+    name = CONGESTION_FIXED_RATE
+
+    def __init__(self, max_window: int, rate: float = DEFAULT_PACING_RATE):
+        super().__init__(max_window)
+        self.rate = rate
+        self.next_send = 0.0
+
+    def send_delay(self, now: float) -> float:
+        return max(self.next_send - now, 0.0)
+
+    def on_send(self, n_bytes: int, now: float) -> None:
+        self.next_send = max(self.next_send, now) + n_bytes / self.rate
+
+CONGESTION_CONTROLS = {
+    algorithm.name: algorithm
+    for algorithm in (CongestionControl, RenoCongestionControl, CubicCongestionControl, FixedRateCongestionControl)
+}
+
+# Creates the congestion control called name, pacing_rate is only used by the fixed-rate pacer
+def create_congestion_control(name: str, max_window: int,
+                              pacing_rate: float = DEFAULT_PACING_RATE) -> CongestionControl:
+    if name not in CONGESTION_CONTROLS:
+        raise ValueError(f'Unknown congestion control {name!r}, expected one of {", ".join(CONGESTION_CONTROLS)}')
+    if name == CONGESTION_FIXED_RATE:
+        return FixedRateCongestionControl(max_window, pacing_rate)
+    return CONGESTION_CONTROLS[name](max_window)
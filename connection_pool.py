@@ -0,0 +1,180 @@
+"""
+Client connection pool for the Simplified TCP, reuses established connections per destination.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from socket_tcp import SocketTCP
+
+# Idle connections kept per destination, the rest are closed when released
+DEFAULT_MAX_IDLE_PER_DESTINATION = 4
+# Seconds an idle connection may wait to be reused, older ones are closed instead
+DEFAULT_IDLE_TIMEOUT_SECONDS = 30.0
+
+# Keeps the connections released by its users open, to hand them to the next request to the same destination.
+# Every message then costs its segments only, without a handshake nor a FIN exchange.
+# configure is called with each new socket before it connects (transfer mode, window, MSS...).
+# Connections are used by one caller at a time, the pool itself can be shared between threads
+class ConnectionPool:
+    def __init__(self, max_idle_per_destination: int = DEFAULT_MAX_IDLE_PER_DESTINATION,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT_SECONDS,
+                 configure: 'Callable[[SocketTCP], None] | None' = None):
+        if max_idle_per_destination < 0:
+            raise ValueError(f'max_idle_per_destination must not be negative, got {max_idle_per_destination}')
+
+        self.max_idle_per_destination = max_idle_per_destination
+        self.idle_timeout = idle_timeout
+        self.configure = configure
+        # Destination (host, port) -> deque of (connection, released time), most recently released last
+        self.idle = {}
+        # Connection -> destination it was acquired for, the connection's own destination is the port accept gave it
+        self.in_use = {}
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def __str__(self):
+        idle = sum(len(connections) for connections in self.idle.values())
+        return f'<ConnectionPool> [IDLE:{idle}, OPENED:{self.connections_opened}, REUSED:{self.connections_reused}]'
+
+    def __repr__(self):
+        return str(self)
+
+    def __enter__(self) -> 'ConnectionPool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    # Returns a connection to address, the most recently released one if there is any, else a new one
+    def acquire(self, address: tuple[str, int]) -> SocketTCP:
+        return self._acquire(address)[0]
+
+    # Helper of acquire, also returns whether the connection was reused.
+    # Idle connections the server closed or reset meanwhile are discarded
+    def _acquire(self, address: tuple[str, int]) -> tuple[SocketTCP, bool]:
+        while True:
+            conn_socket = None
+            expired = []
+            with self.lock:
+                connections = self.idle.get(address)
+                if connections:
+                    conn_socket, released = connections.pop()
+                    # The others were released before it, they expired too
+                    if time.monotonic() - released > self.idle_timeout:
+                        expired = [conn_socket] + [idle_socket for idle_socket, _ in connections]
+                        connections.clear()
+                        conn_socket = None
+
+            for expired_socket in expired:
+                expired_socket.close()
+            if conn_socket is None:
+                break
+            if conn_socket._reusable():
+                with self.lock:
+                    self.connections_reused += 1
+                    self.in_use[conn_socket] = address
+                return conn_socket, True
+            ConnectionPool._discard(conn_socket)
+
+        conn_socket = SocketTCP()
+        if self.configure is not None:
+            self.configure(conn_socket)
+        conn_socket.connect(address)
+        with self.lock:
+            self.connections_opened += 1
+            self.in_use[conn_socket] = address
+        return conn_socket, False
+
+    # Gives a connection back to the pool. Closed connections, those left in the middle of a message
+    # (aborted, the server would answer the next request with the rest of it) and those over
+    # max_idle_per_destination are not kept
+    def release(self, conn_socket: SocketTCP) -> None:
+        with self.lock:
+            address = self.in_use.pop(conn_socket, None)
+        if address is None:
+            raise ValueError(f'{conn_socket} was not acquired from this pool')
+        if conn_socket.is_closed:
+            return
+        # The server closed it, answer its FIN
+        if conn_socket._peer_closed:
+            conn_socket.recv_close()
+            return
+        if not ConnectionPool._between_messages(conn_socket):
+            conn_socket.abort()
+            return
+
+        with self.lock:
+            connections = self.idle.setdefault(address, deque())
+            if len(connections) < self.max_idle_per_destination:
+                connections.append((conn_socket, time.monotonic()))
+                return
+
+        conn_socket.close()
+
+    # Context manager over acquire and release, a connection that raised is aborted instead of kept
+    @contextmanager
+    def connection(self, address: tuple[str, int]) -> Iterator[SocketTCP]:
+        conn_socket = self.acquire(address)
+        try:
+            yield conn_socket
+        except BaseException:
+            with self.lock:
+                self.in_use.pop(conn_socket, None)
+            conn_socket.abort()
+            raise
+        self.release(conn_socket)
+
+    # Sends message to address and returns the whole response, through a pooled connection
+    # A reused connection whose server is gone (send raises ConnectionError) is dropped and the request is sent
+    # again over another one, a new connection raises instead.
+    # Returns None if the server closed the connection instead of answering
+    def request(self, address: tuple[str, int], message: bytes) -> 'bytes | None':
+        while True:
+            conn_socket, reused = self._acquire(address)
+            try:
+                conn_socket.send(message)
+                response = conn_socket.recv_message()
+            except ConnectionError:
+                with self.lock:
+                    self.in_use.pop(conn_socket, None)
+                conn_socket.abort()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                with self.lock:
+                    self.in_use.pop(conn_socket, None)
+                conn_socket.abort()
+                raise
+
+            self.release(conn_socket)
+            return response
+
+    # Helper that ends an idle connection that can not be reused: answers the server's FIN, or drops it
+    @staticmethod
+    def _discard(conn_socket: SocketTCP) -> None:
+        if conn_socket._peer_closed:
+            conn_socket.recv_close()
+        else:
+            conn_socket.abort()
+
+    # Closes every idle connection
+    def close(self) -> None:
+        with self.lock:
+            connections = [conn_socket for idle in self.idle.values() for conn_socket, _ in idle]
+            self.idle.clear()
+
+        for conn_socket in connections:
+            conn_socket.close()
+
+    # Helper that checks if nothing of a received message is left unread, the next user would get it
+    @staticmethod
+    def _between_messages(conn_socket: SocketTCP) -> bool:
+        return conn_socket.expected_total_bytes is None or conn_socket.message_received()
@@ -0,0 +1,49 @@
+"""
+Per-connection counters of the Simplified TCP.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+# Counters kept by each SocketTCP, read through SocketTCP.stats()
+# Only plain increments happen on the per-segment paths
+class ConnectionStats:
+    __slots__ = ('segments_sent', 'segments_received', 'bytes_sent', 'bytes_received', 'retransmissions',
+                 'fast_retransmits', 'duplicate_acks', 'window_probes', 'rtt_samples', 'rtt_sum', 'rtt_min', 'rtt_max',
+                 'bytes_delivered', 'blocked_seconds', 'compressed_messages', 'compression_saved_bytes')
+
+    def __init__(self):
+        self.segments_sent = 0
+        self.segments_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retransmissions = 0
+        self.fast_retransmits = 0
+        self.duplicate_acks = 0
+        self.window_probes = 0
+        self.rtt_samples = 0
+        self.rtt_sum = 0.0
+        self.rtt_min = None
+        self.rtt_max = None
+        self.bytes_delivered = 0
+        self.blocked_seconds = 0.0
+        self.compressed_messages = 0
+        self.compression_saved_bytes = 0
+
+    def __str__(self):
+        return f'<ConnectionStats> {self.to_dict()}'
+
+    def __repr__(self):
+        return str(self)
+
+    # Adds an RTT measurement, in seconds
+    def add_rtt_sample(self, rtt: float) -> None:
+        self.rtt_samples += 1
+        self.rtt_sum += rtt
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self.rtt_max = rtt if self.rtt_max is None else max(self.rtt_max, rtt)
+
+    # Snapshot of the counters as a dict
+    def to_dict(self) -> dict:
+        stats = {name: getattr(self, name) for name in self.__slots__ if name != 'rtt_sum'}
+        stats['rtt_mean'] = self.rtt_sum / self.rtt_samples if self.rtt_samples else None
+        return stats
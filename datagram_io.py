@@ -0,0 +1,203 @@
+"""
+Datagram I/O of the Simplified TCP: one syscall per segment, or batched with UDP GSO/GRO on Linux.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import errno
+import select
+import socket
+import struct
+import sys
+from collections import deque
+
+# UDP socket options for segmentation offload (Linux 4.18+ for GSO, 5.0+ for GRO), missing from older Pythons
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+GSO_SIZE = struct.Struct('=H')
+# Datagrams one GSO send may carry, and their total size (an IPv4 UDP payload)
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65507
+# Receive buffer, fits a whole GRO coalesced datagram
+RECV_BUFFER_SIZE = 65536
+# Datagrams drained from the socket per wakeup, the rest wait for the next one
+RECV_BATCH = 64
+# Errors of a GSO send that mean the path can not segment it (no checksum offload, datagrams over the MTU)
+GSO_ERRNOS = (errno.EIO, errno.EINVAL, errno.EMSGSIZE, errno.ENOPROTOOPT, errno.EOPNOTSUPP)
+
+# Sends and receives the datagrams of a socket, one sendto/recvfrom each
+class DatagramIO:
+    def __init__(self, udp_socket: socket.socket):
+        self.socket = udp_socket
+        self.timeout = None
+
+    def __str__(self):
+        return f'<{type(self).__name__}> [FD:{self.socket.fileno()}]'
+
+    def __repr__(self):
+        return str(self)
+
+    # Sends the datagrams in order
+    # On a non-blocking socket (the one DemuxServerTCP shares) a datagram that finds the send buffer full is
+    # dropped, as if lost on the way: the retransmissions of the connection resend it
+    def send(self, datagrams: list, address: tuple[str, int]) -> None:
+        for datagram in datagrams:
+            try:
+                self.socket.sendto(datagram, address)
+            except BlockingIOError:
+                pass
+
+    # Whether datagrams already read from the socket wait for recv, this one reads them one at a time
+    def pending(self) -> bool:
+        return False
+
+    # Receives one datagram of at most buffer_size bytes, as (data, address)
+    # Raises socket.timeout if none arrives within timeout seconds
+    def recv(self, timeout: 'float | None', buffer_size: int) -> tuple[bytes, tuple[str, int]]:
+        # Changing the timeout is a syscall, most waits use the same one
+        if timeout != self.timeout:
+            self.socket.settimeout(timeout)
+            self.timeout = timeout
+        return self.socket.recvfrom(buffer_size)
+
+# Linux backend, the socket is kept non-blocking:
+# - recv waits with poll only when nothing is queued, then drains every ready datagram into a preallocated
+#   buffer. With GRO the kernel hands consecutive datagrams of a peer coalesced in a single read
+# - send coalesces runs of equal size datagrams into one sendmsg with UDP_SEGMENT (GSO), the kernel splits them
+# Either offload is turned off for the socket the first time the kernel refuses it, falling back to DatagramIO's path
+class BatchedDatagramIO(DatagramIO):
+    def __init__(self, udp_socket: socket.socket):
+        super().__init__(udp_socket)
+        self.socket.setblocking(False)
+        self.received = deque()
+        self.gso = BatchedDatagramIO._offload_supported(self.socket, UDP_SEGMENT)
+        # Receiving is set up by the first recv, sockets that only send (DemuxServerTCP connections) skip it.
+        # GRO changes what the socket reads, so it is also turned on then
+        self.poller = None
+        self.buffer = None
+        self.buffer_view = None
+        self.gro = False
+
+    def send(self, datagrams: list, address: tuple[str, int]) -> None:
+        if not self.gso or len(datagrams) == 1:
+            for datagram in datagrams:
+                self._sendto(datagram, address)
+            return
+
+        start = 0
+        while start < len(datagrams):
+            end = BatchedDatagramIO._gso_run(datagrams, start)
+            if end - start == 1 or not self._send_gso(datagrams[start:end], address):
+                for datagram in datagrams[start:end]:
+                    self._sendto(datagram, address)
+            start = end
+
+    def pending(self) -> bool:
+        return bool(self.received)
+
+    def recv(self, timeout: 'float | None', buffer_size: int) -> tuple[bytes, tuple[str, int]]:
+        if not self.received:
+            if self.poller is None:
+                self._setup_recv()
+            if not self.poller.poll(None if timeout is None else timeout * 1000):
+                raise socket.timeout('timed out')
+            self._drain()
+            # Readable, but the datagram was gone (a checksum error): take it as the end of the wait
+            if not self.received:
+                raise socket.timeout('timed out')
+
+        data, address = self.received.popleft()
+        return data[:buffer_size], address
+
+    def _setup_recv(self) -> None:
+        self.poller = select.poll()
+        self.poller.register(self.socket, select.POLLIN)
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.buffer_view = memoryview(self.buffer)
+        self.gro = BatchedDatagramIO._enable_gro(self.socket)
+
+    # Helper that reads every queued datagram, up to RECV_BATCH reads. Called once poll found the socket readable,
+    # then poll is asked again before each read (cheaper than a read failing with BlockingIOError)
+    def _drain(self) -> None:
+        for i in range(RECV_BATCH):
+            if i > 0 and not self.poller.poll(0):
+                return
+            try:
+                if self.gro:
+                    n_bytes, ancdata, _, address = self.socket.recvmsg_into([self.buffer], socket.CMSG_SPACE(4))
+                else:
+                    n_bytes, address = self.socket.recvfrom_into(self.buffer)
+                    ancdata = ()
+            except (BlockingIOError, InterruptedError):
+                return
+
+            segment_size = n_bytes
+            for level, kind, data in ancdata:
+                if level == SOL_UDP and kind == UDP_GRO:
+                    segment_size = int.from_bytes(data, sys.byteorder) or n_bytes
+            for start in range(0, n_bytes, segment_size):
+                self.received.append((bytes(self.buffer_view[start:min(start + segment_size, n_bytes)]), address))
+
+    # Helper that sends a run of datagrams with GSO, returns False if the kernel refused it
+    def _send_gso(self, datagrams: list, address: tuple[str, int]) -> bool:
+        ancdata = [(SOL_UDP, UDP_SEGMENT, GSO_SIZE.pack(len(datagrams[0])))]
+        try:
+            self._wait_writable(lambda: self.socket.sendmsg(datagrams, ancdata, 0, address))
+        except OSError as exc:
+            if exc.errno not in GSO_ERRNOS:
+                raise
+            self.gso = False
+            return False
+        return True
+
+    def _sendto(self, datagram, address: tuple[str, int]) -> None:
+        self._wait_writable(lambda: self.socket.sendto(datagram, address))
+
+    # Helper that runs a send, waiting for room in the socket buffer while it is full
+    def _wait_writable(self, f_send) -> None:
+        while True:
+            try:
+                f_send()
+                return
+            except (BlockingIOError, InterruptedError):
+                select.select([], [self.socket], [])
+
+    # Helper that returns where the run of datagrams starting at start ends for a single GSO send:
+    # all of them the size of the first one, except a smaller last one
+    @staticmethod
+    def _gso_run(datagrams: list, start: int) -> int:
+        segment_size = len(datagrams[start])
+        total = segment_size
+        end = start + 1
+        while end < len(datagrams) and end - start < GSO_MAX_SEGMENTS:
+            size = len(datagrams[end])
+            if size > segment_size or total + size > GSO_MAX_BYTES:
+                break
+            total += size
+            end += 1
+            if size < segment_size:
+                break
+        return end
+
+    @staticmethod
+    def _offload_supported(udp_socket: socket.socket, option: int) -> bool:
+        try:
+            udp_socket.getsockopt(SOL_UDP, option)
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def _enable_gro(udp_socket: socket.socket) -> bool:
+        try:
+            udp_socket.setsockopt(SOL_UDP, UDP_GRO, 1)
+        except OSError:
+            return False
+        return True
+
+# Creates the datagram I/O of udp_socket: batched on Linux when asked for, one syscall per segment elsewhere
+def create_datagram_io(udp_socket: socket.socket, batched: bool = True) -> DatagramIO:
+    if batched and sys.platform.startswith('linux') and hasattr(select, 'poll'):
+        return BatchedDatagramIO(udp_socket)
+    return DatagramIO(udp_socket)
@@ -0,0 +1,423 @@
+"""
+Simplified TCP server that serves every connection from a single UDP socket.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import heapq
+import itertools
+import selectors
+import socket
+import time
+from collections import deque
+from typing import Callable
+
+from segment_tcp import SegmentTCP, HEADER_VERSION_BINARY
+from trace_tcp import TRACE_OFF, TRACE_EVENTS, TRACE_SEGMENTS
+from congestion_control import CONGESTION_RENO, DEFAULT_PACING_RATE
+from socket_tcp import (
+    SocketTCP, set_reuse_port, UDP_BUFFER_SIZE, MAX_HEADER_SIZE, DEFAULT_MSS, MODE_STOP_AND_WAIT, DEFAULT_WINDOW_SIZE,
+    DELAYED_ACK_SEGMENTS, DELAYED_ACK_TIMEOUT_SECONDS, DEFAULT_RECV_BUFFER_SIZE, MAX_RETRIES
+)
+
+# Connections allowed in the handshake or waiting for accept, further SYNs are dropped
+DEFAULT_BACKLOG = 128
+# Seconds an established connection may go without segments before it is reset and forgotten
+DEFAULT_IDLE_TIMEOUT_SECONDS = 60.0
+# Largest message a connection may send, each one is held whole until poll hands it over
+DEFAULT_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# Connection states
+STATE_SYN_RECEIVED = 'syn_received'
+STATE_ESTABLISHED = 'established'
+STATE_LAST_ACK = 'last_ack'
+STATE_CLOSED = 'closed'
+
+# Socket of a connection of a DemuxServerTCP, it shares the server's UDP socket.
+# The server runs its whole FIN exchange, so close and recv_close only mark it closed for the caller and
+# abort resets it through the server. The shared socket is never closed nor handed to the TimeWaitReaper
+class DemuxSocketTCP(SocketTCP):
+    def __init__(self, server: 'DemuxServerTCP'):
+        super().__init__(server.socket)
+        self._server = server
+
+    def close(self) -> None:
+        self.is_closed = True
+
+    def recv_close(self) -> None:
+        self.is_closed = True
+
+    def abort(self) -> None:
+        if self.is_closed:
+            return
+        self._server._reset_connection((self.destination_addr, self.destination_port))
+        self.is_closed = True
+
+    def _close_socket(self) -> None:
+        self.is_closed = True
+
+    # The server moves each message out of recv_buffer whole as it arrives, there is no reader to hold
+    # compressed input back for
+    def _decompress(self, data_bytes: bytes, limit: bool = True) -> bytes:
+        return super()._decompress(data_bytes, limit=False)
+
+# State machine of a single connection of a DemuxServerTCP.
+# sock is a DemuxSocketTCP, it keeps the seq, negotiated options and received data
+class DemuxConnection:
+    def __init__(self, sock: SocketTCP, syn_seq: int):
+        self.sock = sock
+        self.state = STATE_SYN_RECEIVED
+        # seq of the SYN that opened the connection, a SYN with another one is a new connection from the same address
+        self.syn_seq = syn_seq
+        # Established connections are forgotten once idle_deadline passes without segments from the client
+        self.idle_deadline = None
+        # Segment to resend when the timer expires (SYN+ACK or FIN+ACK), with its timer
+        self.pending_segment = None
+        self.deadline = None
+        self.retries = 0
+        self.sent_time = None
+        # Data of the message being received, moved out of the socket's recv_buffer to keep its window open.
+        # It grows up to the whole message, see DemuxServerTCP.max_message_size
+        self.message = bytearray()
+
+    def __str__(self):
+        return f'<DemuxConnection> [STATE:{self.state}, PEER:{self.sock.destination_addr}:{self.sock.destination_port}, SEQ:{self.sock.seq}]'
+
+    def __repr__(self):
+        return str(self)
+
+# Server that demultiplexes the segments of every client by their address, from one UDP socket.
+# A selectors loop reads the socket and runs the retransmission timers, each client only costs a
+# DemuxConnection: no file descriptor nor blocking thread per client.
+# Connections only receive: completed messages are returned by poll (or passed to serve_forever's callback)
+class DemuxServerTCP:
+    # Constructor
+    def __init__(self, backlog: int = DEFAULT_BACKLOG):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.origin_addr = None
+        self.origin_port = None
+        self.backlog = backlog
+
+        # Settings copied to each connection, as SocketTCP.accept does (see SocketTCP._copy_settings)
+        self.transfer_mode = MODE_STOP_AND_WAIT
+        self.window_size = DEFAULT_WINDOW_SIZE
+        self.congestion_control = CONGESTION_RENO
+        self.pacing_rate = DEFAULT_PACING_RATE
+        self.max_header_version = HEADER_VERSION_BINARY
+        self.mss = DEFAULT_MSS
+        self.recv_buffer_size = DEFAULT_RECV_BUFFER_SIZE
+        self.compression = None
+        self.delayed_ack_segments = DELAYED_ACK_SEGMENTS
+        self.delayed_ack_timeout = DELAYED_ACK_TIMEOUT_SECONDS
+        self.batched_io = True
+        # Bind with SO_REUSEPORT, so several servers (see ShardedServer) share the port
+        self.reuse_port = False
+        # Established connections idle for longer are reset, their client crashed or its FIN or RST was lost
+        self.idle_timeout = DEFAULT_IDLE_TIMEOUT_SECONDS
+        # Messages are moved out of recv_buffer as they arrive, so the window does not bound them.
+        # A connection whose message (by its BYTECOUNT, or its chunks so far) is longer is reset, None for no limit
+        self.max_message_size = DEFAULT_MAX_MESSAGE_SIZE
+
+        # Peer address -> DemuxConnection
+        self.connections = {}
+        self.half_open = 0
+        # Established connections not yet returned by accept
+        self.accept_queue = deque()
+        # (connection socket, message) completed and not yet returned by poll
+        self.messages = deque()
+        # (deadline, counter, connection), entries of connections whose deadline changed are skipped
+        self.timers = []
+        # (idle deadline, counter, connection) of established connections, checked against idle_deadline
+        # when they expire, as segments push it further without touching the heap
+        self.idle_timers = []
+        self._timer_counter = itertools.count()
+        # Connections that got data in the current batch, their delayed ACKs go out once it is drained
+        self._pending_acks = set()
+
+        # Tracing, see SocketTCP
+        self.debug_mode = False
+        self.trace_level = TRACE_OFF
+        self.capture = None
+
+    # Start listening on the address
+    def bind(self, address: tuple[str, int]) -> None:
+        self.origin_addr, self.origin_port = address
+        if self.reuse_port:
+            set_reuse_port(self.socket)
+        self.socket.bind(address)
+        self.selector.register(self.socket, selectors.EVENT_READ)
+
+    # Returns the next established connection from the backlog, running the loop until there is one
+    # Raises socket.timeout if none arrives within timeout seconds
+    def accept(self, timeout: 'float | None' = None) -> tuple[SocketTCP, tuple[str, int]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.accept_queue:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout('timed out')
+            self._run_once(remaining)
+
+        conn_socket = self.accept_queue.popleft()
+        return (conn_socket, (self.origin_addr, self.origin_port))
+
+    # Runs the loop once, waiting at most timeout seconds for segments
+    # Returns the messages completed since the last call, as (connection socket, message)
+    def poll(self, timeout: 'float | None' = None) -> list[tuple[SocketTCP, bytes]]:
+        if not self.messages:
+            self._run_once(timeout)
+
+        messages = list(self.messages)
+        self.messages.clear()
+        return messages
+
+    # Accepts every connection and calls on_message(connection socket, message) with each completed message
+    def serve_forever(self, on_message: Callable[[SocketTCP, bytes], None]) -> None:
+        while True:
+            messages = self.poll()
+            self.accept_queue.clear()
+            for conn_socket, message in messages:
+                on_message(conn_socket, message)
+
+    # Stops listening, connections still open are dropped
+    def close(self) -> None:
+        self.selector.close()
+        self.socket.close()
+        self.connections.clear()
+
+    # Helper that waits the socket or the next timer, then handles every queued segment and expired timer
+    def _run_once(self, timeout: 'float | None') -> None:
+        for timers in (self.timers, self.idle_timers):
+            if timers:
+                until_timer = max(timers[0][0] - time.monotonic(), 0)
+                timeout = until_timer if timeout is None else min(timeout, until_timer)
+
+        if self.selector.select(timeout):
+            buffer_size = max(UDP_BUFFER_SIZE, self.mss + MAX_HEADER_SIZE)
+            while True:
+                try:
+                    recv_message, recv_address = self.socket.recvfrom(buffer_size)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionError:
+                    # ICMP errors of previous sends, retransmissions take care of them
+                    continue
+                if self.capture is not None:
+                    self.capture.write(recv_message, recv_address, (self.origin_addr, self.origin_port))
+                try:
+                    recv_segment = SegmentTCP.parse_segment(recv_message)
+                except ValueError as e:
+                    self._log('@demux, dropping invalid datagram from %s: %s', recv_address, e)
+                    continue
+                # A segment the connection cannot make sense of (BYTECOUNT, compressed data) resets it,
+                # the other connections go on
+                try:
+                    self._handle_segment(recv_segment, recv_address)
+                except ValueError as e:
+                    self._log('@demux, invalid segment from %s, resetting its connection: %s', recv_address, e)
+                    self._reset_connection(recv_address)
+
+            # The socket is drained, no more segments are coming right now to share the ACK with
+            for conn_socket in self._pending_acks:
+                conn_socket._flush_ack()
+            self._pending_acks.clear()
+
+        self._run_timers()
+        self._run_idle_timers()
+
+    # Helper that dispatches a segment to the state machine of its connection
+    def _handle_segment(self, recv_segment: SegmentTCP, address: tuple[str, int]) -> None:
+        connection = self.connections.get(address)
+        if connection is None:
+            if recv_segment.syn and not recv_segment.ack and not recv_segment.rst:
+                self._open_connection(recv_segment, address)
+            return
+
+        conn_socket = connection.sock
+        conn_socket._log('[%s] @demux, recv from %s: %s', conn_socket.seq, address, recv_segment, level=TRACE_SEGMENTS)
+        conn_socket._stats.segments_received += 1
+        conn_socket._stats.bytes_received += len(recv_segment.msg)
+        if connection.idle_deadline is not None:
+            connection.idle_deadline = time.monotonic() + self.idle_timeout
+
+        # The client reused its address for a new connection, the old one is gone
+        if recv_segment.syn and not recv_segment.ack and not recv_segment.rst and recv_segment.seq != connection.syn_seq:
+            conn_socket._log('[%s] @demux, new SYN from %s, replacing its connection', conn_socket.seq, address)
+            self._pending_acks.discard(conn_socket)
+            self._close_connection(connection)
+            self._open_connection(recv_segment, address)
+            return
+
+        # The client aborted the connection, whatever its state
+        if recv_segment.rst:
+            conn_socket._log('[%s] @demux, RST from %s, connection reset', conn_socket.seq, address)
+            self._pending_acks.discard(conn_socket)
+            self._close_connection(connection)
+            return
+
+        if connection.state == STATE_SYN_RECEIVED:
+            if recv_segment.ack and recv_segment.seq == conn_socket.seq + 1:
+                conn_socket.seq = recv_segment.seq
+                conn_socket._sample_rtt(connection.sent_time)
+                self._stop_timer(connection)
+                self.half_open -= 1
+                connection.state = STATE_ESTABLISHED
+                self._start_idle_timer(connection)
+                self.accept_queue.append(conn_socket)
+                conn_socket._log('[%s] @demux, handshake completed with %s', conn_socket.seq, address)
+            elif not recv_segment.ack and not recv_segment.fin and recv_segment.seq == conn_socket.seq + 2:
+                # The handshake ACK was lost but the client already sent its first BYTECOUNT
+                conn_socket._log('[%s] @demux, BYTECOUNT from %s completes the handshake', conn_socket.seq, address)
+                self._handle_segment(SegmentTCP(False, True, False, recv_segment.seq - 1, b''), address)
+                self._handle_segment(recv_segment, address)
+            elif recv_segment.syn:
+                # The client did not get the SYN+ACK yet
+                conn_socket._log('[%s] @demux, duplicate SYN from %s, resending SYN+ACK', conn_socket.seq, address)
+                conn_socket._resend_segment(connection.pending_segment)
+
+        elif connection.state == STATE_ESTABLISHED:
+            if recv_segment.syn and not recv_segment.rst:
+                # Duplicate of the SYN that opened the connection, its SYN+ACK was answered already
+                return
+            if recv_segment.fin:
+                # The FIN+ACK covers any delayed ACK
+                self._pending_acks.discard(conn_socket)
+                conn_socket.seq = recv_segment.seq
+                fin_ack_segment = SegmentTCP(False, True, True, conn_socket.seq, b'')
+                conn_socket._log('[%s] @demux, FIN from %s, send FIN+ACK', conn_socket.seq, address)
+                conn_socket._send_segment(fin_ack_segment)
+                connection.state = STATE_LAST_ACK
+                connection.idle_deadline = None
+                self._start_timer(connection, fin_ack_segment)
+            else:
+                message_completed = conn_socket._handle_data_segment(recv_segment)
+                if self.max_message_size is not None and conn_socket._message_length > self.max_message_size:
+                    raise ValueError(f'Message of {conn_socket._message_length} bytes, '
+                                     f'the limit is {self.max_message_size}')
+                connection.message += conn_socket.recv_buffer.read(len(conn_socket.recv_buffer))
+                if message_completed:
+                    self.messages.append((conn_socket, bytes(connection.message)))
+                    connection.message.clear()
+                if conn_socket._ack_deadline is not None:
+                    self._pending_acks.add(conn_socket)
+
+        elif connection.state == STATE_LAST_ACK:
+            if recv_segment.ack and recv_segment.seq == conn_socket.seq:
+                conn_socket._sample_rtt(connection.sent_time)
+                self._close_connection(connection)
+            elif recv_segment.fin:
+                conn_socket._resend_segment(connection.pending_segment)
+
+    # Helper that answers the SYN of a new client with SYN+ACK, unless the backlog is full
+    def _open_connection(self, syn_segment: SegmentTCP, address: tuple[str, int]) -> None:
+        if self.half_open + len(self.accept_queue) >= self.backlog:
+            self._log('@demux, backlog full, dropping SYN from %s', address)
+            return
+
+        conn_socket = DemuxSocketTCP(self)
+        conn_socket.destination_addr, conn_socket.destination_port = address
+        conn_socket.origin_addr, conn_socket.origin_port = self.origin_addr, self.origin_port
+        conn_socket._copy_settings(self)
+        # Messages are handed whole to poll, the copy in current_message is not needed
+        conn_socket.keep_current_message = False
+        # Fast open data is not accepted here, only the options before it are read
+        conn_socket._negotiate(SegmentTCP.parse_options(SegmentTCP.split_fast_open(syn_segment.msg)[0]))
+        conn_socket.seq = syn_segment.seq + 1
+
+        connection = DemuxConnection(conn_socket, syn_segment.seq)
+        self.connections[address] = connection
+        self.half_open += 1
+
+        synack_options = conn_socket._handshake_options(conn_socket.header_version)
+        synack_segment = SegmentTCP(True, True, False, conn_socket.seq, synack_options)
+        conn_socket._log('[%s] @demux, SYN from %s, send SYN+ACK', conn_socket.seq, address)
+        conn_socket._send_segment(synack_segment)
+        self._start_timer(connection, synack_segment)
+
+    # Helper that forgets a connection once its FIN exchange ended (or its peer is gone)
+    def _close_connection(self, connection: DemuxConnection) -> None:
+        conn_socket = connection.sock
+        if connection.state == STATE_SYN_RECEIVED:
+            self.half_open -= 1
+
+        self._stop_timer(connection)
+        connection.idle_deadline = None
+        connection.state = STATE_CLOSED
+        conn_socket.is_closed = True
+        self.connections.pop((conn_socket.destination_addr, conn_socket.destination_port), None)
+        conn_socket._log('[%s] @demux, connection closed', conn_socket.seq)
+
+    # Helper that sends an RST to the client at address and forgets its connection, if it has one
+    def _reset_connection(self, address: tuple[str, int]) -> None:
+        connection = self.connections.get(address)
+        if connection is None:
+            return
+
+        conn_socket = connection.sock
+        self._pending_acks.discard(conn_socket)
+        if conn_socket.seq is not None:
+            conn_socket._log('[%s] @demux, send RST to %s', conn_socket.seq, address)
+            conn_socket._send_segment(SegmentTCP(True, False, True, conn_socket.seq, b''))
+        self._close_connection(connection)
+
+    # Helper that starts the retransmission timer of a connection for a segment just sent
+    def _start_timer(self, connection: DemuxConnection, tcp_segment: SegmentTCP) -> None:
+        connection.pending_segment = tcp_segment
+        connection.retries = 1
+        connection.sent_time = time.monotonic()
+        connection.deadline = connection.sent_time + connection.sock.rto
+        heapq.heappush(self.timers, (connection.deadline, next(self._timer_counter), connection))
+
+    # Helper that cancels the timer of a connection, its heap entry is skipped when it expires
+    def _stop_timer(self, connection: DemuxConnection) -> None:
+        connection.pending_segment = None
+        connection.deadline = None
+
+    # Helper that resends the pending segment of every connection whose timer expired
+    def _run_timers(self) -> None:
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, _, connection = heapq.heappop(self.timers)
+            if connection.deadline != deadline:
+                continue
+
+            conn_socket = connection.sock
+            if connection.retries >= MAX_RETRIES:
+                conn_socket._log('[%s] @demux, %s timeouts in %s, assume connection closed', conn_socket.seq, MAX_RETRIES, connection.state)
+                self._close_connection(connection)
+                continue
+
+            connection.retries += 1
+            connection.sent_time = None
+            conn_socket.rtt.backoff()
+            conn_socket._log('[%s] @demux, timeout in %s, resending %s', conn_socket.seq, connection.state, connection.pending_segment)
+            conn_socket._resend_segment(connection.pending_segment)
+            connection.deadline = now + conn_socket.rto
+            heapq.heappush(self.timers, (connection.deadline, next(self._timer_counter), connection))
+
+    # Helper that starts the idle timer of a connection that just got established
+    def _start_idle_timer(self, connection: DemuxConnection) -> None:
+        connection.idle_deadline = time.monotonic() + self.idle_timeout
+        heapq.heappush(self.idle_timers, (connection.idle_deadline, next(self._timer_counter), connection))
+
+    # Helper that resets the established connections whose idle deadline passed.
+    # Entries of connections that got segments since are pushed again with their new deadline
+    def _run_idle_timers(self) -> None:
+        now = time.monotonic()
+        while self.idle_timers and self.idle_timers[0][0] <= now:
+            _, _, connection = heapq.heappop(self.idle_timers)
+            if connection.idle_deadline is None:
+                continue
+            if connection.idle_deadline > now:
+                heapq.heappush(self.idle_timers, (connection.idle_deadline, next(self._timer_counter), connection))
+                continue
+
+            conn_socket = connection.sock
+            conn_socket._log('[%s] @demux, idle for %s s, resetting connection', conn_socket.seq, self.idle_timeout)
+            self._reset_connection((conn_socket.destination_addr, conn_socket.destination_port))
+
+    # Helper debugging function, see SocketTCP._log
+    def _log(self, message: str, *args, level: int = TRACE_EVENTS) -> None:
+        if self.debug_mode or self.trace_level >= level:
+            print(message % args if args else message)
@@ -0,0 +1,73 @@
+"""
+Fast open for the Simplified TCP: cookies of the listening sockets and the cookie cache of the clients.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import hashlib
+import hmac
+import os
+import threading
+
+# Cookie bytes, sent in hex as the tfo option of the SYN+ACK
+FAST_OPEN_COOKIE_SIZE = 8
+FAST_OPEN_KEY_SIZE = 16
+
+# Cookies of a listening socket: a MAC of the client's IP with a key of the socket, so only clients that
+# completed a handshake with it before know theirs. A new socket (or a restarted server) has a new key,
+# the cookies it gave before are then refused and replaced
+class FastOpenCookies:
+    def __init__(self):
+        self.key = os.urandom(FAST_OPEN_KEY_SIZE)
+
+    def __str__(self):
+        return '<FastOpenCookies>'
+
+    def __repr__(self):
+        return str(self)
+
+    # Cookie of the client at address
+    def cookie(self, address: tuple[str, int]) -> str:
+        return hmac.new(self.key, address[0].encode(), hashlib.sha256).digest()[:FAST_OPEN_COOKIE_SIZE].hex()
+
+    # Whether cookie is the one of the client at address. Compared as bytes, the SYN may carry any text
+    # (compare_digest refuses strings with non-ASCII characters)
+    def is_valid(self, cookie: str, address: tuple[str, int]) -> bool:
+        return hmac.compare_digest(cookie.encode('utf-8', 'replace'), self.cookie(address).encode())
+
+# Cookies received by the clients of the process, per server address, with the MSS negotiated with it
+# (the SYN is sent before the MSS is known, its data must fit the one of the previous connection)
+class FastOpenCache:
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f'<FastOpenCache> [SERVERS:{len(self.entries)}]'
+
+    def __repr__(self):
+        return str(self)
+
+    # (cookie, mss) of the server at address, None if it never gave one
+    def get(self, address: tuple[str, int]) -> 'tuple[str, int] | None':
+        with self.lock:
+            return self.entries.get(address)
+
+    def put(self, address: tuple[str, int], cookie: str, mss: int) -> None:
+        with self.lock:
+            self.entries[address] = (cookie, mss)
+
+    # Forgets the cookie of a server that no longer gives one
+    def discard(self, address: tuple[str, int]) -> None:
+        with self.lock:
+            self.entries.pop(address, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+_cache = FastOpenCache()
+
+# Returns the cookie cache shared by every socket of the process
+def fast_open_cache() -> FastOpenCache:
+    return _cache
@@ -0,0 +1,250 @@
+"""
+UDP link emulator for the Simplified TCP: a proxy that drops, duplicates, reorders, delays and rate limits segments.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import argparse
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+
+from segment_tcp import SegmentTCP
+
+UDP_BUFFER_SIZE = 65535
+
+# Directions of the link
+CLIENT_TO_SERVER = 'client_to_server'
+SERVER_TO_CLIENT = 'server_to_client'
+
+# Impairments applied to each direction of the link
+# loss, duplicate, reorder: probability for each datagram
+# delay, jitter, reorder_delay: seconds. Jitter is uniform in [-jitter, jitter] but keeps the datagrams in order,
+# only the reordered ones wait reorder_delay more and are overtaken
+# bandwidth: bytes per second, None for an unlimited link
+# queue_limit: bytes waiting for a bandwidth limited link, datagrams that do not fit are dropped (None for no limit)
+class LinkProfile:
+    def __init__(self, loss: float = 0.0, duplicate: float = 0.0, reorder: float = 0.0,
+                 delay: float = 0.0, jitter: float = 0.0, reorder_delay: float = 0.01,
+                 bandwidth: 'float | None' = None, queue_limit: 'int | None' = None):
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder_delay = reorder_delay
+        self.bandwidth = bandwidth
+        self.queue_limit = queue_limit
+
+    def __str__(self):
+        return (f'<LinkProfile> [LOSS:{self.loss}, DUPLICATE:{self.duplicate}, REORDER:{self.reorder}, '
+                f'DELAY:{self.delay}, JITTER:{self.jitter}, BANDWIDTH:{self.bandwidth}, QUEUE:{self.queue_limit}]')
+
+    def __repr__(self):
+        return str(self)
+
+    # Settings as a dict, used in benchmark reports
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+# Profiles used by the benchmark, can also be picked from the command line
+PROFILES = {
+    'clean': LinkProfile(),
+    'lossy': LinkProfile(loss=0.05),
+    'delayed': LinkProfile(delay=0.02, jitter=0.005),
+    'reordering': LinkProfile(reorder=0.02, reorder_delay=0.005),
+    'constrained': LinkProfile(delay=0.01, bandwidth=1_000_000),
+    # A shared bottleneck with a small drop-tail queue, meant for several flows at once
+    'bottleneck': LinkProfile(delay=0.01, bandwidth=1_000_000, queue_limit=20_000),
+    'hostile': LinkProfile(loss=0.05, duplicate=0.02, reorder=0.02, delay=0.01, jitter=0.005),
+}
+
+# Proxy between clients and a server, forwarding every datagram through an impaired link.
+# Each client gets its own socket towards the server, so the server sees one address per client.
+# As SocketTCP.accept answers from a new port, the proxy forwards to the last server address it heard from.
+# All randomness comes from seed, runs with the same seed and traffic take the same decisions
+class LinkEmulator:
+    # Constructor
+    def __init__(self, listen_address: tuple[str, int], server_address: tuple[str, int],
+                 profile: 'LinkProfile | None' = None, seed: 'int | None' = None):
+        self.server_address = server_address
+        self.profile = profile if profile is not None else LinkProfile()
+        self.random = random.Random(seed)
+
+        self.selector = selectors.DefaultSelector()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind(listen_address)
+        self.listen_address = self.socket.getsockname()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+
+        # Client address -> [upstream socket, server address to forward to]
+        self.clients = {}
+        # (departure time, counter, socket, datagram, destination)
+        self.scheduled = []
+        self._counter = itertools.count()
+        # Time when each direction of the link is free again, for the bandwidth limit
+        self.link_free_at = {CLIENT_TO_SERVER: 0.0, SERVER_TO_CLIENT: 0.0}
+        # Departure of the last datagram of each direction, jitter never moves a datagram before it
+        self.last_departure = {CLIENT_TO_SERVER: 0.0, SERVER_TO_CLIENT: 0.0}
+        # Data seqs seen from each client, to count retransmissions
+        self._seen_seqs = {}
+
+        self.stats = {direction: {'datagrams': 0, 'bytes': 0, 'dropped': 0, 'overflowed': 0, 'duplicated': 0,
+                                  'reordered': 0}
+                      for direction in (CLIENT_TO_SERVER, SERVER_TO_CLIENT)}
+        self.stats['retransmissions'] = 0
+
+        self._running = False
+        self._thread = None
+
+    # Runs the proxy in a background thread
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    # Stops the proxy and closes its sockets
+    def stop(self) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        for upstream_socket, _ in self.clients.values():
+            upstream_socket.close()
+        self.selector.close()
+        self.socket.close()
+
+    # Forwards datagrams until stop is called
+    def serve_forever(self) -> None:
+        self._running = True
+        while self._running:
+            timeout = 0.1
+            if self.scheduled:
+                timeout = min(timeout, max(self.scheduled[0][0] - time.monotonic(), 0))
+
+            for key, _ in self.selector.select(timeout):
+                self._read(key.fileobj, key.data)
+            self._flush()
+
+    # Helper that reads every datagram queued in a socket
+    # client_address is None for the listening socket, otherwise the client of the upstream socket
+    def _read(self, sock: socket.socket, client_address: 'tuple[str, int] | None') -> None:
+        while True:
+            try:
+                datagram, address = sock.recvfrom(UDP_BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionError:
+                continue
+
+            if client_address is None:
+                client = self.clients.get(address)
+                if client is None:
+                    upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    upstream_socket.setblocking(False)
+                    self.selector.register(upstream_socket, selectors.EVENT_READ, address)
+                    client = self.clients[address] = [upstream_socket, self.server_address]
+                self._count_retransmission(address, datagram)
+                self._impair(CLIENT_TO_SERVER, client[0], datagram, client[1])
+            else:
+                self.clients[client_address][1] = address
+                self._impair(SERVER_TO_CLIENT, self.socket, datagram, client_address)
+
+    # Helper that decides the fate of a datagram and schedules its copies
+    def _impair(self, direction: str, sock: socket.socket, datagram: bytes, destination: tuple[str, int]) -> None:
+        stats = self.stats[direction]
+        stats['datagrams'] += 1
+        stats['bytes'] += len(datagram)
+
+        if self.random.random() < self.profile.loss:
+            stats['dropped'] += 1
+            return
+
+        copies = 1
+        if self.random.random() < self.profile.duplicate:
+            stats['duplicated'] += 1
+            copies = 2
+
+        now = time.monotonic()
+        for _ in range(copies):
+            departure = now
+            if self.profile.bandwidth and self.profile.queue_limit is not None:
+                queued_bytes = (self.link_free_at[direction] - now) * self.profile.bandwidth
+                if queued_bytes + len(datagram) > self.profile.queue_limit:
+                    stats['overflowed'] += 1
+                    continue
+
+            if self.profile.bandwidth:
+                departure = max(now, self.link_free_at[direction]) + len(datagram) / self.profile.bandwidth
+                self.link_free_at[direction] = departure
+
+            departure += max(self.profile.delay + self.random.uniform(-self.profile.jitter, self.profile.jitter), 0)
+            departure = max(departure, self.last_departure[direction])
+            self.last_departure[direction] = departure
+            if self.random.random() < self.profile.reorder:
+                stats['reordered'] += 1
+                departure += self.profile.reorder_delay
+
+            heapq.heappush(self.scheduled, (departure, next(self._counter), sock, datagram, destination))
+
+    # Helper that sends every datagram whose departure time arrived
+    def _flush(self) -> None:
+        now = time.monotonic()
+        while self.scheduled and self.scheduled[0][0] <= now:
+            _, _, sock, datagram, destination = heapq.heappop(self.scheduled)
+            try:
+                sock.sendto(datagram, destination)
+            except OSError:
+                # Closed peers, the datagram is lost as in a real link
+                pass
+
+    # Helper that counts data segments whose seq the client already sent, before any impairment
+    def _count_retransmission(self, client_address: tuple[str, int], datagram: bytes) -> None:
+        try:
+            segment = SegmentTCP.parse_segment(datagram)
+        except ValueError:
+            # Not a segment, forwarded as it is
+            return
+        if segment.syn or segment.ack or segment.fin or not segment.msg:
+            return
+
+        seen_seqs = self._seen_seqs.setdefault(client_address, set())
+        if segment.seq in seen_seqs:
+            self.stats['retransmissions'] += 1
+        else:
+            seen_seqs.add(segment.seq)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='UDP link emulator between client.py and server.py')
+    parser.add_argument('--listen', type=int, default=8001, help='Port where clients connect')
+    parser.add_argument('--server', default='localhost:8000', help='Server address, host:port')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='clean', help='Base impairment profile')
+    parser.add_argument('--loss', type=float, help='Loss probability')
+    parser.add_argument('--duplicate', type=float, help='Duplication probability')
+    parser.add_argument('--reorder', type=float, help='Reordering probability')
+    parser.add_argument('--delay', type=float, help='One-way delay in seconds')
+    parser.add_argument('--jitter', type=float, help='Jitter in seconds')
+    parser.add_argument('--bandwidth', type=float, help='Bandwidth in bytes per second')
+    parser.add_argument('--queue-limit', type=int, help='Bytes queued before the bandwidth limit, the rest is dropped')
+    parser.add_argument('--seed', type=int, help='Seed for reproducible runs')
+    args = parser.parse_args()
+
+    profile = LinkProfile(**PROFILES[args.profile].to_dict())
+    for option in ('loss', 'duplicate', 'reorder', 'delay', 'jitter', 'bandwidth', 'queue_limit'):
+        if getattr(args, option) is not None:
+            setattr(profile, option, getattr(args, option))
+
+    server_host, server_port = args.server.rsplit(':', 1)
+    emulator = LinkEmulator(('localhost', args.listen), (server_host, int(server_port)), profile, args.seed)
+    print(f'Forwarding localhost:{args.listen} -> {args.server} with {profile}')
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        print(emulator.stats)
@@ -0,0 +1,82 @@
+"""
+Load generator for Simplified TCP servers: many clients opening short connections in parallel.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import os
+import statistics
+import time
+from typing import Callable
+
+from socket_tcp import SocketTCP
+from workers import start_worker, results_queue
+
+# Clients by default, one per core
+DEFAULT_CLIENTS = os.cpu_count() or 1
+
+# Runs clients workers (processes, or threads with processes=False) that together open connections connections
+# to the server at address, one after the other within each client: connect, send message, close.
+# configure is called with each socket before it connects (transfer mode, window, compression...).
+# Returns the report of the run: connections that completed and failed, seconds, connections per second,
+# goodput (message bytes per second), the mean, median and 99th percentile of the connection times
+# (handshake, message and FIN exchange) and 'clients', the counters of each client
+def run_load(address: tuple[str, int], message: bytes, connections: int, clients: int = DEFAULT_CLIENTS,
+             configure: 'Callable[[SocketTCP], None] | None' = None, processes: bool = True) -> dict:
+    if clients < 1 or connections < 1:
+        raise ValueError(f'clients and connections must be at least 1, got {clients} and {connections}')
+
+    clients = min(clients, connections)
+    per_client, remainder = divmod(connections, clients)
+    results = results_queue(processes)
+    start = time.monotonic()
+    workers = [
+        start_worker(processes, _run_client, (
+            address, message, per_client + (1 if client < remainder else 0), configure, client, results
+        ))
+        for client in range(clients)
+    ]
+    client_results = [results.get() for _ in workers]
+    seconds = time.monotonic() - start
+    for worker in workers:
+        worker.join()
+
+    client_results.sort(key=lambda result: result['client'])
+    times = sorted(connection_time for result in client_results for connection_time in result.pop('times'))
+    completed = len(times)
+    return {
+        'connections': completed,
+        'failed': sum(result['failed'] for result in client_results),
+        'bytes': completed * len(message),
+        'seconds': round(seconds, 6),
+        'connections_per_second': round(completed / seconds, 1) if seconds > 0 else None,
+        'goodput_bytes_per_second': round(completed * len(message) / seconds, 1) if seconds > 0 else None,
+        'connection_seconds_mean': round(statistics.fmean(times), 6) if times else None,
+        'connection_seconds_p50': round(times[len(times) // 2], 6) if times else None,
+        'connection_seconds_p99': round(times[min(len(times) * 99 // 100, len(times) - 1)], 6) if times else None,
+        'clients': client_results,
+    }
+
+# Helper worker of run_load: opens its connections one after the other, timing each one
+def _run_client(address: tuple[str, int], message: bytes, connections: int,
+                configure: 'Callable[[SocketTCP], None] | None', client: int, results) -> None:
+    times = []
+    failed = 0
+    errors = {}
+    for _ in range(connections):
+        tcp_socket = SocketTCP()
+        try:
+            if configure is not None:
+                configure(tcp_socket)
+            start = time.monotonic()
+            tcp_socket.connect(address)
+            tcp_socket.send(message)
+            tcp_socket.close()
+            times.append(time.monotonic() - start)
+        except Exception as e:
+            tcp_socket.abort()
+            failed += 1
+            errors[repr(e)] = errors.get(repr(e), 0) + 1
+
+    results.put({'client': client, 'pid': os.getpid(), 'connections': len(times), 'failed': failed,
+                 'errors': errors, 'times': times})
@@ -0,0 +1,160 @@
+"""
+Micro-benchmarks of the per-segment paths of the Simplified TCP, compared against a saved baseline.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from typing import Callable
+
+from segment_tcp import SegmentTCP, HEADER_VERSION_TEXT, HEADER_VERSION_BINARY
+from socket_tcp import SocketTCP, MODE_STOP_AND_WAIT, MODE_GO_BACK_N, MODE_SELECTIVE_REPEAT
+
+PAYLOAD_SIZES = [0, 16, 1400, 8192]
+HEADER_VERSIONS = {'text': HEADER_VERSION_TEXT, 'binary': HEADER_VERSION_BINARY}
+LOOPBACK_MODES = [MODE_STOP_AND_WAIT, MODE_GO_BACK_N, MODE_SELECTIVE_REPEAT]
+# Data segments of each loopback message. Only stop and wait waits an ACK per segment, the windowed modes
+# keep several in flight, so the rate is of segments delivered and not of round trips
+LOOPBACK_SEGMENTS = 500
+LOOPBACK_MSS = 1400
+
+DEFAULT_BASELINE = 'microbenchmark_baseline.json'
+# Allowed slowdown against the baseline, as a fraction of its rate
+DEFAULT_THRESHOLD = 0.25
+# Loopback transfers depend on threads and the kernel's scheduling, they get a looser one
+DEFAULT_LOOPBACK_THRESHOLD = 0.5
+# Each benchmark runs for about MIN_SECONDS per repeat, the median repeat is kept
+MIN_SECONDS = 0.2
+REPEATS = 5
+
+# Measures how many times per second f can run, f does `number` operations per call
+def measure(f: Callable[[], None], number: int = 1) -> float:
+    # Calibrate the calls per repeat
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            f()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_SECONDS / 10:
+            break
+        calls *= 10
+    calls = max(int(calls * MIN_SECONDS / elapsed), 1)
+
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for _ in range(calls):
+            f()
+        times.append(time.perf_counter() - start)
+
+    return calls * number / statistics.median(times)
+
+# Segments per second parsed and serialized, for each header version and payload size
+def segment_benchmarks() -> dict[str, Callable[[], float]]:
+    benchmarks = {}
+    for version_name, version in HEADER_VERSIONS.items():
+        for size in PAYLOAD_SIZES:
+            segment = SegmentTCP(False, False, False, 123456789, b'x' * size)
+            encoded = SegmentTCP.create_segment(segment, version)
+            benchmarks[f'parse_{version_name}_{size}'] = (
+                lambda encoded=encoded: measure(lambda: SegmentTCP.parse_segment(encoded)))
+            benchmarks[f'create_{version_name}_{size}'] = (
+                lambda segment=segment, version=version: measure(lambda: SegmentTCP.create_segment(segment, version)))
+    return benchmarks
+
+# Data segments per second that a single loopback connection delivers through send and recv, every send
+# returns once its segments are acknowledged
+def loopback_segments(mode: str) -> float:
+    server_socket = SocketTCP()
+    server_socket.transfer_mode = mode
+    server_socket.mss = LOOPBACK_MSS
+    server_socket.bind(('127.0.0.1', 0))
+    message = b'x' * (LOOPBACK_SEGMENTS * LOOPBACK_MSS)
+
+    def receive() -> None:
+        conn_socket, _ = server_socket.accept()
+        conn_socket.keep_current_message = False
+        buffer = bytearray(len(message))
+        # An empty message ends the benchmark
+        while True:
+            conn_socket.recv_into(buffer)
+            if conn_socket.message_received() and conn_socket.expected_total_bytes == 0:
+                break
+        conn_socket.recv_close()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+
+    client_socket = SocketTCP()
+    client_socket.transfer_mode = mode
+    client_socket.mss = LOOPBACK_MSS
+    client_socket.connect(server_socket.socket.getsockname())
+    rate = measure(lambda: client_socket.send(message), LOOPBACK_SEGMENTS + 1)
+    client_socket.send(b'')
+    client_socket.close()
+    receiver.join()
+    server_socket.socket.close()
+    return rate
+
+def loopback_benchmarks() -> dict[str, Callable[[], float]]:
+    return {f'loopback_{mode}': (lambda mode=mode: loopback_segments(mode)) for mode in LOOPBACK_MODES}
+
+# Compares the rates against the baseline, returns the names slower than their threshold allows:
+# loopback_threshold for the loopback transfers, threshold for the rest
+def compare(rates: dict[str, float], baseline: dict[str, float], threshold: float,
+            loopback_threshold: float) -> list[str]:
+    slower = []
+    for name, rate in rates.items():
+        if name not in baseline:
+            print(f'{name:32} {rate:>14,.0f}/s  (no baseline)')
+            continue
+
+        change = rate / baseline[name] - 1
+        flag = ''
+        if change < -(loopback_threshold if name.startswith('loopback_') else threshold):
+            slower.append(name)
+            flag = '  SLOWER'
+        print(f'{name:32} {rate:>14,.0f}/s  baseline {baseline[name]:>14,.0f}/s  {change:+7.1%}{flag}')
+
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of segment parsing/serialization and loopback transfers')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline file')
+    parser.add_argument('--save', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Fail when a segment benchmark is this fraction slower than the baseline')
+    parser.add_argument('--loopback-threshold', type=float, default=DEFAULT_LOOPBACK_THRESHOLD,
+                        help='Fail when a loopback transfer benchmark is this fraction slower than the baseline')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    # Without a baseline there is nothing to gate on, a missing file must not pass silently
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    elif not args.save:
+        print(f'No baseline at {args.baseline}, run with --save first to create it')
+        sys.exit(2)
+
+    benchmarks = {**segment_benchmarks(), **loopback_benchmarks()}
+    rates = {name: run() for name, run in benchmarks.items() if args.filter in name}
+
+    slower = compare(rates, baseline, args.threshold, args.loopback_threshold)
+
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump({**baseline, **rates}, file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+    elif slower:
+        print(f'{len(slower)} benchmarks are slower than the baseline allows: {", ".join(slower)}')
+        sys.exit(1)
@@ -0,0 +1,85 @@
+"""
+Byte ring buffer used as the receive buffer of the Simplified TCP socket.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+DEFAULT_RING_CAPACITY = 64 * 1024
+
+# FIFO of bytes over a preallocated bytearray.
+# Writes and reads copy through memoryviews, so appending and consuming are linear in the
+# bytes moved. The storage only grows (doubling) when a write does not fit.
+class RingBuffer:
+    def __init__(self, capacity: int = DEFAULT_RING_CAPACITY):
+        self._storage = bytearray(max(capacity, 1))
+        self._view = memoryview(self._storage)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self):
+        return f'<RingBuffer> [SIZE:{self._size}, CAPACITY:{len(self._storage)}]'
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def capacity(self) -> int:
+        return len(self._storage)
+
+    # Free space before the storage has to grow
+    @property
+    def free(self) -> int:
+        return len(self._storage) - self._size
+
+    # Appends data at the end of the buffer
+    def write(self, data: 'bytes | memoryview') -> None:
+        data_length = len(data)
+        if data_length > self.free:
+            self._grow(self._size + data_length)
+
+        capacity = len(self._storage)
+        tail = (self._head + self._size) % capacity
+        first_part = min(data_length, capacity - tail)
+        self._view[tail:tail + first_part] = data[:first_part]
+        if first_part < data_length:
+            self._view[:data_length - first_part] = data[first_part:]
+        self._size += data_length
+
+    # Moves up to len(buffer) bytes from the start of the ring into buffer, returns how many were moved
+    def read_into(self, buffer: memoryview) -> int:
+        n_bytes = min(len(buffer), self._size)
+        capacity = len(self._storage)
+        first_part = min(n_bytes, capacity - self._head)
+        buffer[:first_part] = self._view[self._head:self._head + first_part]
+        if first_part < n_bytes:
+            buffer[first_part:n_bytes] = self._view[:n_bytes - first_part]
+
+        self._head = (self._head + n_bytes) % capacity
+        self._size -= n_bytes
+        if self._size == 0:
+            self._head = 0
+        return n_bytes
+
+    # Removes and returns up to n_bytes from the start of the ring
+    def read(self, n_bytes: int) -> bytes:
+        data = bytearray(min(n_bytes, self._size))
+        self.read_into(memoryview(data))
+        return bytes(data)
+
+    # Reallocates the storage with room for at least min_capacity bytes, keeping the data in order
+    def _grow(self, min_capacity: int) -> None:
+        capacity = len(self._storage)
+        while capacity < min_capacity:
+            capacity *= 2
+
+        storage = bytearray(capacity)
+        size = self._size
+        self.read_into(memoryview(storage))
+        self._view.release()
+        self._storage = storage
+        self._view = memoryview(storage)
+        self._head = 0
+        self._size = size
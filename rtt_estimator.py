@@ -0,0 +1,48 @@
+"""
+Retransmission timeout estimation for the Simplified TCP (Jacobson/Karels).
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+# Estimator constants (RFC 6298)
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTO_K = 4
+
+INITIAL_RTO_SECONDS = 1.5
+MIN_RTO_SECONDS = 0.05
+MAX_RTO_SECONDS = 30.0
+
+# Keeps the smoothed RTT and its variance for one connection and derives the RTO from them.
+# Only segments sent once may be sampled (Karn's rule), callers are responsible for that.
+class RTTEstimator:
+    def __init__(self, initial_rto: float = INITIAL_RTO_SECONDS,
+                 min_rto: float = MIN_RTO_SECONDS, max_rto: float = MAX_RTO_SECONDS):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = initial_rto
+
+    def __str__(self):
+        return f'<RTTEstimator> [SRTT:{self.srtt}, RTTVAR:{self.rttvar}, RTO:{self.rto}]'
+
+    def __repr__(self):
+        return str(self)
+
+    # Updates the estimation with a new RTT measurement, in seconds
+    # A valid sample also undoes any previous backoff
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+
+        rto = self.srtt + max(self.min_rto, RTO_K * self.rttvar)
+        self.rto = min(max(rto, self.min_rto), self.max_rto)
+
+    # Doubles the RTO after a timeout, up to max_rto
+    def backoff(self) -> None:
+        self.rto = min(self.rto * 2, self.max_rto)
@@ -5,35 +5,42 @@ Author: Augusto Aguayo Barham
 """
 
 
-import re
-import sys
-
-HEADER_SEPATOR_UNIT = '|'
-HEADER_SEPARATOR = f'{HEADER_SEPATOR_UNIT*3}'
-HEADER_REGEX = re.compile(
-    rf'^([01]){re.escape(HEADER_SEPARATOR)}([01]){re.escape(HEADER_SEPARATOR)}([01]){re.escape(HEADER_SEPARATOR)}(\d+){re.escape(HEADER_SEPARATOR)}(.*)$',
-    re.DOTALL
-)
-
-VALID_BOOLS_STR = ['0', '1']
+import struct
+
+# Header versions, negotiated during the handshake
+# Version 1: text header, [SYN]|||[ACK]|||[FIN]|||[SEQ]|||[DATA]
+# Version 2: binary header, [VERSION:1][FLAGS:1][SEQ:8][DATA]
+HEADER_VERSION_TEXT = 1
+HEADER_VERSION_BINARY = 2
+
+HEADER_SEPATOR_UNIT = b'|'
+HEADER_SEPARATOR = HEADER_SEPATOR_UNIT * 3
+VALID_BOOLS = (b'0', b'1')
+
+BINARY_HEADER = struct.Struct('!BBQ')
+FLAG_SYN = 0x01
+FLAG_ACK = 0x02
+FLAG_FIN = 0x04
+# RST (abortive close) is SYN and FIN together, a combination no other segment uses.
+# The text header has no room for a fourth flag, so both versions encode it the same way
+# (syn, ack, fin) for every value of the flags byte, avoids bit tests on each parse
+FLAGS_TABLE = tuple((bool(f & FLAG_SYN), bool(f & FLAG_ACK), bool(f & FLAG_FIN)) for f in range(256))
+
+# Handshake options, sent as data of the SYN and SYN+ACK segments: key=value;key=value
+OPTIONS_SEPARATOR = b';'
+OPTIONS_ASSIGN = b'='
+# A fast open SYN carries the first data after its options, options are text so they never contain it
+FAST_OPEN_SEPARATOR = b'\0'
 
 # Container for each TCP segment
+# msg is kept as bytes (or a memoryview when sending slices of a larger message)
 class SegmentTCP:
-    def __init__(self, syn:bool, ack:bool, fin:bool, seq:int, msg):
-        if not isinstance(syn, bool):
-            raise TypeError(f"Error: syn must be bool, got {type(syn).__name__}")
-        if not isinstance(ack, bool):
-            raise TypeError(f"Error: ack must be bool, got {type(ack).__name__}")
-        if not isinstance(fin, bool):
-            raise TypeError(f"Error: fin must be bool, got {type(fin).__name__}")
-        if not isinstance(seq, int):
-            raise TypeError(f"Error: seq must be int, got {type(seq).__name__}")
-        
-        try:
-            msg = str(msg)
-        except Exception as e:
-            raise TypeError(f'Error: {e}\nmsg could not be converted to str:\nmsg: {msg}')
-        
+    __slots__ = ('syn', 'ack', 'fin', 'seq', 'msg')
+
+    def __init__(self, syn: bool, ack: bool, fin: bool, seq: int, msg: 'bytes | memoryview | str' = b''):
+        if isinstance(msg, str):
+            msg = msg.encode()
+
         self.syn = syn
         self.ack = ack
         self.fin = fin
@@ -41,69 +48,94 @@ class SegmentTCP:
         self.msg = msg
 
     def __str__(self):
-        return f'<SegmentTCP> [SYN:{self.syn}, ACK:{self.ack}, FIN:{self.fin}, SEQ:{self.seq}, MSG:{self.msg}]'
-    
+        return f'<SegmentTCP> [SYN:{self.syn}, ACK:{self.ack}, FIN:{self.fin}, SEQ:{self.seq}, MSG:{bytes(self.msg)}]'
+
     def __repr__(self):
         return str(self)
 
+    # Whether the segment is an RST, the peer dropped the connection
+    @property
+    def rst(self) -> bool:
+        return self.syn and self.fin
+
     # Instantiates a segment based on a bytes response (a sent segment)
+    # The header version is detected from the first byte, text headers always start with '0' or '1'
+    # Raises ValueError if tcp_message is not a valid segment, callers drop it
     @staticmethod
     def parse_segment(tcp_message: bytes) -> 'SegmentTCP':
-        tcp_message_s = tcp_message.decode()
-        re_groups = HEADER_REGEX.match(tcp_message_s).groups()
+        if tcp_message[:1] == b'\x02':
+            if len(tcp_message) < BINARY_HEADER.size:
+                raise ValueError(f'Invalid TCP segment {tcp_message!r}: expected at least {BINARY_HEADER.size} bytes, got {len(tcp_message)}')
 
-        if len(re_groups) != 5:
-            print(f'Invalid TCP segment:\n{tcp_message_s}\nExpected 5 groups, got {len(re_groups)}')
-            sys.exit(1)
+            _, flags, seq = BINARY_HEADER.unpack_from(tcp_message)
+            segment = SegmentTCP.__new__(SegmentTCP)
+            segment.syn, segment.ack, segment.fin = FLAGS_TABLE[flags]
+            segment.seq = seq
+            segment.msg = tcp_message[BINARY_HEADER.size:]
+            return segment
 
-        syn, ack, fin, seq, msg = re_groups
+        return SegmentTCP._parse_text_segment(tcp_message)
 
-        # Type conversion and checking
+    # Casts the segment into bytes form, to send data over the network.
+    @staticmethod
+    def create_segment(segment: 'SegmentTCP', version: int = HEADER_VERSION_TEXT) -> bytes:
+        if version == HEADER_VERSION_BINARY:
+            flags = segment.syn | segment.ack << 1 | segment.fin << 2
+            return BINARY_HEADER.pack(HEADER_VERSION_BINARY, flags, segment.seq) + segment.msg
+
+        return b''.join((
+            b'1' if segment.syn else b'0', HEADER_SEPARATOR,
+            b'1' if segment.ack else b'0', HEADER_SEPARATOR,
+            b'1' if segment.fin else b'0', HEADER_SEPARATOR,
+            str(segment.seq).encode(), HEADER_SEPARATOR,
+            segment.msg
+        ))
+
+    # Builds the data of a handshake segment from a dict of options
+    @staticmethod
+    def create_options(options: dict) -> bytes:
+        return OPTIONS_SEPARATOR.join(f'{key}={value}'.encode() for key, value in options.items())
+
+    # Reads the options from the data of a handshake segment, unknown data is ignored
+    @staticmethod
+    def parse_options(msg: bytes) -> dict[str, str]:
+        options = {}
+        for option in bytes(msg).split(OPTIONS_SEPARATOR):
+            key, assign, value = option.partition(OPTIONS_ASSIGN)
+            if assign:
+                options[key.decode(errors='replace')] = value.decode(errors='replace')
+
+        return options
+
+    # Splits the data of a SYN into its options and the fast open data that follows them, None if there is none
+    @staticmethod
+    def split_fast_open(msg: bytes) -> 'tuple[bytes, bytes | None]':
+        options, separator, data = bytes(msg).partition(FAST_OPEN_SEPARATOR)
+        return options, (data if separator else None)
+
+    # Parses a version 1 (text) header
+    @staticmethod
+    def _parse_text_segment(tcp_message: bytes) -> 'SegmentTCP':
+        fields = tcp_message.split(HEADER_SEPARATOR, 4)
+        if len(fields) != 5:
+            raise ValueError(f'Invalid TCP segment {tcp_message!r}: expected 5 fields, got {len(fields)}')
+
+        syn, ack, fin, seq, msg = fields
+
+        # Type checking
         errors_found = []
-        try:
-            assert syn in VALID_BOOLS_STR
-            syn = bool(int(syn))
-        except Exception as e:
-            errors_found.append(f'<{e}> Could not transform syn: {syn}')
-
-        try:
-            assert ack in VALID_BOOLS_STR
-            ack = bool(int(ack))
-        except Exception as e:
-            errors_found.append(f'<{e}> Could not transform syn: {ack}')
-
-        try:
-            assert fin in VALID_BOOLS_STR
-            fin = bool(int(fin))
-        except Exception as e:
-            errors_found.append(f'<{e}> Could not transform syn: {fin}')
-
-        try:
-            assert seq.isdigit()
-            seq = int(seq)
-        except Exception as e:
-            errors_found.append(f'<{e}> Could not transform seq: {seq}')
+        if syn not in VALID_BOOLS:
+            errors_found.append(f'Could not transform syn: {syn}')
+        if ack not in VALID_BOOLS:
+            errors_found.append(f'Could not transform ack: {ack}')
+        if fin not in VALID_BOOLS:
+            errors_found.append(f'Could not transform fin: {fin}')
+        if not seq.isdigit():
+            errors_found.append(f'Could not transform seq: {seq}')
 
         # Inform errors if any
         if len(errors_found) > 0:
-            print(f"Error parsing TCP Segment: {tcp_message.decode()}")
-            for error in errors_found:
-                print(f'\t{error}')
-            
-            sys.exit(1)
+            raise ValueError(f'Invalid TCP segment {tcp_message!r}: {", ".join(errors_found)}')
 
         # All checks passed -> return tcp segment
-        segment = SegmentTCP(syn, ack, fin, seq, msg)
-        return segment
-
-    # Casts the segment into bytes form, to send data over the network.
-    @staticmethod
-    def create_segment(segment: 'SegmentTCP') -> bytes:
-        syn_str = '1' if segment.syn else '0'
-        ack_str = '1' if segment.ack else '0'
-        fin_str = '1' if segment.fin else '0'
-        seq_str = str(segment.seq)
-
-        s = f'{syn_str}{HEADER_SEPARATOR}{ack_str}{HEADER_SEPARATOR}{fin_str}{HEADER_SEPARATOR}{seq_str}{HEADER_SEPARATOR}{segment.msg}'
-        s_bytes = s.encode()
-        return s_bytes
\ No newline at end of file
+        return SegmentTCP(syn == b'1', ack == b'1', fin == b'1', int(seq), msg)
\ No newline at end of file
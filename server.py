@@ -4,14 +4,65 @@ CC4303 - Computer Networks
 Author: Augusto Aguayo Barham
 """
 
+import argparse
+import sys
 from socket_tcp import SocketTCP
+from demux_server_tcp import DemuxServerTCP
+from compression import CODECS
+from striped_transfer import recv_striped, format_report
+from sharded_server import ShardedServer
 
-BUFFER_SIZE = 16
+parser = argparse.ArgumentParser(description='Actividad 3: Sockets orientados a conexión con Stop & Wait')
+parser.add_argument('--output', help='Write the received message to this file (memory-mapped) instead of printing it')
+parser.add_argument('--demux', action='store_true', help='Serve any number of clients from a single socket, printing each message')
+parser.add_argument('--compression', choices=sorted(CODECS), help='Accept compressed messages from clients that also use this codec')
+parser.add_argument('--striped', action='store_true', help='Receive a striped transfer (client --stripes) into --output, one process per stripe')
+parser.add_argument('--workers', type=int, help='Serve the clients from this many processes sharing the port (SO_REUSEPORT), counting their messages')
+parser.add_argument('--pin-cpus', action='store_true', help='Pin each worker to a CPU (requires --workers)')
+parser.add_argument('--duration', type=float, help='Stop the workers after this many seconds instead of on Ctrl+C (requires --workers)')
+args = parser.parse_args()
+
+if args.demux:
+    def print_message(conn_socket: SocketTCP, message: bytes) -> None:
+        print(f' ====== MESSAGE FROM {conn_socket.destination_addr}:{conn_socket.destination_port} ({len(message)} bytes) ======')
+        print(message.decode(errors='replace'))
+
+    demux_server = DemuxServerTCP()
+    demux_server.compression = args.compression
+    demux_server.bind(('localhost', 8000))
+    demux_server.serve_forever(print_message)
+
+if args.workers is not None:
+    def configure(server: DemuxServerTCP) -> None:
+        server.compression = args.compression
+
+    sharded_server = ShardedServer(args.workers, pin_cpus=args.pin_cpus)
+    sharded_server.configure = configure
+    print(f'{args.workers} workers listening on localhost:8000')
+    stats = sharded_server.serve_forever(('localhost', 8000), duration=args.duration)
+    print(' ============== SHARDED SERVER ===============')
+    for worker in stats['workers']:
+        print(f"worker {worker['worker']} (pid {worker['pid']}, cpu {worker['cpu']}): "
+              f"{worker['connections']} connections, {worker['messages']} messages, {worker['bytes']} bytes")
+    print(f"total   : {stats['connections']} connections, {stats['messages']} messages, {stats['bytes']} bytes in "
+          f"{stats['seconds']} s, {stats['connections_per_second']} connections/s, {stats['goodput_bytes_per_second']} B/s")
+    sys.exit(0)
 
 server_socket = SocketTCP()
-server_socket.debug_mode = True
+server_socket.debug_mode = not args.striped
+server_socket.compression = args.compression
 server_socket.bind(('localhost', 8000))
 
+if args.striped:
+    if args.output is None:
+        parser.error('--striped requires --output')
+
+    report = recv_striped(server_socket, args.output)
+    print(' ============== STRIPED TRANSFER =============')
+    print(format_report(report))
+    server_socket.socket.close()
+    sys.exit(0 if report['ok'] else 1)
+
 conn_socket, conn_addr = server_socket.accept()
 
 print(' ============== CONNECTION DATA ==============')
@@ -23,16 +74,19 @@ print(f'conn origin address: {conn_socket.origin_addr}:{conn_socket.origin_port}
 print(f'conn dest address  : {conn_socket.destination_addr}:{conn_socket.destination_port}')
 print(' =============================================')
 
-# while conn_socket.expected_total_bytes is None or len(conn_socket.current_message) < conn_socket.expected_total_bytes:
-#     recv_bytes = conn_socket.recv(BUFFER_SIZE)
-
-while (conn_socket.expected_total_bytes is None or conn_socket.bytes_received_in_message < conn_socket.expected_total_bytes):
-    recv_bytes = conn_socket.recv(BUFFER_SIZE)
+if args.output is not None:
+    bytes_received = conn_socket.recv_file(args.output)
 
-
-print()
-print(' =============== DATA RECEIVED ===============')
-print(conn_socket.current_message)
+    print()
+    print(' =============== DATA RECEIVED ===============')
+    print(f'{bytes_received} bytes written to {args.output}')
+else:
+    # The client may send several messages over the connection, until it closes it
+    conn_socket.keep_current_message = False
+    while (message := conn_socket.recv_message()) is not None:
+        print()
+        print(' =============== DATA RECEIVED ===============')
+        print(message.decode(errors='replace'))
 
 print()
 print(' ============= CLOSING CONNECTION ============')
@@ -0,0 +1,209 @@
+"""
+Multi-process Simplified TCP server: DemuxServerTCP workers sharing a port with SO_REUSEPORT.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from typing import Callable
+
+from socket_tcp import SocketTCP
+from demux_server_tcp import DemuxServerTCP, DEFAULT_BACKLOG
+from workers import start_worker, results_queue
+
+# Seconds between the stats each worker reports to the parent
+DEFAULT_STATS_INTERVAL_SECONDS = 1.0
+# Seconds start waits for the workers to bind
+WORKER_START_TIMEOUT_SECONDS = 10.0
+
+# Counters each worker reports, summed by stats
+WORKER_COUNTERS = ('connections', 'messages', 'bytes')
+
+# Forks worker processes, each running its own DemuxServerTCP bound to the same address with SO_REUSEPORT:
+# the kernel hashes the clients' addresses among the workers' sockets, so every segment of a client reaches
+# the same worker and each worker handles its clients on its own core, without sharing any state.
+# With pin_cpus each worker is pinned to one of the CPUs the process may run on, in turn (Linux only).
+# configure is called in each worker with its server before bind (transfer mode, window, compression...)
+# and on_message(connection socket, message) with each message received, in the worker.
+# Workers report their counters to the parent every stats_interval seconds, read with stats()
+class ShardedServer:
+    # Constructor
+    def __init__(self, workers: int = os.cpu_count() or 1, pin_cpus: bool = False, backlog: int = DEFAULT_BACKLOG):
+        if workers < 1:
+            raise ValueError(f'workers must be at least 1, got {workers}')
+        if pin_cpus and not hasattr(os, 'sched_setaffinity'):
+            raise ValueError('CPU pinning is not available on this platform')
+        self.workers = workers
+        self.pin_cpus = pin_cpus
+        self.backlog = backlog
+        self.configure = None
+        self.stats_interval = DEFAULT_STATS_INTERVAL_SECONDS
+        self.origin_addr = None
+        self.origin_port = None
+
+        self._processes = []
+        self._stop_event = None
+        self._reports = None
+        # Last report of each worker, by worker index
+        self._worker_stats = {}
+        self._start_time = None
+
+    def __str__(self):
+        return f'<ShardedServer> [ADDRESS:{self.origin_addr}:{self.origin_port}, WORKERS:{self.workers}]'
+
+    def __repr__(self):
+        return str(self)
+
+    # Forks the workers and returns once all of them are listening on address.
+    # Port 0 picks a free port, shared by every worker (read it from origin_port)
+    # Raises OSError if a worker could not bind
+    def start(self, address: tuple[str, int], on_message: 'Callable[[SocketTCP, bytes], None] | None' = None) -> None:
+        cpus = sorted(os.sched_getaffinity(0)) if self.pin_cpus else None
+        self._stop_event = multiprocessing.get_context('fork').Event()
+        self._reports = results_queue(True)
+        self._start_time = time.monotonic()
+        self.origin_addr, self.origin_port = address
+
+        # The first worker binds alone, so the others get the port it got.
+        # No socket of the parent may be bound to it: forked workers would inherit it and the kernel would
+        # hash clients to it, with nobody reading it
+        deadline = time.monotonic() + WORKER_START_TIMEOUT_SECONDS
+        for index in range(self.workers):
+            cpu = cpus[index % len(cpus)] if cpus is not None else None
+            self._processes.append(start_worker(True, _serve_worker, (
+                index, cpu, (self.origin_addr, self.origin_port), self.backlog, self.configure, on_message,
+                self.stats_interval, self._stop_event, self._reports
+            )))
+            if index == 0 or index == self.workers - 1:
+                self._wait_started(index + 1, deadline)
+            if index == 0:
+                self.origin_addr, self.origin_port = self._worker_stats[0]['address']
+
+    # Helper that waits the first report of the workers until there are started of them
+    def _wait_started(self, started: int, deadline: float) -> None:
+        while len(self._worker_stats) < started:
+            try:
+                report = self._reports.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.stop()
+                raise OSError(f'Only {len(self._worker_stats)} of {self.workers} workers started')
+            if 'error' in report:
+                self.stop()
+                raise OSError(f'Worker {report["worker"]} could not start: {report["error"]}')
+            self._worker_stats[report['worker']] = report
+
+    # Runs the workers until interrupted (KeyboardInterrupt) or for duration seconds
+    # Returns the final stats, see stats
+    def serve_forever(self, address: tuple[str, int], on_message: 'Callable[[SocketTCP, bytes], None] | None' = None,
+                      duration: 'float | None' = None) -> dict:
+        self.start(address, on_message)
+        try:
+            deadline = None if duration is None else time.monotonic() + duration
+            while deadline is None or time.monotonic() < deadline:
+                time.sleep(self.stats_interval if deadline is None
+                           else max(min(self.stats_interval, deadline - time.monotonic()), 0))
+        except KeyboardInterrupt:
+            pass
+        return self.stop()
+
+    # Stops the workers, waiting their last report. Returns the final stats, see stats
+    def stop(self) -> dict:
+        if self._stop_event is None:
+            return self.stats()
+
+        self._stop_event.set()
+        # Workers send their last report before exiting, read them first so no worker blocks on a full queue
+        deadline = time.monotonic() + WORKER_START_TIMEOUT_SECONDS
+        while any(process.is_alive() for process in self._processes) and time.monotonic() < deadline:
+            self._drain_reports(timeout=0.1)
+        for process in self._processes:
+            process.join(timeout=max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._drain_reports()
+
+        self._processes = []
+        self._stop_event = None
+        return self.stats()
+
+    # Counters of the workers as last reported: WORKER_COUNTERS summed over the workers, connections and
+    # messages per second and goodput (message bytes per second) since start, and 'workers', the report
+    # of each worker (its pid, cpu, open_connections and counters)
+    def stats(self) -> dict:
+        if self._stop_event is not None:
+            self._drain_reports()
+
+        workers = [self._worker_stats[index] for index in sorted(self._worker_stats)]
+        stats = {name: sum(worker[name] for worker in workers) for name in WORKER_COUNTERS}
+        stats['open_connections'] = sum(worker['open_connections'] for worker in workers)
+        seconds = max((worker['time'] for worker in workers), default=self._start_time)
+        seconds = seconds - self._start_time if self._start_time is not None else 0.0
+        stats['seconds'] = round(seconds, 6)
+        stats['connections_per_second'] = round(stats['connections'] / seconds, 1) if seconds > 0 else None
+        stats['messages_per_second'] = round(stats['messages'] / seconds, 1) if seconds > 0 else None
+        stats['goodput_bytes_per_second'] = round(stats['bytes'] / seconds, 1) if seconds > 0 else None
+        stats['workers'] = workers
+        return stats
+
+    # Helper that keeps the latest report of each worker from the queue
+    def _drain_reports(self, timeout: 'float | None' = None) -> None:
+        while True:
+            try:
+                report = self._reports.get(timeout=timeout) if timeout is not None else self._reports.get_nowait()
+            except queue.Empty:
+                return
+            timeout = None
+            if 'error' not in report:
+                self._worker_stats[report['worker']] = report
+
+# Helper worker of ShardedServer: serves its share of the clients until stop_event is set,
+# reporting its counters every stats_interval seconds and once more before exiting
+def _serve_worker(index: int, cpu: 'int | None', address: tuple[str, int], backlog: int,
+                  configure: 'Callable[[DemuxServerTCP], None] | None',
+                  on_message: 'Callable[[SocketTCP, bytes], None] | None', stats_interval: float,
+                  stop_event, reports) -> None:
+    counters = dict.fromkeys(WORKER_COUNTERS, 0)
+    # Ctrl+C reaches every process of the terminal, the parent stops the workers instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        if cpu is not None:
+            os.sched_setaffinity(0, {cpu})
+        server = DemuxServerTCP(backlog)
+        server.reuse_port = True
+        if configure is not None:
+            configure(server)
+        server.bind(address)
+    except Exception as e:
+        reports.put({'worker': index, 'error': repr(e)})
+        return
+
+    def report() -> None:
+        reports.put({
+            'worker': index, 'pid': os.getpid(), 'cpu': cpu, 'address': server.socket.getsockname(), 'time': time.monotonic(),
+            'open_connections': len(server.connections), **counters
+        })
+
+    report()
+    next_report = time.monotonic() + stats_interval
+    try:
+        while not stop_event.is_set():
+            messages = server.poll(timeout=max(next_report - time.monotonic(), 0))
+            counters['connections'] += len(server.accept_queue)
+            server.accept_queue.clear()
+            for conn_socket, message in messages:
+                counters['messages'] += 1
+                counters['bytes'] += len(message)
+                if on_message is not None:
+                    on_message(conn_socket, message)
+
+            if time.monotonic() >= next_report:
+                report()
+                next_report = time.monotonic() + stats_interval
+    finally:
+        report()
+        server.close()
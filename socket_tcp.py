@@ -4,58 +4,260 @@ CC4303 - Computer Networks
 Author: Augusto Aguayo Barham
 """
 
+import mmap
+import os
 import socket
 import random
 import time
-from typing import Callable
+from collections import deque
+from itertools import chain
+from typing import Callable, Iterable, Iterator
 
-from segment_tcp import SegmentTCP
+from segment_tcp import SegmentTCP, HEADER_VERSION_TEXT, HEADER_VERSION_BINARY, FAST_OPEN_SEPARATOR
+from rtt_estimator import RTTEstimator
+from ring_buffer import RingBuffer
+from connection_stats import ConnectionStats
+from trace_tcp import TRACE_OFF, TRACE_EVENTS, TRACE_SEGMENTS
+from congestion_control import CongestionControl, CONGESTION_RENO, DEFAULT_PACING_RATE, create_congestion_control
+from datagram_io import DatagramIO, create_datagram_io
+from time_wait import time_wait_reaper
+from fast_open import FastOpenCookies, fast_open_cache
+from compression import compress_message, create_codec
 
 # Socket constants
 UDP_BUFFER_SIZE = 4096
+# Segment data size used with peers that do not advertise their MSS
 MESSAGE_MAX_PACKET_SIZE = 16
+# Default MSS, keeps segments under a typical path MTU
+DEFAULT_MSS = 1400
+MAX_MSS = 65000
+# Upper bound of the header size for any header version
+MAX_HEADER_SIZE = 64
+# Timeout for idle waits (new connections, data, FIN), retransmissions use the RTO instead
 SEGMENT_TIMEOUT_SECONDS = 1.5
+# Data the receiver buffers before the application reads it, advertised to the sender as its window
+DEFAULT_RECV_BUFFER_SIZE = 64 * 1024
+
+# Transmissions of SYN+ACK, FIN and FIN+ACK before the peer is assumed gone
+MAX_RETRIES = 3
+# Retransmissions of a BYTECOUNT, data segment or window probe without an answer, then the peer is taken as gone
+# and send raises ConnectionError
+MAX_DATA_RETRIES = 6
+# TIME_WAIT of the side that closes first, in RTOs. Covers the peer's FIN+ACK retransmissions,
+# each one waiting twice as long as the previous
+TIME_WAIT_RTOS = 2 ** MAX_RETRIES
+# Handshakes remembered by a listening socket, SYNs they retransmitted while it was busy are then ignored
+RECENT_HANDSHAKES = 64
+# Teardown states of a closed connection, handled in the background by the TimeWaitReaper:
+# TIME_WAIT answers late FIN+ACKs with the final ACK, LAST_ACK retransmits the FIN+ACK until the final ACK
+CLOSE_TIME_WAIT = 'time_wait'
+CLOSE_LAST_ACK = 'last_ack'
+
+# Transfer modes
+MODE_STOP_AND_WAIT = 'stop_and_wait'
+MODE_GO_BACK_N = 'go_back_n'
+MODE_SELECTIVE_REPEAT = 'selective_repeat'
+DEFAULT_WINDOW_SIZE = 8
+
+# Delayed ACKs (Go-Back-N and Selective Repeat receivers): in-order data is ACKed every
+# DELAYED_ACK_SEGMENTS segments or DELAYED_ACK_TIMEOUT_SECONDS after the first unACKed one
+DELAYED_ACK_SEGMENTS = 2
+DELAYED_ACK_TIMEOUT_SECONDS = 0.01
+
+# Fast retransmit (Go-Back-N and Selective Repeat senders): this many ACKs in a row that do not
+# move the cumulative seq resend the oldest unACKed data without waiting for its timer
+DUPLICATE_ACK_THRESHOLD = 3
+
+# Streaming send, sources are read in chunks of this size.
+# When the total length is unknown each chunk is framed with its own BYTECOUNT: c<length>, ended by c0
+STREAM_CHUNK_SIZE = 1024 * 1024
+CHUNK_BYTECOUNT_PREFIX = b'c'
+# Compressed messages (and chunks) count their compressed bytes, followed by their length once decompressed:
+# z<compressed length>,<length>
+COMPRESSED_BYTECOUNT_PREFIX = b'z'
+COMPRESSED_LENGTH_SEPARATOR = b','
+
+# Sets SO_REUSEPORT on a UDP socket before its bind, so several sockets (one per process) can listen on the
+# same port and the kernel spreads the clients among them by their address
+def set_reuse_port(udp_socket: socket.socket) -> None:
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise ValueError('SO_REUSEPORT is not available on this platform')
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
 # Simplified TCP socket wrapper, using UDP with Stop & Wait.
 class SocketTCP:
     # Constructor
-    def __init__(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(SEGMENT_TIMEOUT_SECONDS)
+    # udp_socket lets several connections share an already bound socket (see DemuxServerTCP)
+    def __init__(self, udp_socket: 'socket.socket | None' = None):
+        if udp_socket is None:
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.settimeout(SEGMENT_TIMEOUT_SECONDS)
+        self.socket = udp_socket
         self.destination_addr = None
         self.destination_port = None
         self.origin_addr = None
         self.origin_port = None
         self.seq = None
         
-        self.current_message = ''
+        # Whole message received so far. keep_current_message None (the default) keeps this copy only without
+        # flow control: with it the receive buffer stays bounded, and the copy would grow with the whole message.
+        # True or False always or never keep it
+        self.current_message = bytearray()
+        self.keep_current_message = None
         self.expected_total_bytes = None
         self.bytes_received_in_message = 0
+        self.chunked_message = False
+        # Length of the message as delivered to the application and how much of it was delivered,
+        # they differ from the two above (bytes on the wire) when the message is compressed
+        self._message_length = 0
+        self._message_delivered = 0
         self.is_closed = False
-        self.recv_buffer = b''
+        # Set once a FIN arrives where the next message was expected
+        self._peer_closed = False
+        # Background teardown once closed (CLOSE_TIME_WAIT or CLOSE_LAST_ACK), with the segment it resends
+        self._close_state = None
+        self._close_segment = None
+        self._close_retries = 0
+        # (client address, SYN seq) of the last handshakes of a listening socket
+        self._recent_handshakes = deque(maxlen=RECENT_HANDSHAKES)
+        self.recv_buffer = RingBuffer()
+
+        # Flow control, each ACK advertises the free space of recv_buffer (out of recv_buffer_size) and
+        # the sender keeps its data within it. Only used when both peers advertise it in the handshake
+        self.recv_buffer_size = DEFAULT_RECV_BUFFER_SIZE
+        self._flow_control = False
+        self._advertised_window = None
+        # Highest seq the receiver has room for, and whether the last ACK moved it
+        self._peer_window_end = None
+        self._peer_window_opened = False
+        # Destination of recv_file, data is written straight into the mapped file instead of recv_buffer
+        self._recv_file = None
+        self._recv_sink = None
+        # Out of order data (Selective Repeat), keyed by the seq where the data starts
+        self.reorder_buffer = {}
+
+        # Both peers must agree on the transfer mode
+        self.transfer_mode = MODE_STOP_AND_WAIT
+        self.window_size = DEFAULT_WINDOW_SIZE
+
+        # Delayed ACKs, delayed_ack_segments = 1 ACKs every segment
+        self.delayed_ack_segments = DELAYED_ACK_SEGMENTS
+        self.delayed_ack_timeout = DELAYED_ACK_TIMEOUT_SECONDS
+        self._unacked_segments = 0
+        self._pending_ack_seq = None
+        self._ack_deadline = None
+        # seq of the last ACK sent, what the peer's data got to. Once this side sends a message its own seq
+        # moves past it, so duplicates of the peer's last segments are re-ACKed with this one
+        self._acked_seq = None
+
+        # Fast retransmit, _recovery_seq is the highest seq sent when it last fired, until it is ACKed
+        self._duplicate_acks = 0
+        self._recovery_seq = None
+
+        # Congestion control of Go-Back-N and Selective Repeat senders, one of CONGESTION_CONTROLS.
+        # pacing_rate (bytes per second) is only used by CONGESTION_FIXED_RATE.
+        # Both must be set before the first send, the controller is created then
+        self.congestion_control = CONGESTION_RENO
+        self.pacing_rate = DEFAULT_PACING_RATE
+        self._congestion = None
+
+        # Wire format, the handshake is always done with the text header and
+        # both peers then use the highest version they both support
+        self.max_header_version = HEADER_VERSION_BINARY
+        self.header_version = HEADER_VERSION_TEXT
+
+        # Maximum segment size, advertised in the handshake.
+        # Once connected it holds the minimum of both peers
+        self.mss = DEFAULT_MSS
+
+        # Fast open: clients ask for a cookie in their SYN and, once they have one, connect_send puts the
+        # BYTECOUNT and the first slice in it. Listening sockets give cookies and accept the SYN data
+        self.fast_open = False
+        self._fast_open_cookies = None
+
+        # Listening sockets with reuse_port bind with SO_REUSEPORT, see set_reuse_port
+        self.reuse_port = False
+
+        # Compression codec (one of compression.CODECS, None to send messages as they are), used if both
+        # peers pick the same one. Each message is compressed whole unless it is too short or does not compress,
+        # and decompressed as its segments arrive
+        self.compression = None
+        self._codec = None
+        self._decompressor = None
+        # Compressed input the decompressor held back, it did not fit in recv_buffer yet
+        self._decompress_tail = b''
+
+        # Retransmission timeout, estimated from the measured RTT of the connection
+        self.rtt = RTTEstimator()
+        self._stats = ConnectionStats()
 
+        # Datagram I/O, batched_io drains every ready datagram per wakeup and coalesces the segments of a
+        # window into GSO sends (Linux only, one syscall per segment elsewhere). Created by the first send or
+        # receive, so both settings must be set before connecting
+        self.batched_io = True
+        self._io = None
+
+        # Tracing, debug_mode prints every message (as TRACE_SEGMENTS).
+        # capture is an optional PcapWriter that gets every segment sent and received
         self.debug_mode = False
+        self.trace_level = TRACE_OFF
+        self.capture = None
 
     # Server function
     # Start listerning on the address
     def bind(self, address: tuple[str, int]) -> None:
         self.origin_addr, self.origin_port = address
+        if self.reuse_port:
+            set_reuse_port(self.socket)
         self.socket.bind((self.origin_addr, self.origin_port))
 
+    # Current retransmission timeout in seconds
+    @property
+    def rto(self) -> float:
+        return self.rtt.rto
+
+    # Counters of the connection: segments, retransmissions, duplicate ACKs, RTT samples, bytes
+    # delivered and seconds blocked waiting segments, plus the current RTT estimation
+    def stats(self) -> dict:
+        stats = self._stats.to_dict()
+        stats['srtt'] = self.rtt.srtt
+        stats['rto'] = self.rtt.rto
+        stats['cwnd'] = self._congestion.cwnd if self._congestion is not None else None
+        return stats
+
     # Client function
     # Initiate handshake with the server
     def connect(self, address: tuple[str, int]) -> None:
+        self._connect(address, None)
+
+    # Client function
+    # Connects to address and sends message. With fast_open and a cookie of a previous connection to the server,
+    # the BYTECOUNT and the first slice travel in the SYN: messages of a single segment take one RTT.
+    # Otherwise it connects (asking for a cookie) and sends as usual
+    def connect_send(self, address: tuple[str, int], message: bytes) -> None:
+        n_sent = self._connect(address, message)
+        if n_sent is None:
+            self.send(message)
+            return
+
+        self._send_slices(self._slice_message(memoryview(message).cast('B')[n_sent:]))
+        self._log('[%s] @send, end', self.seq)
+
+    # Helper that makes the handshake, with message the first slice goes in the SYN when fast open is possible
+    # Returns how many bytes of message the server accepted that way, None if it got none
+    def _connect(self, address: tuple[str, int], message: 'bytes | None') -> 'int | None':
         self.seq = random.randint(0, 100)
         self.destination_addr, self.destination_port = address
-        self._log(f'[{self.seq}] @connect, set seq to {self.seq}')
+        self._log('[%s] @connect, set seq to %s', self.seq, self.seq)
 
-        # Send SYN, seq=x
-        tcp_segment = SegmentTCP(True, False, False, self.seq, '')
-        self._log(f'[{self.seq}] @connect, send SYN')
+        # Send SYN, seq=x, advertising the supported header version and MSS
+        tcp_segment, fast_open_data = self._syn_segment(address, message)
+        self._log('[%s] @connect, send SYN', self.seq)
         self._send_segment(tcp_segment)
+        sent_time = time.monotonic()
 
         # Wait ACK+SYN, seq=x+1
-        self._log(f'[{self.seq}] @connect, wait ACK+SYN...')
+        self._log('[%s] @connect, wait ACK+SYN...', self.seq)
         while True:
             try:
                 recv_segment, recv_address = self._wait_segment(
@@ -64,111 +266,303 @@ class SocketTCP:
                 )
                 break
             except socket.timeout:
-                self._log(f'[{self.seq}] @connect, timeout waiting SYN-ACK, resending SYN')
-                self._send_segment(tcp_segment)
+                self.rtt.backoff()
+                sent_time = None
+                self._log('[%s] @connect, timeout waiting SYN-ACK, resending SYN', self.seq)
+                self._resend_segment(tcp_segment)
+
+        self._sample_rtt(sent_time)
 
+        return self._complete_connect(recv_segment, recv_address, address, fast_open_data)
+
+    # Helper that builds the SYN to address, with fast open it carries the cookie (empty asks for one)
+    # and, once there is one, the BYTECOUNT of message and its first slice.
+    # Returns the SYN and that slice, None if it has none
+    def _syn_segment(self, address: tuple[str, int], message: 'bytes | None') -> 'tuple[SegmentTCP, bytes | None]':
+        fast_open_options = None
+        fast_open_data = None
+        if self.fast_open:
+            cached = fast_open_cache().get(address)
+            fast_open_options = {'tfo': cached[0] if cached is not None else ''}
+            # The MSS is not negotiated yet, the slice fits the one of the previous connection.
+            # Empty messages have no slice, they are sent after the handshake
+            if message is not None and len(message) > 0 and cached is not None:
+                fast_open_options['bytecount'] = len(message)
+                fast_open_data = bytes(memoryview(message).cast('B')[:min(self.mss, cached[1])])
+
+        syn_options = self._handshake_options(self.max_header_version, fast_open_options)
+        if fast_open_data is not None:
+            syn_options += FAST_OPEN_SEPARATOR + fast_open_data
+        return SegmentTCP(True, False, False, self.seq, syn_options), fast_open_data
+
+    # Helper that completes the handshake once the SYN+ACK arrived: negotiates, keeps the cookie and sends the ACK
+    # Returns how many bytes of fast_open_data the SYN+ACK confirmed, None if none
+    def _complete_connect(self, synack_segment: SegmentTCP, recv_address: tuple[str, int],
+                          address: tuple[str, int], fast_open_data: 'bytes | None') -> 'int | None':
         self.destination_addr, self.destination_port = recv_address
-        
+        options = SegmentTCP.parse_options(synack_segment.msg)
+        self._negotiate(options)
+        if self.fast_open:
+            if 'tfo' in options:
+                fast_open_cache().put(address, options['tfo'], self.mss)
+            else:
+                fast_open_cache().discard(address)
+
         # Send ACK
         self.seq += 1
-        tcp_segment = SegmentTCP(False, True, False, self.seq, '')
-        self._log(f'[{self.seq}] @connect, send ACK')
+        tcp_segment = SegmentTCP(False, True, False, self.seq, b'')
+        self._log('[%s] @connect, send ACK', self.seq)
         self._send_segment(tcp_segment)
 
-        self._log(f'[{self.seq}] @connect, handshake completed!')
+        self._log('[%s] @connect, handshake completed!', self.seq)
+
+        # The SYN+ACK also confirms the fast open data, as the ACKs of its BYTECOUNT and slice would
+        if fast_open_data is None or options.get('data') != str(len(fast_open_data)):
+            return None
+        self.seq += 2 + len(fast_open_data)
+        if self._flow_control and 'wnd' in options:
+            self._peer_window_end = self.seq + int(options['wnd'])
+        self._log('[%s] @connect, fast open data accepted (%s bytes)', self.seq, len(fast_open_data))
+        return len(fast_open_data)
 
     # Server function
     # Responds to a client-initiated handshake
-    def accept(self) -> 'tuple[SocketTCP, tuple[str, int]]':
-        # Wait SYN, will set seq=x
-        self._log(f'[{self.seq}] @accept, wait SYN...')
+    # Handshakes whose ACK never arrives (a SYN retransmitted after the connection was made) are dropped
+    # Raises socket.timeout if no SYN arrives within timeout seconds, waits forever when None
+    def accept(self, timeout: 'float | None' = None) -> 'tuple[SocketTCP, tuple[str, int]]':
+        deadline = None if timeout is None else time.monotonic() + timeout
         while True:
+            # Wait SYN, will set seq=x
+            self._log('[%s] @accept, wait SYN...', self.seq)
+            while True:
+                remaining = SEGMENT_TIMEOUT_SECONDS if deadline is None else deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('timed out')
+                try:
+                    recv_segment, recv_address = self._wait_segment(
+                        f_condition=lambda sock, rseg: rseg.syn,
+                        f_update_seq=lambda sock, rseg: sock.seq,
+                        timeout=min(remaining, SEGMENT_TIMEOUT_SECONDS)
+                    )
+                    break
+                except socket.timeout:
+                    # Continue listening for new SYNs
+                    self._log('[%s] @accept, timeout waiting SYN, continuing', self.seq)
+                    continue
+
+            if (recv_address, recv_segment.seq) in self._recent_handshakes:
+                self._log('[%s] @accept, duplicate SYN from %s, ignoring', self.seq, recv_address)
+                continue
+            self._recent_handshakes.append((recv_address, recv_segment.seq))
+
+            # A SYN with malformed options is dropped, the listener goes on
             try:
-                recv_segment, recv_address = self._wait_segment(
-                    f_condition=lambda sock, rseg: rseg.syn,
-                    f_update_seq=lambda sock, rseg: sock.seq
-                )
-                break
-            except socket.timeout:
-                # Continue listening for new SYNs
-                self._log(
-                    f'[{self.seq}] @accept, timeout waiting SYN, continuing')
+                conn_socket = self._handshake(recv_segment, recv_address)
+            except ValueError as e:
+                self._log('[%s] @accept, invalid SYN from %s, ignoring: %s', self.seq, recv_address, e)
                 continue
+            if conn_socket is not None:
+                return (conn_socket, (conn_socket.origin_addr, conn_socket.origin_port))
+
+    # Helper of accepted connections: takes the settings of the socket (or DemuxServerTCP) listener that
+    # accepted them, before the options of the SYN are negotiated
+    def _copy_settings(self, listener: 'SocketTCP | DemuxServerTCP') -> None:
+        self.debug_mode = listener.debug_mode
+        self.trace_level = listener.trace_level
+        self.capture = listener.capture
+        self.transfer_mode = listener.transfer_mode
+        self.window_size = listener.window_size
+        self.congestion_control = listener.congestion_control
+        self.pacing_rate = listener.pacing_rate
+        self.delayed_ack_segments = listener.delayed_ack_segments
+        self.delayed_ack_timeout = listener.delayed_ack_timeout
+        self.max_header_version = listener.max_header_version
+        self.mss = listener.mss
+        self.recv_buffer_size = listener.recv_buffer_size
+        self.compression = listener.compression
+        self.batched_io = listener.batched_io
 
+    # Helper that answers a SYN from a new connection socket and waits its ACK
+    # Returns the connection, or None if the client never ACKed the SYN+ACK.
+    # A fast open connection is returned right away, with the SYN data already received
+    def _handshake(self, syn_segment: SegmentTCP, address: tuple[str, int]) -> 'SocketTCP | None':
         conn_socket = SocketTCP()
-        conn_socket.destination_addr, conn_socket.destination_port = recv_address
-        conn_socket.debug_mode = self.debug_mode
+        conn_socket.destination_addr, conn_socket.destination_port = address
+        conn_socket._copy_settings(self)
+        options_data, fast_open_data = SegmentTCP.split_fast_open(syn_segment.msg)
+        options = SegmentTCP.parse_options(options_data)
+        try:
+            conn_socket._negotiate(options)
+        except ValueError:
+            conn_socket._close_socket()
+            raise
         local_bind_addr = self.origin_addr if self.origin_addr is not None else ''
 
         # Let the system pick a port
         conn_socket.socket.bind((local_bind_addr, 0))
         conn_socket.origin_addr, conn_socket.origin_port = conn_socket.socket.getsockname()
-        conn_socket.seq = recv_segment.seq
 
-        # Send ACK+SYN, seq=x+1
-        conn_socket.seq += 1
-        tcp_segment = SegmentTCP(True, True, False, conn_socket.seq, '')
-        self._log(f'[{conn_socket.seq}] @accept(conn), send ACK+SYN')
+        # Send ACK+SYN, seq=x+1, with the negotiated header version and MSS
+        conn_socket.seq = syn_segment.seq + 1
+        fast_open_options = self._accept_fast_open(conn_socket, options, fast_open_data, address)
+        synack_options = conn_socket._handshake_options(conn_socket.header_version, fast_open_options)
+        tcp_segment = SegmentTCP(True, True, False, conn_socket.seq, synack_options)
+        self._log('[%s] @accept(conn), send ACK+SYN', conn_socket.seq)
         conn_socket._send_segment(tcp_segment)
+        sent_time = time.monotonic()
+
+        # The client already counts the SYN data as ACKed, the connection is kept even if the ACK never comes
+        fast_open = fast_open_options is not None and 'data' in fast_open_options
+        f_condition = SocketTCP._completes_fast_open if fast_open else SocketTCP._completes_handshake
 
         # Wait ACK
-        self._log(f'[{conn_socket.seq}] @accept(conn), wait ACK...')
+        retries = 1
+        self._log('[%s] @accept(conn), wait ACK...', conn_socket.seq)
         while True:
             try:
                 conn_socket._wait_segment(
-                    f_condition=lambda sock, rseg: rseg.ack and rseg.seq == sock.seq + 1,
-                    f_update_seq=lambda sock, rseg: rseg.seq
+                    f_condition=f_condition,
+                    f_update_seq=lambda sock, rseg: sock.seq + 1
                 )
                 break
             except socket.timeout:
-                self._log(f'[{conn_socket.seq}] @accept(conn), timeout waiting ACK, resending SYN-ACK')
-                conn_socket._send_segment(tcp_segment)
+                if fast_open and retries >= MAX_RETRIES:
+                    self._log('[%s] @accept(conn), %s timeouts waiting ACK, keeping the fast open connection', conn_socket.seq, retries)
+                    break
+                if retries >= MAX_RETRIES:
+                    self._log('[%s] @accept(conn), %s timeouts waiting ACK, dropping the connection', conn_socket.seq, retries)
+                    conn_socket._close_socket()
+                    return None
+                retries += 1
+                conn_socket.rtt.backoff()
+                sent_time = None
+                self._log('[%s] @accept(conn), timeout waiting ACK, resending SYN-ACK', conn_socket.seq)
+                conn_socket._resend_segment(tcp_segment)
 
-        self._log(f'[{conn_socket.seq}] @accept(conn), handshake completed!')
+        conn_socket._sample_rtt(sent_time)
+
+        self._log('[%s] @accept(conn), handshake completed!', conn_socket.seq)
+
+        if fast_open:
+            conn_socket._receive_fast_open(options['bytecount'], fast_open_data, syn_segment.seq + 3)
+            self._log('[%s] @accept(conn), fast open, %s bytes received in the SYN', conn_socket.seq, len(fast_open_data))
+
+        return conn_socket
 
-        return (conn_socket, (conn_socket.origin_addr, conn_socket.origin_port))
-    
     # Sends a full message in byte form
     def send(self, message: bytes) -> None:
-        # Slice message into pieces of MESSAGE_MAX_PACKET_SIZE size
-        message_length = len(message)
-        messages_sliced = [
-            message[i:i + MESSAGE_MAX_PACKET_SIZE]
-            for i in range(0, message_length, MESSAGE_MAX_PACKET_SIZE)
-        ]
-
         # Step 1
-        # Send the bytecount of the whole message
+        # Send the bytecount of the whole message, compressed if the codec negotiated helps
+        bytecount, message = self._encode_message(message)
+        self._send_bytecount(bytecount)
+
+        # Step 2
+        # Send all the message slices, of at most mss bytes
+        self._send_slices(self._slice_message(message))
+
+        self._log('[%s] @send, end', self.seq)
+
+    # Sends a message read lazily from a file object or an iterable of bytes-like chunks
+    # With total_length the message is sent as with send, the source must produce exactly that many bytes.
+    # Without it, each chunk is framed with its own BYTECOUNT and an empty chunk ends the message.
+    # With compression the message is always sent in chunks, each one compressed on its own
+    def send_stream(self, source, total_length: 'int | None' = None) -> None:
+        chunks = self._iter_chunks(source)
+
+        if total_length is not None and self._codec is None:
+            self._send_bytecount(str(total_length).encode())
+            self._send_slices(self._count_slices(
+                chain.from_iterable(self._slice_message(chunk) for chunk in chunks),
+                total_length
+            ))
+        else:
+            if total_length is not None:
+                chunks = self._count_slices(chunks, total_length)
+            for chunk in chunks:
+                bytecount, chunk = self._encode_message(chunk)
+                self._send_bytecount(CHUNK_BYTECOUNT_PREFIX + bytecount)
+                self._send_slices(self._slice_message(chunk))
+            self._send_bytecount(CHUNK_BYTECOUNT_PREFIX + b'0')
+
+        self._log('[%s] @send_stream, end', self.seq)
+
+    # Sends the contents of the file at path, without loading it whole in memory
+    # With use_mmap the file is mapped and its slices are sent without any intermediate copy
+    def sendfile(self, path: str, use_mmap: bool = False) -> None:
+        with open(path, 'rb') as file:
+            file_size = os.fstat(file.fileno()).st_size
+            if not use_mmap or file_size == 0:
+                self.send_stream(file, file_size)
+                return
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                self.send(file_map)
+
+    # Helper that returns the BYTECOUNT of a message and the bytes to send for it, compressed when possible
+    def _encode_message(self, message: bytes) -> 'tuple[bytes, bytes]':
+        compressed = compress_message(self._codec, message) if self._codec is not None else None
+        if compressed is None:
+            return str(len(message)).encode(), message
+
+        self._stats.compressed_messages += 1
+        self._stats.compression_saved_bytes += len(message) - len(compressed)
+        return (COMPRESSED_BYTECOUNT_PREFIX + str(len(compressed)).encode()
+                + COMPRESSED_LENGTH_SEPARATOR + str(len(message)).encode()), compressed
+
+    # Sends a BYTECOUNT segment and waits its ACK, data seq numbers start right after it
+    def _send_bytecount(self, bytecount: bytes) -> None:
+        # The peer decompresses a message only as its application reads it, the next one waits for room
+        if self._codec is not None:
+            self._wait_window(1)
         self.seq += 1
-        tcp_segment = SegmentTCP(False, False, False, self.seq, message_length)
-        self._log(f'[{self.seq}] @send, send BYTECOUNT')
+        tcp_segment = SegmentTCP(False, False, False, self.seq, bytecount)
+        self._log('[%s] @send, send BYTECOUNT', self.seq)
         self._send_segment(tcp_segment)
+        sent_time = time.monotonic()
 
         # Wait bytecount ACK
-        self._log(f'[{self.seq}] @send, wait BYTECOUNT ACK...')
+        self._log('[%s] @send, wait BYTECOUNT ACK...', self.seq)
+        retries = 0
         while True:
             try:
                 self._wait_segment(
                     f_condition=lambda sock, rseg: rseg.ack and rseg.seq == sock.seq + 1,
-                    f_update_seq=lambda sock, rseg: rseg.seq + 1
+                    f_update_seq=lambda sock, rseg: rseg.seq
                 )
                 break
             except socket.timeout:
-                self._log(f'[{self.seq}] @send, timeout waiting BYTECOUNT ACK, resending BYTECOUNT')
-                self._send_segment(tcp_segment)
+                self._check_retries(retries, 'BYTECOUNT')
+                retries += 1
+                self.rtt.backoff()
+                sent_time = None
+                self._log('[%s] @send, timeout waiting BYTECOUNT ACK, resending BYTECOUNT', self.seq)
+                self._resend_segment(tcp_segment)
 
-        # Step 2
-        # Start sending all the message slices
+        self._sample_rtt(sent_time)
+
+    # Sends the message slices with the configured transfer mode
+    def _send_slices(self, messages_sliced: Iterable[memoryview]) -> None:
+        if self.transfer_mode == MODE_GO_BACK_N:
+            self._send_go_back_n(messages_sliced)
+        elif self.transfer_mode == MODE_SELECTIVE_REPEAT:
+            self._send_selective_repeat(messages_sliced)
+        else:
+            self._send_stop_and_wait(messages_sliced)
+
+    # Sends the message slices one at a time, waiting the ACK of each one
+    def _send_stop_and_wait(self, messages_sliced: Iterable[memoryview]) -> None:
         for message_slice in messages_sliced:
-            # Send message slice
+            # Send message slice, once the receiver has room for it
+            self._wait_window(len(message_slice))
             self.seq += len(message_slice)
-            message_slice_data = message_slice.decode()
-            tcp_segment = SegmentTCP(False, False, False, self.seq, message_slice_data)
-            self._log(f'[{self.seq}] @send, send msg slice:\'{message_slice_data}\'')
+            tcp_segment = SegmentTCP(False, False, False, self.seq, message_slice)
+            self._log('[%s] @send, send msg slice: %s', self.seq, tcp_segment, level=TRACE_SEGMENTS)
             self._send_segment(tcp_segment)
+            sent_time = time.monotonic()
 
             # Wait message slice ACK
-            self._log(f'[{self.seq}] @send, wait msg slice ACK...')
+            self._log('[%s] @send, wait msg slice ACK...', self.seq, level=TRACE_SEGMENTS)
+            retries = 0
             while True:
                 try:
                     self._wait_segment(
@@ -177,102 +571,508 @@ class SocketTCP:
                     )
                     break
                 except socket.timeout:
-                    self._log(f'[{self.seq}] @send, timeout waiting data ACK, resending msg slice')
-                    self._send_segment(tcp_segment)
+                    self._check_retries(retries, f'seq {self.seq}')
+                    retries += 1
+                    self.rtt.backoff()
+                    sent_time = None
+                    self._log('[%s] @send, timeout waiting data ACK, resending msg slice', self.seq)
+                    self._resend_segment(tcp_segment)
+
+            self._sample_rtt(sent_time)
+
+    # Sends the message slices keeping up to window_size segments in flight, less if the congestion control says so
+    # ACKs are cumulative, on timeout the whole window is resent
+    def _send_go_back_n(self, messages_sliced: Iterable[memoryview]) -> None:
+        slices = iter(messages_sliced)
+        in_flight = deque()  # [segment, sent time], sent time is None once retransmitted
+        # Timeouts in a row of the same oldest segment
+        timeouts = 0
+        timed_out_base = None
+        next_slice = None  # Slice waiting for room in the receive window
+        all_sent = False
+        congestion = self._congestion_controller()
+
+        batch = []  # Segments of the window being filled, sent together
+        while True:
+            # Fill the window, once the ACKs already received are handled so it is sent in one batch
+            while not all_sent and len(in_flight) < self._send_window() and not (in_flight and self._segments_queued()):
+                if next_slice is None:
+                    next_slice = next(slices, None)
+                    if next_slice is None:
+                        all_sent = True
+                        break
+                # The receiver has no room for it yet
+                if not self._window_allows(len(next_slice)):
+                    break
+                message_slice, next_slice = next_slice, None
+
+                send_delay = congestion.send_delay(time.monotonic())
+                if send_delay > 0:
+                    self._send_segments(batch)
+                    time.sleep(send_delay)
+                self.seq += len(message_slice)
+                tcp_segment = SegmentTCP(False, False, False, self.seq, message_slice)
+                self._log('[%s] @send(gbn), send msg slice, %s in flight', self.seq, len(in_flight) + 1, level=TRACE_SEGMENTS)
+                batch.append(tcp_segment)
+                sent_time = time.monotonic()
+                congestion.on_send(len(message_slice), sent_time)
+                in_flight.append([tcp_segment, sent_time])
+            self._send_segments(batch)
+
+            if not in_flight:
+                if all_sent:
+                    break
+                # Nothing in flight will bring a window update, wait for it probing the closed window
+                self._wait_window(len(next_slice))
+                continue
+
+            # Wait for an ACK that confirms at least the oldest segment in flight, or a duplicate of the
+            # last one (the seq where its data starts). The timer always belongs to the oldest segment in flight
+            base_segment = in_flight[0][0]
+            base_start = base_segment.seq - len(base_segment.msg)
+            try:
+                ack_segment, _ = self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.ack and base_start <= rseg.seq <= sock.seq,
+                    f_update_seq=lambda sock, rseg: sock.seq
+                )
+            except socket.timeout:
+                timeouts = timeouts + 1 if base_segment is timed_out_base else 1
+                timed_out_base = base_segment
+                self._check_retries(timeouts - 1, f'seq {base_segment.seq}')
+                self.rtt.backoff()
+                self._log('[%s] @send(gbn), timeout waiting ACK for seq %s, resending window', self.seq, base_segment.seq)
+                self._end_recovery()
+                congestion.on_timeout(time.monotonic())
+                self._resend_window(in_flight)
+                continue
 
-        self._log(f'[{self.seq}] @send, end')
+            self._ack_go_back_n(in_flight, ack_segment)
+
+    # Sends the message slices keeping the window at most window_size segments from the oldest unACKed one.
+    # Each segment has its own timer and only expired segments are resent.
+    # ACKs carry the cumulative seq, plus the seq of the segment that triggered it in the data
+    def _send_selective_repeat(self, messages_sliced: Iterable[memoryview]) -> None:
+        slices = iter(messages_sliced)
+        in_flight = {}  # seq -> [segment, deadline, sent time, retransmissions], None once ACKed
+        next_slice = None  # Slice waiting for room in the receive window
+        all_sent = False
+        congestion = self._congestion_controller()
+
+        batch = []  # Segments of the window being filled, sent together
+        while True:
+            # Fill the window, once the ACKs already received are handled so it is sent in one batch
+            while not all_sent and len(in_flight) < self._send_window() and not (in_flight and self._segments_queued()):
+                if next_slice is None:
+                    next_slice = next(slices, None)
+                    if next_slice is None:
+                        all_sent = True
+                        break
+                # The receiver has no room for it yet
+                if not self._window_allows(len(next_slice)):
+                    break
+                message_slice, next_slice = next_slice, None
+
+                send_delay = congestion.send_delay(time.monotonic())
+                if send_delay > 0:
+                    self._send_segments(batch)
+                    time.sleep(send_delay)
+                self.seq += len(message_slice)
+                tcp_segment = SegmentTCP(False, False, False, self.seq, message_slice)
+                self._log('[%s] @send(sr), send msg slice, %s in flight', self.seq, len(in_flight) + 1, level=TRACE_SEGMENTS)
+                batch.append(tcp_segment)
+                sent_time = time.monotonic()
+                congestion.on_send(len(message_slice), sent_time)
+                in_flight[self.seq] = [tcp_segment, sent_time + self.rto, sent_time, 0]
+            self._send_segments(batch)
+
+            if not in_flight:
+                if all_sent:
+                    break
+                # Nothing in flight will bring a window update, wait for it probing the closed window
+                self._wait_window(len(next_slice))
+                continue
+
+            # Wait until the earliest timer expires
+            next_deadline = min(entry[1] for entry in in_flight.values() if entry is not None)
+            try:
+                ack_segment, _ = self._wait_segment(
+                    f_condition=lambda sock, rseg: rseg.ack,
+                    f_update_seq=lambda sock, rseg: sock.seq,
+                    timeout=max(next_deadline - time.monotonic(), 0.001)
+                )
+            except socket.timeout:
+                self._resend_expired(in_flight)
+                continue
+
+            self._ack_selective_repeat(in_flight, ack_segment)
+
+    # Helper that drops the Go-Back-N segments confirmed by a cumulative ACK
+    # The receiver discards what follows a lost segment, so fast retransmit resends the whole window
+    def _ack_go_back_n(self, in_flight: deque, ack_segment: SegmentTCP) -> None:
+        if ack_segment.seq < in_flight[0][0].seq:
+            # ACKs that only open the receive window are not duplicates
+            if not self._peer_window_opened and self._duplicate_ack():
+                self._log('[%s] @send(gbn), %s duplicate ACKs for seq %s, fast retransmit of the window',
+                          self.seq, self._duplicate_acks, ack_segment.seq)
+                self._congestion.on_loss(time.monotonic())
+                self._resend_window(in_flight)
+                self._stats.fast_retransmits += 1
+            return
+
+        acked_segments = 0
+        while in_flight and in_flight[0][0].seq <= ack_segment.seq:
+            tcp_segment, sent_time = in_flight.popleft()
+            if tcp_segment.seq == ack_segment.seq:
+                self._sample_rtt(sent_time)
+            acked_segments += 1
+        self._grow_window(acked_segments)
+        self._new_ack(ack_segment.seq)
+
+    # Helper that marks the Selective Repeat segments confirmed by an ACK and slides the window
+    # Fast retransmit resends only the oldest unACKed segment, the receiver keeps the ones after it.
+    # ACKs that move the cumulative seq but not past the recovery point resend the next missing one right away
+    def _ack_selective_repeat(self, in_flight: dict, ack_segment: SegmentTCP) -> None:
+        oldest_seq, oldest_entry = next(iter(in_flight.items()))
+        oldest_start = oldest_seq - len(oldest_entry[0].msg)
+        sack_seq, _ = self._ack_data(ack_segment)
+        acked_segments = 0
+        for seq, entry in in_flight.items():
+            if entry is not None and (seq <= ack_segment.seq or seq == sack_seq):
+                if seq == sack_seq or seq == ack_segment.seq:
+                    self._sample_rtt(entry[2])
+                in_flight[seq] = None
+                acked_segments += 1
+        self._grow_window(acked_segments)
+
+        # Slide the window past the ACKed segments
+        for seq in list(in_flight):
+            if in_flight[seq] is not None:
+                break
+            del in_flight[seq]
+
+        # Older ACKs arrived late, they say nothing about losses
+        if ack_segment.seq < oldest_start:
+            return
+        if ack_segment.seq < oldest_seq:
+            if not self._peer_window_opened and self._duplicate_ack():
+                self._log('[%s] @send(sr), %s duplicate ACKs for seq %s, fast retransmit of seq %s',
+                          self.seq, self._duplicate_acks, ack_segment.seq, oldest_seq)
+                self._congestion.on_loss(time.monotonic())
+                self._resend_oldest(in_flight)
+                self._stats.fast_retransmits += 1
+        elif self._recovery_seq is not None and ack_segment.seq < self._recovery_seq:
+            self._duplicate_acks = 0
+            self._log('[%s] @send(sr), partial ACK for seq %s in recovery, resending next missing segment',
+                      self.seq, ack_segment.seq)
+            self._resend_oldest(in_flight)
+        else:
+            self._new_ack(ack_segment.seq)
+
+    # Helper that tells the congestion control about newly ACKed segments, the window does not grow during a recovery
+    def _grow_window(self, acked_segments: int) -> None:
+        if acked_segments > 0 and self._recovery_seq is None:
+            self._congestion.on_ack(acked_segments, self.rtt.srtt, time.monotonic())
+
+    # Helper that returns how many segments may be in flight: the congestion window, plus one for each of the
+    # first duplicate ACKs (limited transmit, RFC 3042) so small windows still get to a fast retransmit
+    def _send_window(self) -> int:
+        window = self._congestion.window()
+        if self._recovery_seq is None:
+            window += min(self._duplicate_acks, DUPLICATE_ACK_THRESHOLD - 1)
+        return min(window, self.window_size)
+
+    # Helper that returns the datagram I/O of the socket, creating it on the first use
+    # Stop & Wait has a single segment in flight, there is nothing to batch
+    def _datagram_io(self) -> DatagramIO:
+        if self._io is None:
+            self._io = create_datagram_io(self.socket, self.batched_io and self.transfer_mode != MODE_STOP_AND_WAIT)
+        return self._io
+
+    # Helper that returns the congestion control of the connection, creating it on the first send
+    def _congestion_controller(self) -> CongestionControl:
+        if self._congestion is None:
+            self._congestion = create_congestion_control(self.congestion_control, self.window_size, self.pacing_rate)
+        return self._congestion
+
+    # Helper that counts an ACK that does not move the cumulative seq
+    # Returns True when it should trigger a fast retransmit: the threshold was just reached out of recovery
+    def _duplicate_ack(self) -> bool:
+        self._stats.duplicate_acks += 1
+        self._duplicate_acks += 1
+        if self._duplicate_acks != DUPLICATE_ACK_THRESHOLD or self._recovery_seq is not None:
+            return False
+        self._recovery_seq = self.seq
+        return True
+
+    # Helper that handles an ACK that moved the cumulative seq, it ends the recovery once it covers the recovery point
+    def _new_ack(self, ack_seq: int) -> None:
+        self._duplicate_acks = 0
+        if self._recovery_seq is not None and ack_seq >= self._recovery_seq:
+            self._log('[%s] @send, recovery finished at seq %s', self.seq, ack_seq)
+            self._recovery_seq = None
+
+    # Helper that leaves fast recovery, a timeout already resends what is missing
+    def _end_recovery(self) -> None:
+        self._duplicate_acks = 0
+        self._recovery_seq = None
+
+    # Helper that resends every Go-Back-N segment in flight, after a timeout or duplicate ACKs
+    def _resend_window(self, in_flight: deque) -> None:
+        for entry in in_flight:
+            self._resend_segment(entry[0])
+            entry[1] = None
+
+    # Helper that resends the oldest unACKed Selective Repeat segment, restarting its timer
+    def _resend_oldest(self, in_flight: dict) -> None:
+        if not in_flight:
+            return
+        entry = next(iter(in_flight.values()))
+        self._resend_segment(entry[0])
+        entry[1] = time.monotonic() + self.rto
+        entry[2] = None
+
+    # Helper that gives up on a peer that answered none of the last MAX_DATA_RETRIES retransmissions of what
+    # (a segment or window probe), instead of resending it forever
+    def _check_retries(self, retries: int, what: str) -> None:
+        if retries >= MAX_DATA_RETRIES:
+            self._log('[%s] @send, no ACK for %s after %s retransmissions, peer gone', self.seq, what, retries)
+            raise ConnectionError(f'No ACK for {what} from {self.destination_addr}:{self.destination_port} '
+                                  f'after {retries} retransmissions')
+
+    # Helper that resends the Selective Repeat segments whose timer expired
+    def _resend_expired(self, in_flight: dict) -> None:
+        self.rtt.backoff()
+        self._end_recovery()
+        self._congestion.on_timeout(time.monotonic())
+        now = time.monotonic()
+        for seq, entry in in_flight.items():
+            if entry is not None and entry[1] <= now:
+                self._check_retries(entry[3], f'seq {seq}')
+                entry[3] += 1
+                self._log('[%s] @send(sr), timeout waiting ACK for seq %s, resending msg slice', self.seq, seq)
+                self._resend_segment(entry[0])
+                entry[1] = now + self.rto
+                entry[2] = None
 
     # Receives a TCP Segment of a message, of size buffer_size
     def recv(self, buffer_size: int) -> bytes:
-        self._log(f'[{self.seq}] @recv({buffer_size}), waiting message...')
-
-        # If the message size is known and enough if buffered just return the data
-        if self.expected_total_bytes is not None:
-            n_bytes = min(buffer_size, self._remaining_to_deliver())
-            if n_bytes > 0 and len(self.recv_buffer) >= n_bytes:
-                data_buffered = self.recv_buffer[:n_bytes]
-                self.recv_buffer = self.recv_buffer[n_bytes:]
-                return data_buffered
-
-        # # If the buffer contains data, return these first
-        # if self.recv_buffer:
-        #     data_buffered = self.recv_buffer[:buffer_size]
-        #     self.recv_buffer = self.recv_buffer[buffer_size:]
-        #     return data_buffered
+        self._log('[%s] @recv(%s), waiting message...', self.seq, buffer_size, level=TRACE_SEGMENTS)
+        n_bytes = self._wait_buffered(buffer_size)
+        data = self.recv_buffer.read(n_bytes)
+        self._send_window_update()
+        return data
+
+    # Receives a TCP Segment of a message directly into buffer (bytearray, memoryview, mmap...)
+    # Returns the number of bytes written, at most len(buffer)
+    def recv_into(self, buffer) -> int:
+        buffer_view = memoryview(buffer).cast('B')
+        self._log('[%s] @recv_into(%s), waiting message...', self.seq, len(buffer_view), level=TRACE_SEGMENTS)
+        n_bytes = self._wait_buffered(len(buffer_view))
+        n_bytes = self.recv_buffer.read_into(buffer_view[:n_bytes])
+        self._send_window_update()
+        return n_bytes
 
+    # Receives the next whole message, or the rest of the current one after a partial recv.
+    # Returns None if the peer closed the connection instead, then recv_close ends it.
+    # Messages larger than recv_buffer_size are read from the buffer as they arrive
+    def recv_message(self) -> 'bytes | None':
+        self._log('[%s] @recv_message, waiting message...', self.seq, level=TRACE_SEGMENTS)
+        message = bytearray()
         while True:
+            n_bytes = self._wait_buffered(self._remaining_to_deliver() or 1)
+            if self._peer_closed:
+                return None
+            message += self.recv_buffer.read(n_bytes)
+            self._send_window_update()
+            if self.message_received():
+                return bytes(message)
+
+    # Receives the next message straight into the file at path, returns its size.
+    # The file is preallocated with the BYTECOUNT and mapped, each segment is written at its offset.
+    # Must be called between messages, not after a partial recv
+    def recv_file(self, path: str) -> int:
+        self._log('[%s] @recv_file(%s), waiting message...', self.seq, path)
+        with open(path, 'w+b') as file:
+            self._recv_file = file
+            try:
+                self._wait_buffered(0)
+            finally:
+                if self._recv_sink is not None:
+                    self._recv_sink.flush()
+                    self._recv_sink.close()
+                self._recv_sink = None
+                self._recv_file = None
+
+        return self._message_length
+
+    # True once the whole current message has been received and read by recv/recv_into
+    def message_received(self) -> bool:
+        return (self.expected_total_bytes is not None and not self.chunked_message
+                and self.bytes_received_in_message >= self.expected_total_bytes
+                and len(self.recv_buffer) == 0 and not self._decompress_tail)
+
+    # Helper that receives segments until buffer_size bytes (or the rest of the message) are buffered
+    # Returns how many bytes can be delivered to the caller
+    # A delayed ACK is never left pending once control goes back to the caller
+    def _wait_buffered(self, buffer_size: int) -> int:
+        while not self._peer_closed:
             # Try to satisfy recv call from buffer
             if self.expected_total_bytes is not None:
                 n_bytes = min(buffer_size, self._remaining_to_deliver())
-                if n_bytes > 0 and len(self.recv_buffer) >= n_bytes:
-                    data_buffered = self.recv_buffer[:n_bytes]
-                    self.recv_buffer = self.recv_buffer[n_bytes:]
-                    return data_buffered
+                if n_bytes > 0 and (len(self.recv_buffer) >= n_bytes or self._recv_buffer_full()):
+                    self._flush_ack()
+                    return min(n_bytes, len(self.recv_buffer))
             
-            # Wait for data
+            # Wait for data, or until the delayed ACK is due
             try:
                 recv_segment, recv_address = self._wait_segment(
                     f_condition=lambda sock, rseg: True,
-                    f_update_seq=lambda sock, rseg: sock.seq
+                    f_update_seq=lambda sock, rseg: sock.seq,
+                    timeout=self._recv_timeout()
                 )
             except socket.timeout:
-                self._log(f'[{self.seq}] @recv, timeout waiting data, continuing')
+                if self._ack_deadline is not None:
+                    self._flush_ack()
+                else:
+                    self._log('[%s] @recv, timeout waiting data, continuing', self.seq)
                 continue
 
-            # If expected total bytes is not set, message should be bytecount of message
-            if self.expected_total_bytes is None or self.bytes_received_in_message >= self.expected_total_bytes:
-                self.expected_total_bytes = int(recv_segment.msg)
-                self.bytes_received_in_message = 0
-                self.current_message = ''
-                self.seq = recv_segment.seq + 1
+            # The peer closed the connection instead of sending another message, recv_close answers its FIN
+            if recv_segment.fin and not recv_segment.ack:
+                self._log('[%s] @recv, FIN received, peer closed the connection', self.seq)
+                self._flush_ack()
+                self.seq = recv_segment.seq
+                self._peer_closed = True
+                break
 
-                # Send bytecount ACK
-                ack_segment = SegmentTCP(False, True, False, self.seq, '')
-                self._send_segment(ack_segment)
-                continue
+            # Empty messages, the end of a chunked one or recv_file have nothing else to wait for
+            try:
+                message_completed = self._handle_data_segment(recv_segment)
+            except ValueError as e:
+                raise self._reset_invalid(e) from e
+            if message_completed and self.message_received():
+                self._flush_ack()
+                return 0
 
-            # Handle duplicates or out of order packages
-            # Just re-send the last ACK for the last confirmed package
-            if self.seq is not None and recv_segment.seq <= self.seq:
-                self._log(f'[{self.seq}] @recv, duplicate segment detected (seq {recv_segment.seq}), re-ACKing')
-                ack_segment = SegmentTCP(False, True, False, self.seq, '')
-                self._send_segment(ack_segment)
-                continue
+        return 0
 
-            # Otherwise, it is a slice of the message
-            data_bytes = recv_segment.msg.encode()
-            self.current_message += recv_segment.msg
-            self.bytes_received_in_message += len(data_bytes)
-            self.seq = recv_segment.seq
+    # Helper that processes a segment received while waiting data: BYTECOUNT, data slices or duplicates
+    # Returns True if the segment completed the current message
+    def _handle_data_segment(self, recv_segment: SegmentTCP) -> bool:
+        # ACKs carry no data, they belong to a previous exchange
+        if recv_segment.ack:
+            return False
 
-            # Send the ACK
-            tcp_segment = SegmentTCP(False, True, False, self.seq, '')
-            self._send_segment(tcp_segment)
+        # Handle duplicates, just re-send the ACK for the last confirmed package
+        if self.seq is not None and recv_segment.seq <= self.seq:
+            self._log('[%s] @recv, duplicate segment detected (seq %s), re-ACKing', self.seq, recv_segment.seq, level=TRACE_SEGMENTS)
+            self._send_ack(recv_segment.seq)
+            return False
+
+        # If expected total bytes is not set, message should be bytecount of message
+        if self.expected_total_bytes is None or self.bytes_received_in_message >= self.expected_total_bytes:
+            self._start_message(bytes(recv_segment.msg), recv_segment.seq)
+
+            # Send bytecount ACK
+            self._send_ack(None)
+            return not self.chunked_message and self.bytes_received_in_message >= self.expected_total_bytes
+
+        # Out of order packages are discarded, the cumulative ACK makes the sender go back.
+        # With Selective Repeat they are buffered until the gap is filled
+        data_bytes = recv_segment.msg
+        data_start_seq = recv_segment.seq - len(data_bytes)
+
+        # Older senders skip one seq between the BYTECOUNT ACK and the first slice
+        if self.bytes_received_in_message == 0 and data_start_seq == self.seq + 1:
+            self.seq += 1
+        if data_start_seq != self.seq:
+            if (self.transfer_mode == MODE_SELECTIVE_REPEAT
+                    and len(self.reorder_buffer) < self.window_size):
+                self._log('[%s] @recv, out of order segment (seq %s), buffering', self.seq, recv_segment.seq, level=TRACE_SEGMENTS)
+                self.reorder_buffer[data_start_seq] = recv_segment.msg
+                self._send_ack(recv_segment.seq)
+            else:
+                self._log('[%s] @recv, out of order segment (seq %s), re-ACKing', self.seq, recv_segment.seq, level=TRACE_SEGMENTS)
+                self._send_ack(None)
+            return False
+
+        # Otherwise, it is the next slice of the message, followed by any buffered contiguous data
+        self._deliver(recv_segment.msg)
+        filled_gap = False
+        while self.seq in self.reorder_buffer:
+            self._deliver(self.reorder_buffer.pop(self.seq))
+            filled_gap = True
+
+        # Send the ACK, the end of the message (or chunk) and filled gaps are ACKed right away
+        if (self.bytes_received_in_message >= self.expected_total_bytes or filled_gap
+                or not self._delays_acks()):
+            self._send_ack(recv_segment.seq)
+        else:
+            self._delay_ack(recv_segment.seq)
+        return not self.chunked_message and self.bytes_received_in_message >= self.expected_total_bytes
+
+    # Helper that starts receiving a message, or the next chunk of one, from its BYTECOUNT received with seq
+    def _start_message(self, bytecount: bytes, seq: int) -> None:
+        # Compressing senders wait for the window before a BYTECOUNT, so the previous message is decompressed by now.
+        # Otherwise it is finished first, beyond the free space
+        if self._decompress_tail:
+            self._store(self._decompress(b'', limit=False))
+
+        if not self.chunked_message:
+            self.expected_total_bytes = 0
+            self.bytes_received_in_message = 0
+            self._message_length = 0
+            self._message_delivered = 0
+            self.current_message = bytearray()
+
+        chunked = bytecount.startswith(CHUNK_BYTECOUNT_PREFIX)
+        if chunked:
+            bytecount = bytecount[len(CHUNK_BYTECOUNT_PREFIX):]
+
+        # Compressed messages (and chunks) get a new decompressor, the compressed bytes are what the seq counts
+        self._decompressor = None
+        if bytecount.startswith(COMPRESSED_BYTECOUNT_PREFIX):
+            if self._codec is None:
+                raise ValueError(f'Compressed message received, but no compression was negotiated: {bytecount!r}')
+            bytecount, _, length = bytecount[len(COMPRESSED_BYTECOUNT_PREFIX):].partition(COMPRESSED_LENGTH_SEPARATOR)
+            self._decompressor = self._codec.decompressor()
+        else:
+            length = bytecount
+        wire_length = int(bytecount)
+
+        # Chunked messages grow with each chunk until the empty one
+        if chunked:
+            self.expected_total_bytes += wire_length
+            self.chunked_message = wire_length > 0
+        else:
+            self.expected_total_bytes = wire_length
+        self._message_length += int(length)
 
-            # Store received bytes, only return up to buffer_size, thes remainder stays in the buffer
-            self.recv_buffer += data_bytes
-            # data_out = self.recv_buffer[:buffer_size]
-            # self.recv_buffer = self.recv_buffer[buffer_size:]
+        if self._recv_file is not None:
+            self._resize_recv_sink(self._message_length)
 
-            # return data_out
+        self.reorder_buffer = {}
+        self.seq = seq + 1
 
     # Terminates the socket
-    # Handles the B-Host-side FIN/ACK package exchange
+    # Handles the B-Host-side FIN/ACK package exchange. Returns once the peer's FIN+ACK arrives,
+    # TIME_WAIT (answering its retransmissions with the final ACK) goes on in the background
     def close(self) -> None:
         if self.is_closed:
             return
 
-        self._log(f'[{self.seq}] @close, initiating termination')
+        self._log('[%s] @close, initiating termination', self.seq)
 
         # Send FIN
         self.seq += 1
-        fin_segment = SegmentTCP(False, False, True, self.seq, '')
-        self._log(f'[{self.seq}] @close, send FIN')
+        fin_segment = SegmentTCP(False, False, True, self.seq, b'')
+        self._log('[%s] @close, send FIN', self.seq)
         self._send_segment(fin_segment)
+        sent_time = time.monotonic()
 
-        # Wait FIN+ACK (3 timeouts), on timeout resends FIN
+        # Wait FIN+ACK (MAX_RETRIES timeouts), on timeout resends FIN
         retries = 1
-        self._log(f'[{self.seq}] @close, wait FIN+ACK...')
+        self._log('[%s] @close, wait FIN+ACK...', self.seq)
         while True:
             try:
                 self._wait_segment(
@@ -281,135 +1081,651 @@ class SocketTCP:
                 )
                 break
             except socket.timeout:
+                # If the last FIN got no response, assume connection is closed.
+                if retries >= MAX_RETRIES:
+                    self._log('[%s] @close, %s timeouts waiting FIN+ACK, assume connection closed', self.seq, retries)
+                    self._close_socket()
+                    return
+
                 retries += 1
+                self.rtt.backoff()
+                sent_time = None
+                self._log('[%s] @close, timeout waiting FIN+ACK, resending FIN', self.seq)
+                self._resend_segment(fin_segment)
+            except ConnectionResetError:
+                return
 
-                # If third sent FIN+ACK without response, assume connection is closed.
-                if retries >= 3:
-                    self._log(f'[{self.seq}] @close, 3 timeouts waiting FIN+ACK, assume connection closed')
-                    self.socket.close()
-                    self.is_closed = True
-                    return
-                
-                self._log(f'[{self.seq}] @close, timeout waiting FIN+ACK, resending FIN')
-                self._send_segment(fin_segment)
-
-        # Send final ACK it 3 times with a timeout between sends.
-        ack_segment = SegmentTCP(False, True, False, self.seq, '')
-        for i in range(3):
-            self._log(f'[{self.seq}] @close, re-send final ACK {i+1}/3')
-            self._send_segment(ack_segment)
-            time.sleep(SEGMENT_TIMEOUT_SECONDS)
+        self._sample_rtt(sent_time)
 
-        self.socket.close()
-        self.is_closed = True
-        self._log(f'[{self.seq}] @close, connection closed')
+        # Send final ACK, the reaper sends it again for each FIN+ACK retransmitted during TIME_WAIT
+        ack_segment = SegmentTCP(False, True, False, self.seq, b'')
+        self._log('[%s] @close, send final ACK', self.seq)
+        self._send_segment(ack_segment)
+        self._linger(CLOSE_TIME_WAIT, ack_segment, time.monotonic() + TIME_WAIT_RTOS * self.rto)
+        self._log('[%s] @close, connection closed', self.seq)
 
     # Terminates the socket
-    # Handles the A-Host-side FIN/ACK package exchange
+    # Handles the A-Host-side FIN/ACK package exchange. Returns once the FIN+ACK is sent,
+    # waiting the final ACK (LAST_ACK, retransmitting the FIN+ACK) goes on in the background
     def recv_close(self) -> None:
         if self.is_closed:
             return
 
-        self._log(f'[{self.seq}] @recv_close, waiting FIN...')
+        self._log('[%s] @recv_close, waiting FIN...', self.seq)
+        self._flush_ack()
 
-        # Wait FIN
-        while True:
+        # Wait FIN, unless recv already got it
+        while not self._peer_closed:
             try:
                 recv_segment, _ = self._wait_segment(
                     f_condition=lambda sock, rseg: rseg.fin,
-                    f_update_seq=lambda sock, rseg: rseg.seq
+                    f_update_seq=lambda sock, rseg: rseg.seq,
+                    timeout=SEGMENT_TIMEOUT_SECONDS
                 )
                 break
             except socket.timeout:
-                self._log(
-                    f'[{self.seq}] @recv_close, timeout waiting FIN, continuing')
+                self._log('[%s] @recv_close, timeout waiting FIN, continuing', self.seq)
                 continue
+            except ConnectionResetError:
+                return
 
         # Send FIN+ACK
-        tcp_segment = SegmentTCP(False, True, True, self.seq, '')
-        self._log(f'[{self.seq}] @recv_close, send FIN+ACK')
+        tcp_segment = SegmentTCP(False, True, True, self.seq, b'')
+        self._log('[%s] @recv_close, send FIN+ACK', self.seq)
         self._send_segment(tcp_segment)
+        self._linger(CLOSE_LAST_ACK, tcp_segment, time.monotonic() + self.rto)
+        self._log('[%s] @recv_close, connection closed', self.seq)
 
-        retries = 1
-        self._log(f'[{self.seq}] @recv_close, wait final ACK...')
-        while True:
+    # Abortive close: sends an RST and closes right away, without the FIN exchange nor TIME_WAIT.
+    # Data the peer did not ACK yet is lost, its next call on the connection raises ConnectionResetError
+    def abort(self) -> None:
+        if self.is_closed:
+            return
+
+        if self.destination_addr is not None and self.seq is not None:
+            self._log('[%s] @abort, send RST', self.seq)
+            self._send_segment(SegmentTCP(True, False, True, self.seq, b''))
+        self._close_socket()
+        self._log('[%s] @abort, connection closed', self.seq)
+
+    # Helper that appends in-order data to the message and the receive buffer
+    def _deliver(self, data_bytes: bytes) -> None:
+        self.bytes_received_in_message += len(data_bytes)
+        self.seq += len(data_bytes)
+        if self._decompressor is not None:
+            data_bytes = self._decompress(data_bytes)
+        self._store(data_bytes)
+
+    # Helper that appends data of the message, already decompressed, to the receive buffer
+    def _store(self, data_bytes: bytes) -> None:
+        offset = self._message_delivered
+        self._message_delivered += len(data_bytes)
+        self._stats.bytes_delivered += len(data_bytes)
+
+        # recv_file writes at the offset of the data in the message
+        if self._recv_sink is not None:
+            self._recv_sink[offset:offset + len(data_bytes)] = data_bytes
+            return
+
+        if self.keep_current_message or (self.keep_current_message is None and not self._flow_control):
+            self.current_message += data_bytes
+
+        # Store received bytes, recv only returns up to buffer_size, the remainder stays in the buffer
+        self.recv_buffer.write(data_bytes)
+
+    # Helper that decompresses the next bytes of a compressed message (or chunk), after the ones held back.
+    # With flow control (and limit) the output fits in the free space of recv_buffer, the rest of the input waits
+    # in _decompress_tail until the application reads (see _resume_decompress), so a small compressed window
+    # can not blow up into a large buffer.
+    # Raises ValueError if the data is corrupt: the codec fails, or it decompresses to more than its BYTECOUNT
+    # said, or to less once it is all here
+    def _decompress(self, data_bytes: bytes, limit: bool = True) -> bytes:
+        if self._decompress_tail:
+            data_bytes = self._decompress_tail + data_bytes
+        max_length = 0
+        if limit and self._flow_control and self._recv_sink is None:
+            max_length = self.recv_buffer_size - len(self.recv_buffer)
+            if max_length <= 0:
+                self._decompress_tail = bytes(data_bytes)
+                return b''
+
+        try:
+            data_bytes = self._decompressor.decompress(data_bytes, max_length)
+        except self._codec.error as e:
+            raise ValueError(f'Corrupt compressed message: {e}') from e
+        self._decompress_tail = self._decompressor.unconsumed_tail
+
+        delivered = self._message_delivered + len(data_bytes)
+        if delivered > self._message_length or (
+                self.bytes_received_in_message >= self.expected_total_bytes and not self._decompress_tail
+                and delivered < self._message_length):
+            raise ValueError(f'Compressed message decompressed to {delivered} bytes, expected {self._message_length}')
+        return data_bytes
+
+    # Helper that decompresses the input held back by _decompress into the space the application freed
+    def _resume_decompress(self) -> None:
+        if self._decompress_tail:
+            try:
+                self._store(self._decompress(b''))
+            except ValueError as e:
+                raise self._reset_invalid(e) from e
+
+    # Helper that resets the connection after data it can not interpret (an invalid BYTECOUNT, corrupt
+    # compressed data). Returns the error for the caller to raise
+    def _reset_invalid(self, error: ValueError) -> ConnectionResetError:
+        self._log('[%s] @recv, invalid data from peer, resetting the connection: %s', self.seq, error)
+        self.abort()
+        return ConnectionResetError(f'Connection reset, invalid data from peer: {error}')
+
+    # Helper that sizes the recv_file destination to size bytes and maps it
+    # Chunked messages grow the file (and the map) with each chunk
+    def _resize_recv_sink(self, size: int) -> None:
+        if size == 0:
+            return
+
+        self._recv_file.truncate(size)
+        if self._recv_sink is None:
+            self._recv_sink = mmap.mmap(self._recv_file.fileno(), size)
+        elif len(self._recv_sink) != size:
+            self._recv_sink.resize(size)
+
+    # Helper that ACKs up to the last in-order seq, this also covers any delayed ACK
+    # With Selective Repeat the seq of the received segment also goes in the data.
+    # With flow control the data are options instead: the free window (wnd) and the SACK seq (sack)
+    def _send_ack(self, received_seq: 'int | None') -> None:
+        selective_ack = self.transfer_mode == MODE_SELECTIVE_REPEAT and received_seq is not None
+        if self._flow_control:
+            self._advertised_window = self._receive_window()
+            options = {'wnd': self._advertised_window}
+            if selective_ack:
+                options['sack'] = received_seq
+            ack_data = SegmentTCP.create_options(options)
+        else:
+            ack_data = str(received_seq).encode() if selective_ack else b''
+        ack_segment = SegmentTCP(False, True, False, self.seq, ack_data)
+        self._acked_seq = self.seq
+        self._send_segment(ack_segment)
+        self._unacked_segments = 0
+        self._ack_deadline = None
+
+    # Helper that reads the data of an ACK: the Selective Repeat SACK seq and the advertised window, None when missing
+    def _ack_data(self, ack_segment: SegmentTCP) -> 'tuple[int | None, int | None]':
+        if not ack_segment.msg:
+            return None, None
+        if not self._flow_control:
+            return int(ack_segment.msg), None
+
+        options = SegmentTCP.parse_options(ack_segment.msg)
+        sack, window = options.get('sack'), options.get('wnd')
+        return (int(sack) if sack is not None else None), (int(window) if window is not None else None)
+
+    # Helper that moves the end of the peer's receive window with the one advertised by an ACK.
+    # The end never goes back, so late ACKs are harmless
+    def _read_window(self, ack_segment: SegmentTCP) -> None:
+        self._peer_window_opened = False
+        _, window = self._ack_data(ack_segment)
+        if window is None:
+            return
+
+        window_end = ack_segment.seq + window
+        if self._peer_window_end is None or window_end > self._peer_window_end:
+            self._peer_window_opened = self._peer_window_end is not None
+            self._peer_window_end = window_end
+
+    # Helper that checks if n_bytes more data fit in the peer's receive window
+    def _window_allows(self, n_bytes: int) -> bool:
+        return self._peer_window_end is None or self.seq + n_bytes <= self._peer_window_end
+
+    # Helper that waits until the peer has room for n_bytes more. While its window stays closed it is probed
+    # with an empty segment, answered with an ACK that carries the current window (in case an update was lost)
+    def _wait_window(self, n_bytes: int) -> None:
+        persist_timeout = self.rto
+        probes = 0
+        while not self._window_allows(n_bytes):
             try:
                 self._wait_segment(
-                    f_condition=lambda sock, rseg: rseg.ack and rseg.seq == sock.seq,
-                    f_update_seq=lambda sock, rseg: sock.seq
+                    f_condition=lambda sock, rseg: rseg.ack,
+                    f_update_seq=lambda sock, rseg: sock.seq,
+                    timeout=persist_timeout
                 )
-                break
+                probes = 0
             except socket.timeout:
-                retries += 1
-                if retries >= 3:
-                    self._log(f'[{self.seq}] @recv_close, 3 timeouts waiting final ACK, assume connection closed')
-                    self.socket.close()
-                    self.is_closed = True
-                    self._log(f'[{self.seq}] @recv_close, connection closed')
-                    return
-                
-                self._log(f'[{self.seq}] @recv_close, timeout waiting final ACK, resending FIN+ACK')
-                tcp_segment = SegmentTCP(False, True, True, self.seq, '')
-                self._send_segment(tcp_segment)
+                self._check_retries(probes, 'window probe')
+                probes += 1
+                self._log('[%s] @send, receive window closed, sending window probe', self.seq)
+                self._send_segment(SegmentTCP(False, False, False, self.seq, b''))
+                self._stats.window_probes += 1
+                persist_timeout = min(persist_timeout * 2, SEGMENT_TIMEOUT_SECONDS)
 
-        self.socket.close()
-        self.is_closed = True
-        self._log(f'[{self.seq}] @recv_close, connection closed')
+    # Helper that returns the free space of the receive buffer, recv_file writes to the file instead.
+    # The window counts message bytes as the application reads them, decompressed: it stays closed while
+    # compressed input is held back waiting for room
+    def _receive_window(self) -> int:
+        if self._recv_sink is not None:
+            return self.recv_buffer_size
+        if self._decompress_tail:
+            return 0
+        return max(self.recv_buffer_size - len(self.recv_buffer), 0)
+
+    # Helper that checks if the sender ran out of window, so recv has to hand what it has instead of waiting more
+    def _recv_buffer_full(self) -> bool:
+        return self._flow_control and len(self.recv_buffer) > 0 and self._receive_window() < self.mss
+
+    # Helper that tells the sender its window opened after the application read from recv_buffer.
+    # Only once it grew by a segment (or half the buffer) or the buffer was emptied, smaller updates would make it
+    # send tiny segments
+    def _send_window_update(self) -> None:
+        if not self._flow_control or self._advertised_window is None:
+            return
+        self._resume_decompress()
+        window_growth = self._receive_window() - self._advertised_window
+        if window_growth >= min(self.mss, self.recv_buffer_size // 2) or (window_growth > 0 and not self.recv_buffer):
+            self._log('[%s] @recv, window opened to %s, sending window update', self.seq, self._receive_window(),
+                      level=TRACE_SEGMENTS)
+            self._send_ack(None)
+
+    # Whether in-order data may be ACKed late, Stop & Wait senders wait each ACK so they never are
+    def _delays_acks(self) -> bool:
+        return self.delayed_ack_segments > 1 and self.transfer_mode != MODE_STOP_AND_WAIT
+
+    # Helper that postpones the ACK of an in-order segment, until delayed_ack_segments are pending
+    def _delay_ack(self, received_seq: int) -> None:
+        self._unacked_segments += 1
+        self._pending_ack_seq = received_seq
+        # Segments already received are handled first, one ACK then covers the whole batch
+        if self._unacked_segments >= self.delayed_ack_segments and not self._segments_queued():
+            self._send_ack(received_seq)
+        elif self._ack_deadline is None:
+            self._ack_deadline = time.monotonic() + self.delayed_ack_timeout
+
+    # Helper that checks if received segments are waiting to be handled, drained by the batched datagram I/O
+    def _segments_queued(self) -> bool:
+        return self._io is not None and self._io.pending()
+
+    # Helper that sends the delayed ACK, if any
+    def _flush_ack(self) -> None:
+        if self._ack_deadline is not None:
+            self._send_ack(self._pending_ack_seq)
+
+    # Helper that picks how long recv waits for a segment: until the delayed ACK is due, if there is one
+    def _recv_timeout(self) -> float:
+        if self._ack_deadline is None:
+            return SEGMENT_TIMEOUT_SECONDS
+        return max(self._ack_deadline - time.monotonic(), 0.001)
 
     # Helper private method to send a tcp segment
     def _send_segment(self, tcp_segment) -> None:
-        message_bytes = SegmentTCP.create_segment(tcp_segment)
-        self._log(f'[{self.seq}] @_send_segment, sent msg: {tcp_segment}')
-        self.socket.sendto(message_bytes, (self.destination_addr, self.destination_port))
+        message_bytes = self._encode_segment(tcp_segment)
+        self._datagram_io().send((message_bytes,), (self.destination_addr, self.destination_port))
+
+    # Helper that sends several segments at once, in as few syscalls as the datagram I/O allows. Empties the list
+    def _send_segments(self, tcp_segments: list) -> None:
+        if not tcp_segments:
+            return
+        datagrams = [self._encode_segment(tcp_segment) for tcp_segment in tcp_segments]
+        tcp_segments.clear()
+        self._datagram_io().send(datagrams, (self.destination_addr, self.destination_port))
+
+    # Helper that serializes a segment about to be sent, counting and capturing it
+    def _encode_segment(self, tcp_segment) -> bytes:
+        message_bytes = SegmentTCP.create_segment(tcp_segment, self.header_version)
+        self._log('[%s] @_send_segment, sent msg: %s', self.seq, tcp_segment, level=TRACE_SEGMENTS)
+        self._stats.segments_sent += 1
+        self._stats.bytes_sent += len(tcp_segment.msg)
+        if self.capture is not None:
+            self.capture.write(message_bytes, self.socket.getsockname(), (self.destination_addr, self.destination_port))
+        return message_bytes
+
+    # Helper that sends a segment again, after a timeout or a duplicate from the peer
+    def _resend_segment(self, tcp_segment) -> None:
+        self._stats.retransmissions += 1
+        self._send_segment(tcp_segment)
 
     # Helper private method to await a tcp segment based on a condition
     # f_condition:  lambda function (self, received_segment)
     #               Condition for when the received message is accepted
     # f_update_seq: lambda function (self, received_segment)
     #               Assigns the new seq number to the caller
+    # timeout:      seconds to wait for each segment, the current RTO by default
     def _wait_segment(self, 
                       f_condition: Callable[['SocketTCP', SegmentTCP], bool], 
-                      f_update_seq: Callable[['SocketTCP', SegmentTCP], int]
+                      f_update_seq: Callable[['SocketTCP', SegmentTCP], int],
+                      timeout: 'float | None' = None
                       ) -> tuple[SegmentTCP, tuple[str, int]]:
-        is_waiting = True
-        while is_waiting:
+        timeout = self.rtt.rto if timeout is None else timeout
+        datagram_io = self._datagram_io()
+        while True:
+            blocked_since = time.monotonic()
             try:
-                recv_message, recv_address = self.socket.recvfrom(UDP_BUFFER_SIZE)
+                recv_message, recv_address = datagram_io.recv(timeout, max(UDP_BUFFER_SIZE, self.mss + MAX_HEADER_SIZE))
             except socket.timeout as exc:
                 raise exc
-            
-            recv_segment = SegmentTCP.parse_segment(recv_message)
-            self._log(f'[{self.seq}] @_wait_message, recv: {recv_segment}')
-            
-            condition_met = f_condition(self, recv_segment)
-            if condition_met:
-                is_waiting = False
-                self.seq = f_update_seq(self, recv_segment)
-                self._log(f'[{self.seq}] @_wait_message, confirmed')
-            else:
-                if recv_segment.syn and recv_segment.ack:
-                    ack_seq = recv_segment.seq + 1
-                    ack_segment = SegmentTCP(False, True, False, ack_seq, '')
-                    self._log(f'[{self.seq}] @_wait_message, duplicate SYN+ACK detected, resending ACK with seq={ack_seq}')
-                    self._send_segment(ack_segment)
-                else:
-                    if self.seq is not None and recv_segment.seq <= self.seq:
-                        ack_segment = SegmentTCP(False, True, False, self.seq, '')
-                        self._log(f'[{self.seq}] @_wait_message, duplicate segment seq={recv_segment.seq}<={self.seq}, resending ACK')
-                        self._send_segment(ack_segment)
+            finally:
+                self._stats.blocked_seconds += time.monotonic() - blocked_since
+
+            if self.capture is not None:
+                self.capture.write(recv_message, recv_address, self.socket.getsockname())
+            try:
+                recv_segment = SegmentTCP.parse_segment(recv_message)
+            except ValueError as e:
+                self._log('[%s] @_wait_message, dropping invalid datagram from %s: %s', self.seq, recv_address, e)
+                continue
+            if self._check_segment(recv_segment, f_condition, f_update_seq):
+                return recv_segment, recv_address
+
+    # Helper that checks a received segment against the condition of _wait_segment
+    # Updates the seq if it is met, otherwise re-ACKs duplicates. Returns whether the condition was met
+    def _check_segment(self,
+                       recv_segment: SegmentTCP,
+                       f_condition: Callable[['SocketTCP', SegmentTCP], bool],
+                       f_update_seq: Callable[['SocketTCP', SegmentTCP], int]
+                       ) -> bool:
+        self._log('[%s] @_wait_message, recv: %s', self.seq, recv_segment, level=TRACE_SEGMENTS)
+        self._stats.segments_received += 1
+        self._stats.bytes_received += len(recv_segment.msg)
+        if recv_segment.ack and self._flow_control and not recv_segment.syn:
+            self._read_window(recv_segment)
+
+        if recv_segment.rst:
+            # Listening sockets have no connection to reset, it belongs to a handshake they already dropped
+            if self.destination_addr is None:
+                return False
+            self._log('[%s] @_wait_message, RST received, connection reset by peer', self.seq)
+            self._close_socket()
+            raise ConnectionResetError(f'Connection reset by {self.destination_addr}:{self.destination_port}')
 
+        if f_condition(self, recv_segment):
+            self.seq = f_update_seq(self, recv_segment)
+            self._log('[%s] @_wait_message, confirmed', self.seq, level=TRACE_SEGMENTS)
+            return True
 
-        return recv_segment, recv_address
+        # ACKs that do not confirm what the caller waits for
+        if recv_segment.ack and not recv_segment.syn and not recv_segment.fin:
+            self._stats.duplicate_acks += 1
+
+        if recv_segment.syn and recv_segment.ack:
+            ack_seq = recv_segment.seq + 1
+            ack_segment = SegmentTCP(False, True, False, ack_seq, b'')
+            self._log('[%s] @_wait_message, duplicate SYN+ACK detected, resending ACK with seq=%s', self.seq, ack_seq, level=TRACE_SEGMENTS)
+            self._send_segment(ack_segment)
+        elif not recv_segment.ack:
+            if self.seq is not None and recv_segment.seq <= self.seq:
+                ack_seq = self.seq if self._acked_seq is None else self._acked_seq
+                ack_segment = SegmentTCP(False, True, False, ack_seq, b'')
+                self._log('[%s] @_wait_message, duplicate segment seq=%s<=%s, resending ACK with seq=%s', self.seq, recv_segment.seq, self.seq, ack_seq, level=TRACE_SEGMENTS)
+                self._send_segment(ack_segment)
+
+        return False
     
+    # Helper that feeds the RTT estimator with the time since a segment was sent
+    # sent_time is None for retransmitted segments, their ACK is ambiguous (Karn's rule)
+    def _sample_rtt(self, sent_time: 'float | None') -> None:
+        if sent_time is not None:
+            rtt = time.monotonic() - sent_time
+            self.rtt.sample(rtt)
+            self._stats.add_rtt_sample(rtt)
+
+    # Helper that checks if a segment received by a new connection completes its handshake: the ACK of the
+    # SYN+ACK or, if that ACK was lost, the first BYTECOUNT of the client. The BYTECOUNT itself is not ACKed,
+    # the client sends it again after its timeout
+    @staticmethod
+    def _completes_handshake(sock: 'SocketTCP', recv_segment: SegmentTCP) -> bool:
+        if recv_segment.ack:
+            return recv_segment.seq == sock.seq + 1
+        return not recv_segment.syn and not recv_segment.fin and recv_segment.seq == sock.seq + 2
+
+    # Helper that checks if a segment received by a new fast open connection completes its handshake: the ACK
+    # of the SYN+ACK or, if it was lost, any segment of the client after the SYN data, its FIN included
+    # (a message that fit in the SYN is followed by close). That segment is not ACKed, the client resends it
+    @staticmethod
+    def _completes_fast_open(sock: 'SocketTCP', recv_segment: SegmentTCP) -> bool:
+        if recv_segment.ack:
+            return recv_segment.seq == sock.seq + 1
+        return not recv_segment.syn and recv_segment.seq > sock.seq + 2
+
+    # Helper of listening sockets that picks the fast open options of the SYN+ACK for conn_socket: a cookie for
+    # clients that ask for one and, if the SYN has data and a valid cookie, how much of it was accepted.
+    # None without fast open
+    def _accept_fast_open(self, conn_socket: 'SocketTCP', options: dict[str, str],
+                          fast_open_data: 'bytes | None', address: tuple[str, int]) -> 'dict | None':
+        if not self.fast_open or 'tfo' not in options:
+            return None
+        if self._fast_open_cookies is None:
+            self._fast_open_cookies = FastOpenCookies()
+
+        # SYNs without data, or with an invalid BYTECOUNT, fall back to a normal handshake
+        fast_open_options = {'tfo': self._fast_open_cookies.cookie(address)}
+        bytecount = SocketTCP._fast_open_bytecount(options)
+        if (fast_open_data and bytecount is not None and len(fast_open_data) <= min(conn_socket.mss, bytecount)
+                and self._fast_open_cookies.is_valid(options['tfo'], address)):
+            fast_open_options['data'] = len(fast_open_data)
+            if conn_socket._flow_control:
+                fast_open_options['wnd'] = conn_socket.recv_buffer_size - len(fast_open_data)
+        return fast_open_options
+
+    # Helper that reads the BYTECOUNT of a fast open SYN, None if it has none or it is not a length
+    @staticmethod
+    def _fast_open_bytecount(options: dict[str, str]) -> 'int | None':
+        try:
+            bytecount = int(options['bytecount'])
+        except (KeyError, ValueError):
+            return None
+        return bytecount if bytecount >= 0 else None
+
+    # Helper that receives the BYTECOUNT and first slice of a fast open SYN, as if they followed the handshake
+    # with the BYTECOUNT at seq
+    def _receive_fast_open(self, bytecount: str, data: bytes, seq: int) -> None:
+        self._start_message(bytecount.encode(), seq)
+        if data:
+            self._deliver(data)
+
+    # Helper that closes the UDP socket, the connection is over
+    def _close_socket(self) -> None:
+        self.socket.close()
+        self.is_closed = True
+
+    # Helper of idle connections (see ConnectionPool), reads the segments queued since the last message without
+    # blocking. Returns False if the connection can no longer carry a new request: the peer closed it (recv_close
+    # then answers its FIN), reset it, or sent data nobody asked for. ACKs and invalid datagrams are dropped
+    def _reusable(self) -> bool:
+        if self.is_closed or self._peer_closed:
+            return False
+
+        datagram_io = self._datagram_io()
+        while True:
+            try:
+                recv_message, recv_address = datagram_io.recv(0, max(UDP_BUFFER_SIZE, self.mss + MAX_HEADER_SIZE))
+            except (socket.timeout, BlockingIOError, InterruptedError):
+                return True
+            if self.capture is not None:
+                self.capture.write(recv_message, recv_address, self.socket.getsockname())
+            try:
+                recv_segment = SegmentTCP.parse_segment(recv_message)
+            except ValueError:
+                continue
+
+            self._log('[%s] @_reusable, recv: %s', self.seq, recv_segment, level=TRACE_SEGMENTS)
+            if recv_segment.rst:
+                self._log('[%s] @_reusable, RST received, connection reset', self.seq)
+                self._close_socket()
+                return False
+            if recv_segment.fin and not recv_segment.ack:
+                self._log('[%s] @_reusable, FIN received, peer closed the connection', self.seq)
+                self.seq = recv_segment.seq
+                self._peer_closed = True
+                return False
+            if not recv_segment.ack:
+                return False
+
+    # Helper that hands the socket to the TimeWaitReaper for the rest of the teardown, until deadline at most.
+    # The connection is closed for the caller, the reaper closes the UDP socket once the teardown ends
+    def _linger(self, state: str, tcp_segment: SegmentTCP, deadline: float) -> None:
+        self._close_state = state
+        self._close_segment = tcp_segment
+        self._close_retries = 1
+        self.is_closed = True
+        time_wait_reaper().add(self, deadline)
+
+    # Helper of the reaper, reads a segment that arrived while lingering. Returns False once the teardown ended
+    def _linger_readable(self) -> bool:
+        try:
+            recv_message, recv_address = self._datagram_io().recv(0, max(UDP_BUFFER_SIZE, self.mss + MAX_HEADER_SIZE))
+        except (socket.timeout, BlockingIOError, InterruptedError):
+            return True
+
+        if self.capture is not None:
+            self.capture.write(recv_message, recv_address, self.socket.getsockname())
+        try:
+            recv_segment = SegmentTCP.parse_segment(recv_message)
+        except ValueError:
+            return True
+        return self._linger_segment(recv_segment)
+
+    # Helper that handles a segment received during TIME_WAIT or LAST_ACK, returns False once the teardown ended
+    def _linger_segment(self, recv_segment: SegmentTCP) -> bool:
+        self._log('[%s] @%s, recv: %s', self.seq, self._close_state, recv_segment, level=TRACE_SEGMENTS)
+        self._stats.segments_received += 1
+        self._stats.bytes_received += len(recv_segment.msg)
+
+        if recv_segment.rst:
+            self._log('[%s] @%s, RST received, teardown ended', self.seq, self._close_state)
+            return False
+
+        if self._close_state == CLOSE_TIME_WAIT:
+            # The final ACK was lost, the peer resent its FIN+ACK
+            if recv_segment.ack and recv_segment.fin:
+                self._log('[%s] @time_wait, FIN+ACK received again, resending final ACK', self.seq)
+                self._resend_segment(self._close_segment)
+            return True
+
+        if recv_segment.ack and not recv_segment.fin and recv_segment.seq == self.seq:
+            self._log('[%s] @last_ack, final ACK received, teardown ended', self.seq)
+            return False
+        # The FIN+ACK was lost, the peer resent its FIN
+        if recv_segment.fin:
+            self._log('[%s] @last_ack, FIN received again, resending FIN+ACK', self.seq)
+            self._resend_segment(self._close_segment)
+        return True
+
+    # Helper of the reaper, called when the lingering timer expires. Returns the next deadline, or None once
+    # the teardown ended: TIME_WAIT is over, or the FIN+ACK was sent MAX_RETRIES times without the final ACK
+    def _linger_timeout(self) -> 'float | None':
+        if self._close_state == CLOSE_TIME_WAIT:
+            self._log('[%s] @time_wait, teardown ended', self.seq)
+            return None
+
+        if self._close_retries >= MAX_RETRIES:
+            self._log('[%s] @last_ack, %s timeouts waiting final ACK, assume connection closed', self.seq, self._close_retries)
+            return None
+
+        self._close_retries += 1
+        self.rtt.backoff()
+        self._log('[%s] @last_ack, timeout waiting final ACK, resending FIN+ACK', self.seq)
+        self._resend_segment(self._close_segment)
+        return time.monotonic() + self.rto
+
+    # Helper that picks the header version and MSS from the options received in the handshake
+    # Peers that do not advertise them only understand the text header and MESSAGE_MAX_PACKET_SIZE segments
+    def _negotiate(self, options: dict[str, str]) -> None:
+        peer_version = SocketTCP._int_option(options, 'ver', HEADER_VERSION_TEXT)
+        if peer_version < HEADER_VERSION_TEXT:
+            raise ValueError(f'Invalid ver option: {peer_version}')
+        self.header_version = min(peer_version, self.max_header_version)
+
+        peer_mss = SocketTCP._int_option(options, 'mss', MESSAGE_MAX_PACKET_SIZE)
+        self.mss = max(min(self.mss, peer_mss, MAX_MSS), 1)
+
+        # Peers that advertise their receive buffer also advertise their window in each ACK.
+        # Segments never exceed either buffer, or the window could never fit one
+        self._flow_control = 'rwnd' in options
+        if self._flow_control:
+            self.mss = max(min(self.mss, SocketTCP._int_option(options, 'rwnd', 0), self.recv_buffer_size), 1)
+
+        # Messages are compressed only if both peers picked the same codec
+        self._codec = None
+        if self.compression is not None and options.get('comp') == self.compression:
+            self._codec = create_codec(self.compression)
+
+    # Helper that reads a non-negative integer option of the handshake, default when missing
+    # Raises ValueError if the peer sent anything else
+    @staticmethod
+    def _int_option(options: dict[str, str], name: str, default: int) -> int:
+        value = options.get(name)
+        if value is None:
+            return default
+        if not value.isascii() or not value.isdigit():
+            raise ValueError(f'Invalid {name} option: {value!r}')
+        return int(value)
+
+    # Helper that builds the options of the SYN and SYN+ACK segments: header version, MSS, receive buffer and
+    # compression codec, followed by the fast_open ones if any
+    def _handshake_options(self, version: int, fast_open: 'dict | None' = None) -> bytes:
+        options = {'ver': version, 'mss': self.mss, 'rwnd': self.recv_buffer_size}
+        if self.compression is not None:
+            options['comp'] = self.compression
+        if fast_open is not None:
+            options.update(fast_open)
+        return SegmentTCP.create_options(options)
+
+    # Helper that lazily slices a message into pieces of at most mss bytes, without copying.
+    # Text headers are read as str by older peers, so there slices never split a multi-byte UTF-8 character
+    def _slice_message(self, message: bytes) -> Iterator[memoryview]:
+        message_view = memoryview(message).cast('B')
+        message_length = len(message_view)
+        start = 0
+        while start < message_length:
+            end = min(start + self.mss, message_length)
+            if self.header_version == HEADER_VERSION_TEXT:
+                while start + 1 < end < message_length and message_view[end] & 0xC0 == 0x80:
+                    end -= 1
+            yield message_view[start:end]
+            start = end
+
+    # Helper that reads a send_stream source as chunks of about STREAM_CHUNK_SIZE bytes
+    # Small items of an iterable are joined, so each chunk is only copied once
+    def _iter_chunks(self, source) -> Iterator[bytes]:
+        if hasattr(source, 'read'):
+            while True:
+                chunk = source.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+        pending = []
+        pending_length = 0
+        for item in source:
+            pending.append(item)
+            pending_length += len(item)
+            if pending_length >= STREAM_CHUNK_SIZE:
+                yield pending[0] if len(pending) == 1 else b''.join(pending)
+                pending = []
+                pending_length = 0
+
+        if pending_length > 0:
+            yield pending[0] if len(pending) == 1 else b''.join(pending)
+
+    # Helper that checks a stream produces exactly the bytes announced in its BYTECOUNT
+    def _count_slices(self, messages_sliced: Iterable[memoryview], total_length: int) -> Iterator[memoryview]:
+        bytes_sent = 0
+        for message_slice in messages_sliced:
+            bytes_sent += len(message_slice)
+            if bytes_sent > total_length:
+                raise ValueError(f'Error: stream is longer than total_length={total_length}')
+            yield message_slice
+
+        if bytes_sent != total_length:
+            raise ValueError(f'Error: stream ended after {bytes_sent} bytes, expected total_length={total_length}')
+
     # Helper that calculates how many bytes remain to deliver
     def _remaining_to_deliver(self) -> int:
         if self.expected_total_bytes is None:
             return 0
         
-        delivered_so_far = self.bytes_received_in_message - len(self.recv_buffer)
-        return max(self.expected_total_bytes - delivered_so_far, 0)
+        delivered_so_far = self._message_delivered - len(self.recv_buffer)
+        return max(self._message_length - delivered_so_far, 0)
 
     # Helper debugging function
-    def _log(self, message: str) -> None:
-        if self.debug_mode:
-            print(message)
+    # message is only formatted (message % args) when level is enabled, callers pass the values as args
+    def _log(self, message: str, *args, level: int = TRACE_EVENTS) -> None:
+        if self.debug_mode or self.trace_level >= level:
+            print(message % args if args else message)
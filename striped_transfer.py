@@ -0,0 +1,230 @@
+"""
+Striped transfers for the Simplified TCP: one message or file split across parallel connections and processes.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import mmap
+import os
+import queue
+import socket
+import threading
+import time
+from typing import Callable
+
+from segment_tcp import SegmentTCP
+from socket_tcp import SocketTCP
+from workers import start_worker, results_queue
+
+# Stripes of a transfer by default, one per core
+DEFAULT_STRIPES = os.cpu_count() or 4
+# Seconds the receiver waits for a new connection before it checks the headers that arrived
+HEADER_POLL_SECONDS = 0.05
+# Numeric options of a stripe header
+STRIPE_HEADER_FIELDS = ('stripe', 'stripes', 'offset', 'length', 'total')
+
+# A striped transfer splits its data into contiguous stripes, each one sent by its own worker over its own
+# connection. The first message of each connection is a header with the options:
+# transfer (id shared by every stripe), stripe (index), stripes (how many), offset, length and total (bytes of
+# the whole data). The stripe's data follows as a second message, stripes of length 0 have none.
+# The receiver preallocates the output with total and each of its workers writes its stripe in place.
+# Workers are processes (see workers.py), so the stripes use several cores, or threads with processes=False.
+
+# Sends source (bytes-like, or the path of a file) to the server at address in stripes parallel connections.
+# configure is called with each socket before it connects (transfer mode, window, compression...).
+# Returns the report of the transfer, see _report
+def send_striped(address: tuple[str, int], source: 'bytes | str', stripes: int = DEFAULT_STRIPES,
+                 configure: 'Callable[[SocketTCP], None] | None' = None, processes: bool = True) -> dict:
+    if stripes < 1:
+        raise ValueError(f'stripes must be at least 1, got {stripes}')
+
+    if isinstance(source, str):
+        total = os.path.getsize(source)
+    else:
+        total = len(memoryview(source).cast('B'))
+    transfer = os.urandom(8).hex()
+    ranges = _stripe_ranges(total, stripes)
+
+    start = time.monotonic()
+    results = results_queue(processes)
+    workers = [
+        start_worker(processes, _send_stripe, (
+            address, source, configure, _stripe_header(transfer, stripe, len(ranges), offset, length, total), results
+        ))
+        for stripe, (offset, length) in enumerate(ranges)
+    ]
+    return _report(workers, results, total, start)
+
+# Receives a striped transfer from the clients that connect to server_socket (already bound) into the file at
+# path, each stripe written at its offset. The header of each connection is read by its own thread, so a silent
+# client does not hold back the others. Connections whose header is malformed or does not belong to the transfer
+# are aborted and skipped.
+# Returns the report of the transfer, see _report
+def recv_striped(server_socket: SocketTCP, path: str, processes: bool = True) -> dict:
+    transfer = None
+    stripes = None
+    total = 0
+    received = set()
+    workers = []
+    results = results_queue(processes)
+    start = None
+    # (connection, header) of each connection whose header was read, header is None if malformed
+    headers = queue.Queue()
+
+    while stripes is None or len(received) < stripes:
+        try:
+            conn_socket, _ = server_socket.accept(timeout=HEADER_POLL_SECONDS)
+            if start is None:
+                start = time.monotonic()
+            threading.Thread(target=_read_stripe_header, args=(conn_socket, headers), daemon=True).start()
+        except socket.timeout:
+            pass
+
+        while not headers.empty():
+            conn_socket, header = headers.get_nowait()
+            if header is None or transfer not in (None, header['transfer']) or header['stripe'] in received \
+                    or (transfer is not None and (header['stripes'], header['total']) != (stripes, total)):
+                conn_socket.abort()
+                continue
+
+            # The first stripe tells the size of the output
+            if transfer is None:
+                transfer, stripes, total = header['transfer'], header['stripes'], header['total']
+                with open(path, 'wb') as file:
+                    file.truncate(total)
+
+            received.add(header['stripe'])
+            workers.append(start_worker(processes, _recv_stripe, (
+                conn_socket, path, header['stripe'], header['offset'], header['length'], results
+            )))
+            # The worker process has its own copy of the connection
+            if processes:
+                conn_socket._close_socket()
+
+    return _report(workers, results, total, start)
+
+# Returns the report of a transfer as text, a line per stripe and one with the totals
+def format_report(report: dict) -> str:
+    lines = []
+    for result in report['stripes']:
+        line = f"stripe {result['stripe']}: {result['length']} bytes at {result['offset']}, "
+        if 'error' in result:
+            lines.append(line + f"failed: {result['error']}")
+        else:
+            lines.append(line + f"{result['seconds']} s, {result['throughput_bytes_per_second']} B/s, "
+                                f"{result['retransmissions']} retransmissions")
+    lines.append(f"total   : {report['bytes']} bytes, {report['seconds']} s, {report['throughput_bytes_per_second']} B/s")
+    return '\n'.join(lines)
+
+# Helper that splits total bytes into at most stripes contiguous (offset, length) ranges, at least one
+def _stripe_ranges(total: int, stripes: int) -> list[tuple[int, int]]:
+    stripes = max(min(stripes, total), 1)
+    stripe_length, remainder = divmod(total, stripes)
+    ranges = []
+    offset = 0
+    for stripe in range(stripes):
+        length = stripe_length + (1 if stripe < remainder else 0)
+        ranges.append((offset, length))
+        offset += length
+    return ranges
+
+def _stripe_header(transfer: str, stripe: int, stripes: int, offset: int, length: int, total: int) -> bytes:
+    return SegmentTCP.create_options({
+        'transfer': transfer, 'stripe': stripe, 'stripes': stripes, 'offset': offset, 'length': length, 'total': total
+    })
+
+# Helper worker of send_striped: connects, sends the header and the stripe, and closes
+def _send_stripe(address: tuple[str, int], source: 'bytes | str', configure: 'Callable[[SocketTCP], None] | None',
+                 header: bytes, results) -> None:
+    options = SegmentTCP.parse_options(header)
+    stripe, offset, length = int(options['stripe']), int(options['offset']), int(options['length'])
+    tcp_socket = SocketTCP()
+    try:
+        if configure is not None:
+            configure(tcp_socket)
+        tcp_socket.connect(address)
+        start = time.monotonic()
+        tcp_socket.send(header)
+        if length > 0:
+            if isinstance(source, str):
+                with open(source, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                    tcp_socket.send(memoryview(file_map)[offset:offset + length])
+            else:
+                tcp_socket.send(memoryview(source).cast('B')[offset:offset + length])
+        tcp_socket.close()
+        results.put(_stripe_result(tcp_socket, stripe, offset, length, time.monotonic() - start))
+    except Exception as e:
+        tcp_socket.abort()
+        results.put({'stripe': stripe, 'offset': offset, 'length': length, 'error': repr(e)})
+
+# Helper thread of recv_striped: reads the header of a connection and puts it, parsed, in headers
+def _read_stripe_header(conn_socket: SocketTCP, headers: queue.Queue) -> None:
+    try:
+        header = _parse_stripe_header(conn_socket.recv_message() or b'')
+    except Exception:
+        header = None
+    headers.put((conn_socket, header))
+
+# Helper that parses a stripe header, None if an option is missing, is not a non-negative integer
+# or the stripe falls outside the transfer
+def _parse_stripe_header(message: bytes) -> 'dict | None':
+    options = SegmentTCP.parse_options(message)
+    values = [options.get(name, '') for name in STRIPE_HEADER_FIELDS]
+    if 'transfer' not in options or not all(value.isascii() and value.isdigit() for value in values):
+        return None
+    header = dict(zip(STRIPE_HEADER_FIELDS, map(int, values)))
+    if header['stripe'] >= header['stripes'] or header['offset'] + header['length'] > header['total']:
+        return None
+    header['transfer'] = options['transfer']
+    return header
+
+# Helper worker of recv_striped: receives the stripe straight into the mapped output, at its offset
+def _recv_stripe(conn_socket: SocketTCP, path: str, stripe: int, offset: int, length: int, results) -> None:
+    start = time.monotonic()
+    try:
+        if length > 0:
+            with open(path, 'r+b') as file, mmap.mmap(file.fileno(), 0) as file_map:
+                stripe_view = memoryview(file_map)[offset:offset + length]
+                received = 0
+                while received < length:
+                    n_bytes = conn_socket.recv_into(stripe_view[received:])
+                    if n_bytes == 0:
+                        raise ConnectionError(f'Stripe {stripe} ended after {received} of {length} bytes')
+                    received += n_bytes
+                stripe_view.release()
+                file_map.flush()
+        conn_socket.recv_close()
+        results.put(_stripe_result(conn_socket, stripe, offset, length, time.monotonic() - start))
+    except Exception as e:
+        conn_socket.abort()
+        results.put({'stripe': stripe, 'offset': offset, 'length': length, 'error': repr(e)})
+
+def _stripe_result(tcp_socket: SocketTCP, stripe: int, offset: int, length: int, seconds: float) -> dict:
+    stats = tcp_socket.stats()
+    return {
+        'stripe': stripe,
+        'offset': offset,
+        'length': length,
+        'seconds': round(seconds, 6),
+        'throughput_bytes_per_second': round(length / seconds, 1) if seconds > 0 else None,
+        'retransmissions': stats['retransmissions'],
+        'pid': os.getpid(),
+    }
+
+# Helper that waits every worker and builds the report of the transfer:
+# ok, total bytes, seconds from start to the last stripe's end, aggregate throughput and the result of each stripe, sorted by stripe.
+# Failed stripes have an error instead of their measurements
+def _report(workers: list, results, total: int, start: float) -> dict:
+    stripe_results = [results.get() for _ in workers]
+    seconds = time.monotonic() - start
+    for worker in workers:
+        worker.join()
+
+    stripe_results.sort(key=lambda result: result['stripe'])
+    return {
+        'ok': all('error' not in result for result in stripe_results),
+        'bytes': total,
+        'seconds': round(seconds, 6),
+        'throughput_bytes_per_second': round(total / seconds, 1) if seconds > 0 else None,
+        'stripes': stripe_results,
+    }
@@ -0,0 +1,146 @@
+"""
+Background teardown of closed Simplified TCP connections: TIME_WAIT and LAST_ACK, off the caller's thread.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import heapq
+import itertools
+import os
+import selectors
+import socket
+import threading
+import time
+
+# Keeps the UDP sockets of connections that close and recv_close already returned from, until their
+# teardown ends: answering late FIN+ACKs during TIME_WAIT, or retransmitting the FIN+ACK until the final ACK.
+# A single thread serves every lingering socket with one selector and a heap of timers. The protocol is left
+# to each SocketTCP, through two helpers:
+# - _linger_readable(), called when its socket is readable, returns False once the teardown ended
+# - _linger_timeout(), called when its timer expires, returns the next deadline or None to end it
+# Ended sockets are closed by the reaper
+class TimeWaitReaper:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # (deadline, counter, socket) heap, entries whose deadline changed are skipped when they expire
+        self.timers = []
+        self.deadlines = {}
+        self._timer_counter = itertools.count()
+        # Sockets added from other threads, registered by the reaper thread (selectors are not thread safe)
+        self.added = []
+        self.lock = threading.Lock()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self.thread = None
+
+    def __str__(self):
+        return f'<TimeWaitReaper> [LINGERING:{len(self)}]'
+
+    def __repr__(self):
+        return str(self)
+
+    # Sockets still lingering, including those added but not registered yet
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.deadlines) + len(self.added)
+
+    # Hands a closed SocketTCP to the reaper until its teardown ends, or until deadline (time.monotonic()) at most
+    def add(self, tcp_socket, deadline: float) -> None:
+        with self.lock:
+            self.added.append((tcp_socket, deadline))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='TimeWaitReaper', daemon=True)
+                self.thread.start()
+        self._wakeup_send.send(b'\0')
+
+    # Waits until no socket is lingering, or timeout seconds. Returns whether they all ended
+    def wait(self, timeout: 'float | None' = None) -> bool:
+        end = None if timeout is None else time.monotonic() + timeout
+        while len(self) > 0:
+            if end is not None and time.monotonic() >= end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    # Helper loop of the reaper thread
+    def _run(self) -> None:
+        while True:
+            timeout = None
+            if self.timers:
+                timeout = max(self.timers[0][0] - time.monotonic(), 0)
+
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self._wakeup_recv:
+                    self._register_added()
+                elif not key.data._linger_readable():
+                    self._end(key.data)
+
+            self._run_timers()
+
+    # Helper that registers the sockets added since the last wakeup
+    def _register_added(self) -> None:
+        try:
+            while self._wakeup_recv.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.lock:
+            added, self.added = self.added, []
+            for tcp_socket, deadline in added:
+                self.selector.register(tcp_socket.socket, selectors.EVENT_READ, tcp_socket)
+                self._set_timer(tcp_socket, deadline)
+
+        # Segments already read from the socket before it was handed over
+        for tcp_socket, _ in added:
+            while tcp_socket._datagram_io().pending():
+                if not tcp_socket._linger_readable():
+                    self._end(tcp_socket)
+                    break
+
+    # Helper that calls _linger_timeout of every socket whose timer expired
+    def _run_timers(self) -> None:
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, _, tcp_socket = heapq.heappop(self.timers)
+            if self.deadlines.get(tcp_socket) != deadline:
+                continue
+
+            next_deadline = tcp_socket._linger_timeout()
+            if next_deadline is None:
+                self._end(tcp_socket)
+            else:
+                self._set_timer(tcp_socket, next_deadline)
+
+    def _set_timer(self, tcp_socket, deadline: float) -> None:
+        self.deadlines[tcp_socket] = deadline
+        heapq.heappush(self.timers, (deadline, next(self._timer_counter), tcp_socket))
+
+    # Helper that closes a socket whose teardown ended
+    def _end(self, tcp_socket) -> None:
+        with self.lock:
+            if self.deadlines.pop(tcp_socket, None) is None:
+                return
+            self.selector.unregister(tcp_socket.socket)
+        tcp_socket.socket.close()
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+# Returns the reaper shared by every socket of the process, created on the first close
+def time_wait_reaper() -> TimeWaitReaper:
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = TimeWaitReaper()
+        return _reaper
+
+# A forked child does not get the reaper thread of its parent, it creates its own on its first close
+def _reset_after_fork() -> None:
+    global _reaper, _reaper_lock
+    _reaper = None
+    _reaper_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,92 @@
+"""
+Tracing for the Simplified TCP: trace levels and a pcap capture of the segments.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import socket
+import struct
+import threading
+import time
+
+# Trace levels, each one includes the previous ones
+# Messages are only formatted when their level is enabled
+TRACE_OFF = 0
+# Handshake, timeouts, retransmissions and close
+TRACE_EVENTS = 1
+# Every segment sent and received
+TRACE_SEGMENTS = 2
+
+# pcap format, segments are stored as IPv4/UDP datagrams so usual tools (tcpdump, Wireshark) can read them
+PCAP_GLOBAL_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD_HEADER = struct.Struct('<IIII')
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_SNAPLEN = 65535
+LINKTYPE_RAW = 101
+IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+UDP_HEADER = struct.Struct('!HHHH')
+IP_PROTOCOL_UDP = 17
+IP_TTL = 64
+# Hosts whose packed IPv4 address a writer remembers, it starts over when full
+ADDRESS_CACHE_SIZE = 256
+
+# Writes every segment it is given to a pcap file, as seen by the socket that sent or received it.
+# Can be shared by several sockets (accept passes it to each connection), writes are serialized
+class PcapWriter:
+    def __init__(self, path: str):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        # Packed IPv4 address of each host written, so resolving it is not paid per packet
+        self.addresses = {}
+        self.file.write(PCAP_GLOBAL_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, PCAP_SNAPLEN, LINKTYPE_RAW))
+
+    def __enter__(self) -> 'PcapWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    # Appends a datagram sent from source to destination, both (host, port)
+    def write(self, data: bytes, source: tuple[str, int], destination: tuple[str, int]) -> None:
+        udp_length = UDP_HEADER.size + len(data)
+        udp_header = UDP_HEADER.pack(source[1], destination[1], udp_length, 0)
+        ip_header = IPV4_HEADER.pack(
+            0x45, 0, IPV4_HEADER.size + udp_length, 0, 0, IP_TTL, IP_PROTOCOL_UDP, 0,
+            self._ip_bytes(source[0]), self._ip_bytes(destination[0])
+        )
+        ip_header = ip_header[:10] + struct.pack('!H', PcapWriter._checksum(ip_header)) + ip_header[12:]
+
+        packet_length = len(ip_header) + udp_length
+        now = time.time()
+        seconds = int(now)
+        with self.lock:
+            self.file.write(PCAP_RECORD_HEADER.pack(seconds, int((now - seconds) * 1_000_000),
+                                                    min(packet_length, PCAP_SNAPLEN), packet_length))
+            self.file.write(ip_header)
+            self.file.write(udp_header)
+            self.file.write(data[:PCAP_SNAPLEN - len(ip_header) - UDP_HEADER.size])
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+    # IPv4 address of host, addresses that can not be resolved are stored as 0.0.0.0
+    def _ip_bytes(self, host: str) -> bytes:
+        address = self.addresses.get(host)
+        if address is None:
+            try:
+                address = socket.inet_aton(socket.gethostbyname(host or '0.0.0.0'))
+            except OSError:
+                address = bytes(4)
+            if len(self.addresses) >= ADDRESS_CACHE_SIZE:
+                self.addresses.clear()
+            self.addresses[host] = address
+        return address
+
+    # Internet checksum of the IPv4 header
+    @staticmethod
+    def _checksum(header: bytes) -> int:
+        total = sum(struct.unpack(f'!{len(header) // 2}H', header))
+        while total > 0xFFFF:
+            total = (total & 0xFFFF) + (total >> 16)
+        return ~total & 0xFFFF
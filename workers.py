@@ -0,0 +1,37 @@
+"""
+Worker processes (or threads) of the parallel tools of the Simplified TCP: striped transfers, sharded servers, load generators.
+CC4303 - Computer Networks
+Author: Augusto Aguayo Barham
+"""
+
+import multiprocessing
+import queue
+import threading
+from typing import Callable
+
+from socket_tcp import SEGMENT_TIMEOUT_SECONDS
+from time_wait import time_wait_reaper
+
+# Seconds a worker process waits for the teardown of its connections (TIME_WAIT, LAST_ACK) before exiting
+WORKER_EXIT_LINGER_SECONDS = 2 * SEGMENT_TIMEOUT_SECONDS
+
+# Workers are processes created with fork (so they can take any callable, and the sockets and settings of the
+# parent), or threads with processes=False. Either way they report back through a results_queue
+
+# Starts target(*args) in a new worker, returns the Process or Thread
+def start_worker(processes: bool, target: Callable, args: tuple):
+    if processes:
+        worker = multiprocessing.get_context('fork').Process(target=_run_process, args=(target, args))
+    else:
+        worker = threading.Thread(target=target, args=args)
+    worker.start()
+    return worker
+
+# Queue shared by the workers and their parent
+def results_queue(processes: bool):
+    return multiprocessing.get_context('fork').Queue() if processes else queue.Queue()
+
+# Helper entry point of worker processes, gives the connections' teardown some time before the process exits
+def _run_process(target: Callable, args: tuple) -> None:
+    target(*args)
+    time_wait_reaper().wait(WORKER_EXIT_LINGER_SECONDS)